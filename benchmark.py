@@ -0,0 +1,406 @@
+"""Benchmarks for invoice rendering, pricing and the request path.
+
+Run from the project root:
+
+    python benchmark.py run --iterations 50 --output results.json
+    python benchmark.py run --baseline results.json
+    python benchmark.py templates --iterations 200
+    python benchmark.py startup
+    python benchmark.py print-run --invoices 200
+    python benchmark.py profiles
+
+``run`` times ``create_pdf``, ``create_pdf_pharma`` (1, 5, 50 and 5,000 line
+items, with and without the logo/watermark images), the pricing step of
+``Create()`` and the full ``POST /`` path through Flask's test client. The
+database is a throwaway SQLite file and PDFs go to a temporary directory, so a
+run never touches the configured MySQL server or the ``INVOICE/`` folder.
+``startup`` measures cold starts of fresh interpreters with and without
+``preload()``. ``print-run`` compares one print-run PDF of many invoices with
+rendering them one by one and merging the files (merging needs ``pypdf``;
+without it only the summed size of the separate files is reported), and times
+``generate_print_run`` end to end, as a stored run and as a draft.
+``profiles`` reports the PDF size and render time of each output profile.
+"""
+import os
+import io
+import sys
+import json
+import time
+import atexit
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+_WORKDIR = tempfile.mkdtemp(prefix='invoice-bench-')
+atexit.register(shutil.rmtree, _WORKDIR, True)
+os.environ.update({
+    'DB_BACKEND': 'sqlite',
+    'DB_SQLITE_PATH': os.path.join(_WORKDIR, 'bench.sqlite3'),
+    'DB_WRITE_BEHIND': '0',
+    # Every iteration posts the same form; content dedupe would turn them into cache hits
+    'IDEMPOTENCY_WINDOW': '0',
+    'INVOICE_STORAGE': 'local',
+    'INVOICE_DIR': os.path.join(_WORKDIR, 'INVOICE'),
+    'RENDER_MODE': 'sync',
+})
+
+import server
+import reportlab
+from reportlab.pdfgen import canvas
+
+ITEM_COUNTS = (1, 5, 50, 5000)
+REQUEST_ITEM_COUNTS = (1, 5, 50)
+
+
+def _render_pharma(timestamp, products=('Pens', 'Erasers'), quantities=(3, 2)):
+    return server.create_pdf_pharma('ACME Corp', 'Line 1\nLine 2', '1.5', '10', '', timestamp, canvas, '01/01/2026',
+                                    '1.65', list(products), list(quantities), 5.0, 3.35, 'Jane Doe', '555-0100')
+
+
+def _render_tan(timestamp):
+    return server.create_pdf('ACME Corp', 'Line 1\nLine 2', '1.5', '10', '', timestamp, canvas, '01/01/2026', '1.65', 'Pens')
+
+
+def _line_items(count):
+    names = sorted(server.PRODUCT_PRICES)
+    return [names[i % len(names)] for i in range(count)], [i % 9 + 1 for i in range(count)]
+
+
+def _form(count):
+    form = {'CompanyName': 'ACME Corp', 'CompanyAddress': 'Line 1\nLine 2', 'CustomerName': 'Jane Doe',
+            'CustomerPhone': '555-0100', 'Email': 'jane@example.com', 'STax': '10', 'AmountPaid': '1000'}
+    for i, (product, quantity) in enumerate(zip(*_line_items(count)), 1):
+        form[f'Product{i}'] = product
+        form[f'Quantity{i}'] = str(quantity)
+    return form
+
+
+def _set_assets(enabled):
+    # Point the renderers at missing files to measure invoices without logo and watermark
+    server.WATERMARK_FILE = '.webp' if enabled else '.no-watermark'
+    server.LOGO_FILES = ('logo.png', 'logo.jpg') if enabled else ('.no-logo.png',)
+
+
+def _peak_rss_mb():
+    # Peak resident set size of this process so far (ru_maxrss is KiB on Linux, bytes on macOS)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1)
+
+
+def _percentile(ordered, q):
+    # Nearest-rank percentile of an already sorted list
+    index = max(0, min(len(ordered) - 1, int(round(q / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def _iterations_for(items, iterations):
+    # Scale the large cases down so a run stays in the minutes range
+    return max(3, min(iterations, iterations * 50 // max(items, 1)))
+
+
+def _measure(run, iterations):
+    """Time ``run`` (which returns the output size in bytes, or None) and summarize the samples."""
+    run()  # warm caches, templates and the connection pool
+    samples = []
+    size = None
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        size = run()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    elapsed = time.perf_counter() - started
+    ordered = sorted(samples)
+    return {
+        'iterations': iterations,
+        'mean_ms': round(statistics.mean(samples), 3),
+        'p50_ms': round(_percentile(ordered, 50), 3),
+        'p90_ms': round(_percentile(ordered, 90), 3),
+        'p99_ms': round(_percentile(ordered, 99), 3),
+        'max_ms': round(ordered[-1], 3),
+        'per_sec': round(iterations / elapsed, 2) if elapsed else None,
+        'peak_rss_mb': _peak_rss_mb(),
+        'pdf_bytes': size,
+    }
+
+
+def _cases(iterations):
+    # (name, iterations, callable returning the output size) in increasing memory order,
+    # since peak RSS only ever grows within a process
+    cases = [('create_pdf', iterations, lambda: os.path.getsize(_render_tan('bench-tan')))]
+    for items in ITEM_COUNTS:
+        products, quantities = _line_items(items)
+        form = _form(items)
+        for with_assets in (True, False):
+            def run(with_assets=with_assets, products=products, quantities=quantities):
+                _set_assets(with_assets)
+                return os.path.getsize(_render_pharma('bench-pharma', products, quantities))
+            suffix = 'assets' if with_assets else 'plain'
+            cases.append((f'create_pdf_pharma/{items}/{suffix}', _iterations_for(items, iterations), run))
+        def price(form=form):
+            server._price_invoice(server._invoice_from_mapping(form))
+            return None
+        cases.append((f'pricing/{items}', iterations, price))
+    client = server.app.test_client()
+    for items in REQUEST_ITEM_COUNTS:
+        def post(form=_form(items)):
+            _set_assets(True)
+            response = client.post('/', data=form)
+            if response.status_code != 200 or b'Invoice created' not in response.data:
+                raise RuntimeError(f'POST / failed with {response.status_code}')
+            return None
+        cases.append((f'post/{items}', _iterations_for(items, iterations), post))
+    return cases
+
+
+def _compare(results, baseline, threshold):
+    # Print the change in median latency per case; returns the names that regressed beyond threshold (%)
+    regressions = []
+    print(f"\n{'case':<34} {'baseline p50':>12} {'p50':>10} {'change':>8}")
+    for name, stats in results.items():
+        before = baseline.get(name)
+        if not before or not before.get('p50_ms'):
+            continue
+        change = (stats['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100.0
+        flag = ' REGRESSION' if change > threshold else ''
+        if flag:
+            regressions.append(name)
+        print(f"{name:<34} {before['p50_ms']:>12.2f} {stats['p50_ms']:>10.2f} {change:>+7.1f}%{flag}")
+    return regressions
+
+
+def bench_run(args):
+    """Run the full suite, optionally saving the results and comparing them with a baseline."""
+    server.migrate()
+    server.catalog.warm()
+    results = {}
+    print(f"{'case':<34} {'n':>5} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'per sec':>9} {'rss MB':>8} {'bytes':>9}")
+    for name, iterations, run in _cases(args.iterations):
+        if args.filter and args.filter not in name:
+            continue
+        stats = results[name] = _measure(run, iterations)
+        print(f"{name:<34} {iterations:>5} {stats['p50_ms']:>9.2f} {stats['p90_ms']:>9.2f} {stats['p99_ms']:>9.2f} "
+              f"{stats['per_sec']:>9.1f} {stats['peak_rss_mb'] or 0:>8.1f} {stats['pdf_bytes'] or '':>9}")
+    _set_assets(True)
+
+    if args.output:
+        report = {
+            'meta': {
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'reportlab': reportlab.Version,
+                'platform': platform.platform(),
+                'iterations': args.iterations,
+            },
+            'cases': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f'\nResults written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f).get('cases', {})
+        if _compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+def _time_renders(render, iterations):
+    # Per-invoice CPU time in milliseconds and the size of the PDF; the output file is reused and removed
+    path = render('benchmark')
+    samples = []
+    for _ in range(iterations):
+        started = time.process_time()
+        render('benchmark')
+        samples.append((time.process_time() - started) * 1000.0)
+    size = os.path.getsize(path)
+    os.remove(path)
+    return samples, size
+
+
+def bench_templates(args):
+    """Compare rendering with and without the pre-rendered static page templates."""
+    print(f"{'layout':<8} {'watermark':<10} {'templates':<10} {'median ms':>10} {'mean ms':>10} {'bytes':>8}")
+    for watermark in (True, False):
+        server.WATERMARK_FILE = '.webp' if watermark else '.no-watermark'
+        for name, render in (('pharma', _render_pharma), ('tan', _render_tan)):
+            for templates in (False, True):
+                server.PAGE_TEMPLATES = templates
+                samples, size = _time_renders(render, args.iterations)
+                print(f"{name:<8} {str(watermark):<10} {str(templates):<10} {statistics.median(samples):>10.2f} "
+                      f"{statistics.mean(samples):>10.2f} {size:>8}")
+
+
+# Run in a fresh interpreter: cold-start timings and the latency of the first request
+_STARTUP_SCRIPT = '''
+import json, time, server
+server.migrate()
+server.create_app()
+client = server.app.test_client()
+started = time.perf_counter()
+client.post('/', data=%r)
+first = (time.perf_counter() - started) * 1000.0
+started = time.perf_counter()
+client.post('/', data=%r)
+print(json.dumps(dict(server.startup, first_request_ms=first, second_request_ms=(time.perf_counter() - started) * 1000.0)))
+'''
+
+
+def bench_startup(args):
+    """Compare cold starts with and without preloading, each in a new process."""
+    form = _form(5)
+    script = _STARTUP_SCRIPT % (form, form)
+    print(f"{'preload':<8} {'import ms':>10} {'ready ms':>10} {'1st req ms':>11} {'2nd req ms':>11}")
+    for preload in ('0', '1'):
+        runs = []
+        for _ in range(args.iterations):
+            env = dict(os.environ, PRELOAD=preload)
+            output = subprocess.run([sys.executable, '-c', script], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        def median(key):
+            return statistics.median(run[key] for run in runs)
+        print(f"{preload == '1'!s:<8} {median('import_seconds') * 1000:>10.1f} {median('ready_seconds') * 1000:>10.1f} "
+              f"{median('first_request_ms'):>11.1f} {median('second_request_ms'):>11.1f}")
+
+
+def _print_run_invoices(count):
+    # Priced, numbered invoice dicts as the batch reader produces them
+    invoices = []
+    for i in range(count):
+        invoice = server._price_invoice(server._invoice_from_mapping(_form(i % 5 + 1)))
+        invoice['number'] = f'RUN-{i:05d}'
+        invoices.append(invoice)
+    return invoices
+
+
+def _render_separately(invoice):
+    return server.render_pdf_pharma(invoice['companyname'], invoice['companyaddress'], str(invoice['total_amount']),
+                                    str(invoice['stax']), invoice['email'], invoice['number'], canvas, invoice['date'],
+                                    str(invoice['finalstax']), invoice['products'], invoice['quantities'],
+                                    invoice['amount_paid'], invoice['change'], invoice['customername'], invoice['customerphone'])
+
+
+def bench_print_run(args):
+    """Compare a single print-run PDF with separately rendered invoices merged into one file."""
+    server.migrate()
+    server.catalog.warm()
+    invoices = _print_run_invoices(args.invoices)
+    _render_separately(invoices[0])  # warm templates and assets
+
+    started = time.perf_counter()
+    files = [_render_separately(invoice) for invoice in invoices]
+    render_s = time.perf_counter() - started
+    merged_size = merge_s = None
+    if pypdf is not None:
+        started = time.perf_counter()
+        writer = pypdf.PdfWriter()
+        for data in files:
+            writer.append(pypdf.PdfReader(io.BytesIO(data)))
+        out = io.BytesIO()
+        writer.write(out)
+        merge_s = time.perf_counter() - started
+        merged_size = out.tell()
+
+    started = time.perf_counter()
+    out = io.BytesIO()
+    pages = server.render_print_run(invoices, out)
+    print_run_s = time.perf_counter() - started
+
+    # End to end, as `batch --print-run` runs it: parse, number, draw, and (unless a draft) store, insert and email
+    upload = ''.join(json.dumps(_form(i % 5 + 1)) + '\n' for i in range(args.invoices)).encode('utf-8')
+    server.generate_print_run(io.BytesIO(upload[:upload.index(b'\n') + 1]), 'jsonl', io.BytesIO())  # start the render pool
+    end_to_end = {}
+    for store in (False, True):
+        started = time.perf_counter()
+        result = io.BytesIO()
+        stats = server.generate_print_run(io.BytesIO(upload), 'jsonl', result, store=store)
+        end_to_end[store] = (time.perf_counter() - started, result.tell(), stats['pages'])
+
+    print(f"{'method':<26} {'seconds':>9} {'bytes':>12} {'bytes/invoice':>14}")
+    print(f"{'separate files':<26} {render_s:>9.2f} {sum(map(len, files)):>12} {sum(map(len, files)) // len(files):>14}")
+    if merged_size is not None:
+        print(f"{'separate + merge':<26} {render_s + merge_s:>9.2f} {merged_size:>12} {merged_size // len(files):>14}")
+    else:
+        print('(install pypdf to time merging the separate files)')
+    print(f"{'print run (drawing only)':<26} {print_run_s:>9.2f} {out.tell():>12} {out.tell() // len(files):>14}  ({pages} pages)")
+    for store, label in ((False, 'batch --print-run --draft'), (True, 'batch --print-run')):
+        seconds, size, pages = end_to_end[store]
+        print(f"{label:<26} {seconds:>9.2f} {size:>12} {size // len(files):>14}  ({pages} pages)")
+
+
+def bench_profiles(args):
+    """PDF size and median render time per output profile (PDF_PROFILES)."""
+    server.migrate()
+    server.catalog.warm()
+    print(f"{'profile':<14} {'items':>6} {'bytes':>9} {'median ms':>10}")
+    for profile in server.PDF_PROFILES:
+        server.set_pdf_profile(profile)
+        for items in (1, 50):
+            products, quantities = _line_items(items)
+            samples = []
+            for _ in range(args.iterations + 1):
+                started = time.perf_counter()
+                data = _render_separately({'companyname': 'ACME Corp', 'companyaddress': 'Line 1\nLine 2', 'total_amount': 1.5,
+                                           'stax': 10, 'email': '', 'number': 'bench-profile', 'date': '01/01/2026',
+                                           'finalstax': 1.65, 'products': products, 'quantities': quantities,
+                                           'amount_paid': 5.0, 'change': 3.35, 'customername': 'Jane Doe',
+                                           'customerphone': '555-0100'})
+                samples.append((time.perf_counter() - started) * 1000.0)
+            # The first render of a profile loads its images and templates
+            print(f"{profile:<14} {items:>6} {len(data):>9} {statistics.median(samples[1:]):>10.2f}")
+    server.set_pdf_profile('standard')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Invoice rendering benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='render, pricing and request benchmarks')
+    run.add_argument('--iterations', type=int, default=50, help='samples per case (large invoices use fewer)')
+    run.add_argument('--filter', default='', help='only run cases whose name contains this text')
+    run.add_argument('--output', help='write the results to this JSON file')
+    run.add_argument('--baseline', help='compare with the results in this JSON file')
+    run.add_argument('--threshold', type=float, default=10.0,
+                     help='median slowdown in percent reported as a regression (exit status 1)')
+    templates = commands.add_parser('templates', help='static page templates on/off')
+    templates.add_argument('--iterations', type=int, default=100)
+    startup = commands.add_parser('startup', help='cold start with and without preloading')
+    startup.add_argument('--iterations', type=int, default=5, help='processes started per configuration')
+    print_run = commands.add_parser('print-run', help='print-run PDF against merged separate PDFs')
+    print_run.add_argument('--invoices', type=int, default=200)
+    profiles = commands.add_parser('profiles', help='size and render time per PDF output profile')
+    profiles.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.WARNING)
+    if args.command == 'run':
+        return bench_run(args)
+    if args.command == 'templates':
+        bench_templates(args)
+    if args.command == 'startup':
+        bench_startup(args)
+    if args.command == 'print-run':
+        bench_print_run(args)
+    if args.command == 'profiles':
+        bench_profiles(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
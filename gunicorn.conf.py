@@ -0,0 +1,49 @@
+"""Pre-fork production server configuration.
+
+    pip install gunicorn
+    gunicorn -c gunicorn.conf.py
+
+The application is imported and warmed up once in the master process
+(``preload_app``): ReportLab, pymysql, fonts, image assets, page templates and
+the product catalog are loaded before the workers are forked, so each worker
+starts warm and shares that memory copy-on-write. Settings can be overridden
+with the environment variables below or on the command line.
+"""
+import gc
+import os
+import time
+
+wsgi_app = 'server:create_app()'
+bind = os.getenv('BIND', '0.0.0.0:8080')
+workers = int(os.getenv('WEB_WORKERS', '0')) or (os.cpu_count() or 1)
+threads = int(os.getenv('WEB_THREADS', '2'))
+timeout = int(os.getenv('WEB_TIMEOUT', '60'))  # long invoices and exports can take a while
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', '0'))  # recycle workers after this many requests (0 = never)
+max_requests_jitter = max_requests // 10
+preload_app = True
+reload = False
+accesslog = os.getenv('ACCESS_LOG', '-')
+
+_forked = {}
+
+
+def when_ready(server):
+    # Move everything loaded so far into the permanent generation, so the garbage collector
+    # never writes to those pages in the workers and they stay shared
+    gc.freeze()
+    server.log.info('Preloaded application frozen (%d objects), forking %d worker(s)', gc.get_freeze_count(), workers)
+
+
+def pre_fork(server, worker):
+    _forked[worker.age] = time.perf_counter()
+
+
+def post_fork(server, worker):
+    # server.py resets its connection pool, write-behind writer and render queue in the child itself
+    started = _forked.pop(worker.age, None)
+    if started is not None:
+        server.log.info('Worker %s forked in %.1f ms', worker.pid, (time.perf_counter() - started) * 1000.0)
+    import server as app_module
+    if app_module.SMTP_HOST and app_module.EMAIL_WORKER:
+        # Each worker sends from the shared outbox; EMAIL_RATE applies per worker
+        app_module.get_email_sender()
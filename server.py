@@ -1,17 +1,48 @@
+import time
+_IMPORT_STARTED = time.perf_counter()  # start of the cold-start measurement reported by create_app()
 import os
 import sys
 import datetime
-import time
 import logging
 import webbrowser
 import threading
-from flask import Flask, render_template, request
+import collections
+import contextlib
+import sqlite3
+import queue
+import json
+import atexit
+import uuid
+import concurrent.futures
+import multiprocessing
+import csv
+import io
+import zipfile
+import argparse
+import tempfile
+import shutil
+import copy
+import hashlib
+import decimal
+import base64
+import itertools
+import bisect
+import smtplib
+from email.message import EmailMessage
+from email.utils import formatdate, parseaddr
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, send_file, g, has_request_context
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.lib import colors
 from reportlab.lib.units import inch
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfdoc
 import textwrap
 import pymysql
+try:
+    import fcntl
+except ImportError:  # Windows: manifest rewrites are not locked against other processes
+    fcntl = None
 
 
 app = Flask(__name__)
@@ -23,8 +54,79 @@ DB_USER = os.getenv('DB_USER', 'root')
 DB_PASSWORD = os.getenv('DB_PASSWORD', '')
 DB_NAME = os.getenv('DB_NAME', 'invoice_db')
 DB_TABLE = os.getenv('DB_TABLE', 'invoices')
+# 'mysql' (default) or 'sqlite' - a local stand-in useful for development and tests
+DB_BACKEND = os.getenv('DB_BACKEND', 'mysql')
+DB_SQLITE_PATH = os.getenv('DB_SQLITE_PATH', os.path.join(APP_ROOT, 'invoice_db.sqlite3'))
+
+# Connection pool configuration
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))  # seconds to wait when the pool is exhausted
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '3600'))  # recycle connections older than this
+DB_POOL_PING_IDLE = float(os.getenv('DB_POOL_PING_IDLE', '30'))  # ping connections idle longer than this (0 = always)
+
+# Write-behind mode: queue invoice rows and insert them in batches from a background thread
+DB_WRITE_BEHIND = os.getenv('DB_WRITE_BEHIND', '0') == '1'
+DB_WRITE_QUEUE_SIZE = int(os.getenv('DB_WRITE_QUEUE_SIZE', '10000'))
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '500'))
+DB_WRITE_MAX_LATENCY = float(os.getenv('DB_WRITE_MAX_LATENCY', '0.5'))  # seconds a row may wait before a flush
+DB_WRITE_ENQUEUE_TIMEOUT = float(os.getenv('DB_WRITE_ENQUEUE_TIMEOUT', '2'))  # block this long when the queue is full
+DB_WRITE_SPILL_PATH = os.getenv('DB_WRITE_SPILL_PATH', '')  # optional JSON-lines file used when the queue is full
+DB_WRITE_DEAD_LETTER_PATH = os.getenv('DB_WRITE_DEAD_LETTER_PATH', '')  # optional JSON-lines file for rows the database rejects
+
+# Where rendered invoices go: 'sharded' (INVOICE_DIR/<yyyy>/<mm>/<shard>/ with a manifest index),
+# 'local' (flat INVOICE_DIR/Invoice (<number>).pdf), 'content' (content-addressed objects under
+# INVOICE_DIR) or 'direct' (nothing is written; POST / returns the PDF in the response)
+INVOICE_STORAGE = os.getenv('INVOICE_STORAGE', 'sharded')
+INVOICE_DIR = os.getenv('INVOICE_DIR', os.path.join(APP_ROOT, 'INVOICE'))
+# Cold storage: `server.py archive --days N` packs older invoices into monthly ZIP bundles here
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', os.path.join(INVOICE_DIR, 'archive'))
+
+# PDF rendering: 'sync' renders inside the request, 'async' hands invoices to a process pool
+RENDER_MODE = os.getenv('RENDER_MODE', 'sync')
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', '0')) or os.cpu_count() or 1
+RENDER_MAX_JOBS = int(os.getenv('RENDER_MAX_JOBS', '10000'))  # finished jobs remembered for GET /jobs/<id>
+
+# Instrumentation: per-stage latency histograms and counters served at /metrics (per process)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+SERVER_TIMING = os.getenv('SERVER_TIMING', '0') == '1'  # add a Server-Timing header with the stage timings
+
+# Invoice numbers are reserved from the database in blocks and formatted with INVOICE_NUMBER_FORMAT
+INVOICE_NUMBER_BLOCK = int(os.getenv('INVOICE_NUMBER_BLOCK', '100'))
+INVOICE_NUMBER_FORMAT = os.getenv('INVOICE_NUMBER_FORMAT', 'INV-{:08d}')
 
-# Product prices dictionary
+# Duplicate submissions: results are remembered per Idempotency-Key header for IDEMPOTENCY_TTL seconds;
+# requests without a key are deduplicated by their content for IDEMPOTENCY_WINDOW seconds (default 0 = off)
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_WINDOW = float(os.getenv('IDEMPOTENCY_WINDOW', '0'))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', '10000'))
+IDEMPOTENCY_MAX_BYTES = int(os.getenv('IDEMPOTENCY_MAX_BYTES', str(64 * 1024 * 1024)))  # PDFs kept for 'direct' storage
+
+# Product catalog: prices live in the products table and are cached per process
+DB_PRODUCTS_TABLE = os.getenv('DB_PRODUCTS_TABLE', 'products')
+CATALOG_TTL = float(os.getenv('CATALOG_TTL', '300'))  # seconds a cached price is trusted
+CATALOG_WARM = os.getenv('CATALOG_WARM', '1') == '1'  # load the whole catalog at startup
+
+# Outgoing email: invoices with a customer address are mailed with the PDF attached, through a
+# persistent outbox table and a background sender. Leaving SMTP_HOST empty turns email off.
+SMTP_HOST = os.getenv('SMTP_HOST', '')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+SMTP_USER = os.getenv('SMTP_USER', '')
+SMTP_PASSWORD = os.getenv('SMTP_PASSWORD', '')
+SMTP_SECURITY = os.getenv('SMTP_SECURITY', 'starttls')  # 'starttls', 'ssl' or 'none' (e.g. a local test server)
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', '30'))
+EMAIL_FROM = os.getenv('EMAIL_FROM', SMTP_USER or 'invoices@localhost')
+EMAIL_RATE = float(os.getenv('EMAIL_RATE', '5'))  # messages per second per sending process (0 = unlimited)
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', '8'))
+EMAIL_RETRY_DELAY = float(os.getenv('EMAIL_RETRY_DELAY', '30'))  # first retry delay in seconds, doubled per attempt (max 1h)
+EMAIL_IDLE_CLOSE = float(os.getenv('EMAIL_IDLE_CLOSE', '60'))  # close an SMTP connection unused for this long
+EMAIL_MESSAGES_PER_CONNECTION = int(os.getenv('EMAIL_MESSAGES_PER_CONNECTION', '100'))  # then reconnect
+EMAIL_WORKER = os.getenv('EMAIL_WORKER', '1') == '1'  # send from a thread in the web process ('0': use `server.py send-mail`)
+
+# Production serving (create_app / gunicorn.conf.py): warm assets, templates, fonts and the catalog before forking
+PRELOAD = os.getenv('PRELOAD', '1') == '1'
+
+# Product prices dictionary (seeds the products table and is the fallback while the database is unreachable)
 PRODUCT_PRICES = {
     'Pens': 0.10,
     'Counterbook': 1.05,
@@ -37,6 +139,757 @@ PRODUCT_PRICES = {
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
 
+class Metrics:
+    """Process-local counters and latency histograms, exported in Prometheus text format.
+
+    Every method returns immediately when ``enabled`` is false. Stages are
+    timed with ``started = metrics.clock()`` ... ``metrics.record(stage, started)``;
+    ``clock()`` returns None when disabled, so nothing is measured at all.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, enabled=True, buckets=BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def clock(self):
+        return time.perf_counter() if self.enabled else None
+
+    def record(self, stage, started):
+        # Observe the time since ``started`` for one stage of invoice handling
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        self.observe('invoice_stage_seconds', elapsed, stage=stage)
+        if SERVER_TIMING and has_request_context():
+            g.setdefault('server_timing', []).append((stage, elapsed))
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self._histograms.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{_prometheus_labels(labels)} {value}')
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_prometheus_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_prometheus_labels(labels)} {total}')
+            lines.append(f'{name}_count{_prometheus_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+metrics = Metrics(METRICS_ENABLED)
+
+
+class PoolTimeout(Exception):
+    """Raised when no database connection becomes available within the pool timeout."""
+
+
+class ConnectionPool:
+    """Thread-safe pool of reusable DB-API connections.
+
+    Connections are created by the ``connect`` callable, so the pool works the
+    same against MySQL or a local stand-in. Idle connections are handed out
+    most-recently-used first, pinged when they have been idle for a while and
+    recycled once they are older than ``max_lifetime``.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=5.0, max_lifetime=3600.0, ping_idle=30.0):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError('invalid pool size: min=%r max=%r' % (min_size, max_size))
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_idle = ping_idle
+        self._cond = threading.Condition()
+        self._idle = collections.deque()  # (connection, created_at, last_used_at)
+        self._created_at = {}  # id(connection) -> created_at, for checked out connections
+        self._size = 0  # idle + checked out + being opened
+        self._closed = False
+        self._stats = collections.Counter()
+
+    def fill(self):
+        """Open connections until ``min_size`` are available."""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                self._discard_slot()
+                raise
+            now = time.monotonic()
+            with self._cond:
+                self._stats['created'] += 1
+                self._idle.append((conn, now, now))
+                self._cond.notify()
+
+    def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout('connection pool is closed')
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    entry = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout('no database connection available after %.1fs (max_size=%d)' % (timeout, self.max_size))
+                self._stats['waits'] += 1
+                self._cond.wait(remaining)
+        try:
+            conn, created_at = self._checkout(entry)
+        except Exception:
+            self._discard_slot()
+            raise
+        with self._cond:
+            self._created_at[id(conn)] = created_at
+            self._stats['acquired'] += 1
+            self._stats['wait_seconds'] += time.monotonic() - started
+        return conn
+
+    def _checkout(self, entry):
+        now = time.monotonic()
+        if entry is not None:
+            conn, created_at, last_used = entry
+            if now - created_at > self.max_lifetime:
+                self._count('recycled')
+                self._close_quietly(conn)
+            elif now - last_used >= self.ping_idle and not self._ping(conn):
+                self._count('ping_failures')
+                self._close_quietly(conn)
+            else:
+                return conn, created_at
+        conn = self._connect()
+        self._count('created')
+        return conn, now
+
+    def release(self, conn, discard=False):
+        """Return a connection to the pool.
+
+        Whatever transaction it still has open is rolled back first: with
+        autocommit off, even a read leaves a REPEATABLE READ snapshot behind
+        that the next borrower would otherwise keep reading from.
+        """
+        with self._cond:
+            created_at = self._created_at.pop(id(conn), None)
+        if created_at is None:
+            raise ValueError('connection does not belong to this pool')
+        now = time.monotonic()
+        if not (discard or self._closed or now - created_at > self.max_lifetime):
+            try:
+                conn.rollback()
+            except Exception:
+                self._count('reset_failures')
+                discard = True
+        if discard or self._closed or now - created_at > self.max_lifetime:
+            self._close_quietly(conn)
+            self._discard_slot()
+            return
+        with self._cond:
+            self._idle.append((conn, created_at, now))
+            self._stats['released'] += 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """Check out a connection for the duration of a ``with`` block.
+
+        Work that was not committed, including the read snapshot of a block
+        that only queried, is rolled back when the connection is released; a
+        connection that cannot even be rolled back is discarded instead of
+        returned to the pool.
+        """
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._cond:
+            in_use = len(self._created_at)
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': in_use,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'created': self._stats['created'],
+                'closed': self._stats['closed'],
+                'acquired': self._stats['acquired'],
+                'released': self._stats['released'],
+                'waits': self._stats['waits'],
+                'timeouts': self._stats['timeouts'],
+                'recycled': self._stats['recycled'],
+                'ping_failures': self._stats['ping_failures'],
+                'reset_failures': self._stats['reset_failures'],
+                'avg_wait_ms': round(1000.0 * self._stats['wait_seconds'] / max(self._stats['acquired'], 1), 3),
+            }
+
+    def _ping(self, conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def _discard_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _count(self, key):
+        # Counters are updated from any thread; Counter += is not atomic
+        with self._cond:
+            self._stats[key] += 1
+
+    def _close_quietly(self, conn):
+        self._count('closed')
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class _SQLiteCursor:
+    # Minimal pymysql-compatible cursor over sqlite3 (``%s`` placeholders, dict rows)
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, args=None):
+        self._cursor.execute(sql.replace('%s', '?'), tuple(args or ()))
+        return self._cursor.rowcount
+
+    def executemany(self, sql, seq_of_args):
+        self._cursor.executemany(sql.replace('%s', '?'), [tuple(a) for a in seq_of_args])
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size or self._cursor.arraysize)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    def close(self):
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _SQLiteConnection:
+    # Local stand-in for a pymysql connection, used when DB_BACKEND=sqlite
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=DB_POOL_TIMEOUT, check_same_thread=False)
+        self._conn.row_factory = lambda cur, row: {d[0]: v for d, v in zip(cur.description, row)}
+
+    def cursor(self, cursorclass=None):
+        return _SQLiteCursor(self._conn.cursor())
+
+    def ping(self, reconnect=False):
+        self._conn.execute('SELECT 1')
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+
+def _db_connect():
+    if DB_BACKEND == 'sqlite':
+        return _SQLiteConnection(DB_SQLITE_PATH)
+    return pymysql.connect(host=DB_HOST,
+                           user=DB_USER,
+                           password=DB_PASSWORD,
+                           db=DB_NAME,
+                           charset='utf8mb4',
+                           cursorclass=pymysql.cursors.DictCursor)
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    """Return the process-wide connection pool, creating it on first use."""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                pool = ConnectionPool(_db_connect, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX,
+                                      timeout=DB_POOL_TIMEOUT, max_lifetime=DB_POOL_MAX_LIFETIME,
+                                      ping_idle=DB_POOL_PING_IDLE)
+                try:
+                    pool.fill()
+                except Exception:
+                    logging.warning('Could not pre-open %d database connection(s)', DB_POOL_MIN)
+                _db_pool = pool
+    return _db_pool
+
+
+def _migrate_invoices_table(cursor):
+    if DB_BACKEND == 'sqlite':
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS `{DB_TABLE}` (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                       "`Company_Name` TEXT, `Company_Address` TEXT, `Email_ID` TEXT, `Amount` REAL, "
+                       "`Final_Amount` REAL, `Product` TEXT, `Amount_Paid` REAL, `Change` REAL)")
+    else:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS `{DB_TABLE}` (id INT AUTO_INCREMENT PRIMARY KEY, "
+                       "`Company_Name` VARCHAR(255), `Company_Address` TEXT, `Email_ID` VARCHAR(255), "
+                       "`Amount` DECIMAL(10,2), `Final_Amount` DECIMAL(10,2), `Product` TEXT, "
+                       "`Amount_Paid` DECIMAL(10,2), `Change` DECIMAL(10,2))")
+
+
+def _migrate_products_table(cursor):
+    if DB_BACKEND == 'sqlite':
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS `{DB_PRODUCTS_TABLE}` (`name` TEXT PRIMARY KEY, "
+                       "`price` REAL NOT NULL, `updated_at` TEXT DEFAULT CURRENT_TIMESTAMP)")
+        insert = f"INSERT OR IGNORE INTO `{DB_PRODUCTS_TABLE}` (`name`, `price`) VALUES (%s, %s)"
+    else:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS `{DB_PRODUCTS_TABLE}` (`name` VARCHAR(255) PRIMARY KEY, "
+                       "`price` DECIMAL(10,2) NOT NULL, "
+                       "`updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP)")
+        insert = f"INSERT IGNORE INTO `{DB_PRODUCTS_TABLE}` (`name`, `price`) VALUES (%s, %s)"
+    # Seed with the built-in price list
+    cursor.executemany(insert, sorted(PRODUCT_PRICES.items()))
+
+
+def _migrate_invoice_numbers(cursor):
+    if DB_BACKEND == 'sqlite':
+        cursor.execute("CREATE TABLE IF NOT EXISTS `invoice_sequences` (`name` TEXT PRIMARY KEY, `next_value` INTEGER NOT NULL)")
+        cursor.execute("INSERT OR IGNORE INTO `invoice_sequences` (`name`, `next_value`) VALUES ('invoice', 1)")
+        cursor.execute(f"ALTER TABLE `{DB_TABLE}` ADD COLUMN `Invoice_Number` TEXT")
+        cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS `idx_{DB_TABLE}_number` ON `{DB_TABLE}` (`Invoice_Number`)")
+    else:
+        cursor.execute("CREATE TABLE IF NOT EXISTS `invoice_sequences` "
+                       "(`name` VARCHAR(64) PRIMARY KEY, `next_value` BIGINT NOT NULL)")
+        cursor.execute("INSERT IGNORE INTO `invoice_sequences` (`name`, `next_value`) VALUES ('invoice', 1)")
+        cursor.execute(f"ALTER TABLE `{DB_TABLE}` ADD COLUMN `Invoice_Number` VARCHAR(64) NULL, "
+                       f"ADD UNIQUE KEY `idx_{DB_TABLE}_number` (`Invoice_Number`)")
+
+
+def _migrate_invoice_items(cursor):
+    # One row per line item; (product, invoice_id) serves per-product reports without touching invoices
+    if DB_BACKEND == 'sqlite':
+        cursor.execute("CREATE TABLE IF NOT EXISTS `invoice_items` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, "
+                       "`invoice_id` INTEGER NOT NULL, `line_no` INTEGER NOT NULL, `product` TEXT NOT NULL, "
+                       "`quantity` INTEGER, `unit_price` REAL, `line_total` REAL)")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS `idx_invoice_items_line` ON `invoice_items` (`invoice_id`, `line_no`)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS `idx_invoice_items_product` ON `invoice_items` (`product`, `invoice_id`)")
+    else:
+        cursor.execute("CREATE TABLE IF NOT EXISTS `invoice_items` (`id` BIGINT AUTO_INCREMENT PRIMARY KEY, "
+                       "`invoice_id` INT NOT NULL, `line_no` INT NOT NULL, `product` VARCHAR(255) NOT NULL, "
+                       "`quantity` INT NULL, `unit_price` DECIMAL(10,2) NULL, `line_total` DECIMAL(12,2) NULL, "
+                       "UNIQUE KEY `idx_invoice_items_line` (`invoice_id`, `line_no`), "
+                       "KEY `idx_invoice_items_product` (`product`, `invoice_id`))")
+
+
+def _migrate_invoice_search(cursor):
+    # Creation time plus the secondary indexes used by GET /invoices (each ends in id for keyset pagination)
+    if DB_BACKEND == 'sqlite':
+        cursor.execute(f"ALTER TABLE `{DB_TABLE}` ADD COLUMN `Created_At` TEXT")
+        cursor.execute(f"UPDATE `{DB_TABLE}` SET `Created_At` = datetime('now', 'localtime') WHERE `Created_At` IS NULL")
+        for name, columns in INVOICE_INDEXES:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS `idx_{DB_TABLE}_{name}` ON `{DB_TABLE}` ({columns})")
+    else:
+        cursor.execute(f"ALTER TABLE `{DB_TABLE}` ADD COLUMN `Created_At` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+                       + ', '.join(f"ADD KEY `idx_{DB_TABLE}_{name}` ({columns})" for name, columns in INVOICE_INDEXES))
+
+
+def _migrate_revenue_rollups(cursor):
+    # Per-company daily and monthly totals, kept up to date by _insert_invoice_records
+    if DB_BACKEND == 'sqlite':
+        cursor.execute("CREATE TABLE IF NOT EXISTS `revenue_rollups` (`period` TEXT NOT NULL, `bucket` TEXT NOT NULL, "
+                       "`company` TEXT NOT NULL, `invoices` INTEGER NOT NULL DEFAULT 0, `revenue` REAL NOT NULL DEFAULT 0, "
+                       "`tax` REAL NOT NULL DEFAULT 0, `total` REAL NOT NULL DEFAULT 0, `amount_paid` REAL NOT NULL DEFAULT 0, "
+                       "`change` REAL NOT NULL DEFAULT 0, PRIMARY KEY (`period`, `bucket`, `company`))")
+    else:
+        cursor.execute("CREATE TABLE IF NOT EXISTS `revenue_rollups` (`period` VARCHAR(5) NOT NULL, "
+                       "`bucket` VARCHAR(10) NOT NULL, `company` VARCHAR(255) NOT NULL, `invoices` INT NOT NULL DEFAULT 0, "
+                       "`revenue` DECIMAL(14,2) NOT NULL DEFAULT 0, `tax` DECIMAL(14,2) NOT NULL DEFAULT 0, "
+                       "`total` DECIMAL(14,2) NOT NULL DEFAULT 0, `amount_paid` DECIMAL(14,2) NOT NULL DEFAULT 0, "
+                       "`change` DECIMAL(14,2) NOT NULL DEFAULT 0, PRIMARY KEY (`period`, `bucket`, `company`))")
+    _rebuild_revenue_rollups(cursor)
+
+
+def _migrate_email_outbox(cursor):
+    # Queued invoice emails; next_attempt_at is a Unix time, also used as the lease of a message being sent
+    if DB_BACKEND == 'sqlite':
+        cursor.execute("CREATE TABLE IF NOT EXISTS `email_outbox` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, "
+                       "`invoice_number` TEXT NOT NULL, `recipient` TEXT NOT NULL, `status` TEXT NOT NULL DEFAULT 'pending', "
+                       "`attempts` INTEGER NOT NULL DEFAULT 0, `next_attempt_at` REAL NOT NULL, `claim` TEXT NULL, "
+                       "`last_error` TEXT NULL, `created_at` TEXT NOT NULL, `sent_at` TEXT NULL)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS `idx_email_outbox_due` ON `email_outbox` (`status`, `next_attempt_at`)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS `idx_email_outbox_claim` ON `email_outbox` (`claim`)")
+    else:
+        cursor.execute("CREATE TABLE IF NOT EXISTS `email_outbox` (`id` BIGINT AUTO_INCREMENT PRIMARY KEY, "
+                       "`invoice_number` VARCHAR(64) NOT NULL, `recipient` VARCHAR(255) NOT NULL, "
+                       "`status` VARCHAR(16) NOT NULL DEFAULT 'pending', `attempts` INT NOT NULL DEFAULT 0, "
+                       "`next_attempt_at` DOUBLE NOT NULL, `claim` VARCHAR(32) NULL, `last_error` TEXT NULL, "
+                       "`created_at` DATETIME NOT NULL, `sent_at` DATETIME NULL, "
+                       "KEY `idx_email_outbox_due` (`status`, `next_attempt_at`), KEY `idx_email_outbox_claim` (`claim`))")
+
+
+# Secondary indexes on the invoices table: (name, columns)
+INVOICE_INDEXES = (
+    ('created', '`Created_At`, `id`'),
+    ('company', '`Company_Name`, `Created_At`, `id`'),
+    ('email', '`Email_ID`, `Created_At`, `id`'),
+    ('total', '`Final_Amount`'),
+)
+
+
+# Schema changes in the order they are applied by `python server.py migrate`
+MIGRATIONS = [
+    ('0001_invoices', _migrate_invoices_table),
+    ('0002_products', _migrate_products_table),
+    ('0003_invoice_numbers', _migrate_invoice_numbers),
+    ('0004_invoice_items', _migrate_invoice_items),
+    ('0005_invoice_search', _migrate_invoice_search),
+    ('0006_revenue_rollups', _migrate_revenue_rollups),
+    ('0007_email_outbox', _migrate_email_outbox),
+]
+
+
+def migrate():
+    """Apply pending schema migrations in order; returns the ids that were applied."""
+    applied = []
+    with get_db_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS `schema_migrations` "
+                           "(`id` VARCHAR(64) PRIMARY KEY, `applied_at` VARCHAR(32))")
+            cursor.execute("SELECT `id` FROM `schema_migrations`")
+            done = {row['id'] for row in cursor.fetchall()}
+            for migration_id, apply in MIGRATIONS:
+                if migration_id in done:
+                    continue
+                apply(cursor)
+                cursor.execute("INSERT INTO `schema_migrations` (`id`, `applied_at`) VALUES (%s, %s)",
+                               (migration_id, datetime.datetime.now().isoformat(timespec='seconds')))
+                connection.commit()
+                applied.append(migration_id)
+                logging.info('Applied migration %s', migration_id)
+    return applied
+
+
+class UnknownProduct(ValueError):
+    """Raised when an invoice names a product that is not in the catalog."""
+
+
+def _load_product_prices(names=None):
+    # {name: price} for the given product names, or for the whole catalog when names is None
+    with get_db_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            if names is None:
+                cursor.execute(f"SELECT `name`, `price` FROM `{DB_PRODUCTS_TABLE}`")
+                rows = cursor.fetchall()
+            else:
+                rows = []
+                names = list(names)
+                for i in range(0, len(names), 500):
+                    chunk = names[i:i + 500]
+                    cursor.execute(f"SELECT `name`, `price` FROM `{DB_PRODUCTS_TABLE}` "
+                                   f"WHERE `name` IN ({', '.join(['%s'] * len(chunk))})", chunk)
+                    rows.extend(cursor.fetchall())
+    return {row['name']: float(row['price']) for row in rows}
+
+
+def _save_product_prices(prices):
+    # Insert or update {name: price} in the products table
+    if DB_BACKEND == 'sqlite':
+        sql = (f"INSERT INTO `{DB_PRODUCTS_TABLE}` (`name`, `price`) VALUES (%s, %s) "
+               "ON CONFLICT(`name`) DO UPDATE SET `price` = excluded.`price`, `updated_at` = CURRENT_TIMESTAMP")
+    else:
+        sql = (f"INSERT INTO `{DB_PRODUCTS_TABLE}` (`name`, `price`) VALUES (%s, %s) "
+               "ON DUPLICATE KEY UPDATE `price` = VALUES(`price`)")
+    with get_db_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, list(prices.items()))
+        connection.commit()
+
+
+class ProductCatalog:
+    """In-process cache of product prices in front of the products table.
+
+    Prices are looked up in bulk (one query for all the misses of an invoice),
+    unknown names are cached too, and every entry expires after ``ttl``
+    seconds. ``invalidate()`` bumps the cache version, which retires every
+    entry at once. While the database is unreachable the ``fallback`` prices
+    are served for a short while instead of retrying on every lookup.
+    """
+
+    RETRY_SECONDS = 30.0
+
+    def __init__(self, load, ttl=300.0, fallback=None):
+        self._load = load
+        self.ttl = ttl
+        self._fallback = dict(fallback or {})
+        self._lock = threading.Lock()
+        self._entries = {}  # name -> (price or None, expires_at, version)
+        self._version = 0
+        self._stats = {'hits': 0, 'misses': 0, 'loads': 0, 'load_errors': 0, 'invalidations': 0}
+
+    def prices(self, names):
+        """Return {name: price or None} for ``names``, loading the misses with one query."""
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self._lock:
+            version = self._version
+            for name in names:
+                if name in found:
+                    continue
+                entry = self._entries.get(name)
+                if entry is not None and entry[1] > now and entry[2] == version:
+                    found[name] = entry[0]
+                else:
+                    found[name] = None
+                    missing.append(name)
+            hits = len(found) - len(missing)
+            self._stats['hits'] += hits
+            self._stats['misses'] += len(missing)
+        metrics.inc('invoice_catalog_lookups_total', hits, result='hit')
+        if missing:
+            metrics.inc('invoice_catalog_lookups_total', len(missing), result='miss')
+            found.update(self._fetch(missing, version))
+        return found
+
+    def price(self, name):
+        return self.prices((name,))[name]
+
+    def _fetch(self, names, version):
+        expires = time.monotonic() + self.ttl
+        try:
+            loaded = self._load(names)
+            with self._lock:
+                self._stats['loads'] += 1
+        except Exception as e:
+            logging.warning('Product catalog lookup failed, using built-in prices: %s', e)
+            loaded = {name: self._fallback[name] for name in names if name in self._fallback}
+            expires = time.monotonic() + min(self.ttl, self.RETRY_SECONDS)
+            with self._lock:
+                self._stats['load_errors'] += 1
+        result = {name: loaded.get(name) for name in names}
+        with self._lock:
+            if version == self._version:
+                for name, price in result.items():
+                    self._entries[name] = (price, expires, version)
+        return result
+
+    def prime(self, prices):
+        # Cache prices that are already known (e.g. computed by the parent of a render worker)
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for name, price in prices.items():
+                self._entries[name] = (price, expires, self._version)
+
+    def warm(self):
+        """Load the whole catalog in one query; returns the number of products cached."""
+        loaded = self._load(None)
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._stats['loads'] += 1
+            self._entries = {name: (price, expires, self._version) for name, price in loaded.items()}
+        logging.info('Product catalog warmed with %d product(s)', len(loaded))
+        return len(loaded)
+
+    def invalidate(self, names=None):
+        """Forget cached prices for ``names``, or for every product when names is None."""
+        with self._lock:
+            self._stats['invalidations'] += 1
+            if names is None:
+                self._version += 1
+                self._entries = {}
+            else:
+                for name in names:
+                    self._entries.pop(name, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, cached=len(self._entries), version=self._version, ttl=self.ttl)
+
+
+catalog = ProductCatalog(lambda names: _load_product_prices(names), ttl=CATALOG_TTL, fallback=PRODUCT_PRICES)
+
+
+def _reserve_invoice_numbers(count, sequence='invoice'):
+    """Reserve ``count`` consecutive sequence values with one update; returns (first, last + 1)."""
+    with get_db_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            if DB_BACKEND == 'sqlite':
+                # The UPDATE holds SQLite's write lock until commit, so the SELECT sees our own reservation
+                updated = cursor.execute("UPDATE `invoice_sequences` SET `next_value` = `next_value` + %s "
+                                         "WHERE `name` = %s", (count, sequence))
+                cursor.execute("SELECT `next_value` FROM `invoice_sequences` WHERE `name` = %s", (sequence,))
+            else:
+                # LAST_INSERT_ID(expr) is per connection, so concurrent reservations cannot see each other's value
+                updated = cursor.execute("UPDATE `invoice_sequences` SET `next_value` = LAST_INSERT_ID(`next_value` + %s) "
+                                         "WHERE `name` = %s", (count, sequence))
+                cursor.execute("SELECT LAST_INSERT_ID() AS `next_value`")
+            row = cursor.fetchone()
+        if not updated or row is None:
+            connection.rollback()
+            raise RuntimeError(f'invoice sequence {sequence!r} not found; run `python server.py migrate`')
+        connection.commit()
+    end = int(row['next_value'])
+    return end - count, end
+
+
+class InvoiceNumberAllocator:
+    """Hands out invoice numbers from blocks reserved in the database.
+
+    One database round-trip reserves ``block_size`` numbers; threads then take
+    numbers from the block under a lock. Every process reserves its own
+    blocks, so numbers are unique across processes and increasing within one,
+    but not gapless: numbers left in a block when a process exits, and numbers
+    of invoices that fail after allocation, are never used. After a failed
+    reservation further attempts are skipped for ``retry_after`` seconds.
+    """
+
+    def __init__(self, reserve, block_size=100, fmt='INV-{:08d}', retry_after=5.0):
+        self._reserve = reserve
+        self.block_size = max(1, block_size)
+        self.format = fmt
+        self.retry_after = retry_after
+        self.reset()
+
+    def reset(self):
+        # Forget the current block; also run in forked children so they never reuse the parent's numbers
+        self._lock = threading.Lock()
+        self._next = self._end = 0
+        self._retry_at = 0.0
+        self._stats = {'allocated': 0, 'blocks': 0, 'failures': 0}
+
+    def allocate(self):
+        with self._lock:
+            if self._next >= self._end:
+                if time.monotonic() < self._retry_at:
+                    raise RuntimeError('invoice number reservation failed recently')
+                try:
+                    self._next, self._end = self._reserve(self.block_size)
+                except Exception:
+                    self._stats['failures'] += 1
+                    self._retry_at = time.monotonic() + self.retry_after
+                    raise
+                self._stats['blocks'] += 1
+            value = self._next
+            self._next += 1
+            self._stats['allocated'] += 1
+        return self.format.format(value)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, remaining=self._end - self._next, block_size=self.block_size)
+
+
+invoice_numbers = InvoiceNumberAllocator(_reserve_invoice_numbers, INVOICE_NUMBER_BLOCK, INVOICE_NUMBER_FORMAT)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=invoice_numbers.reset)
+
+
+def allocate_invoice_number():
+    """Return the next invoice number, or a unique temporary one while the database is unreachable."""
+    try:
+        return invoice_numbers.allocate()
+    except Exception as e:
+        metrics.inc('invoice_number_fallbacks_total')
+        logging.warning('Could not reserve invoice numbers, using a temporary number: %s', e)
+        return f"TMP-{datetime.datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+
 
 
 @app.route("/")
@@ -50,19 +903,268 @@ def main():
                 "<p>Template not found. Use the form endpoint POST / to submit invoice data.</p></body></html>")
 
 
+@app.before_request
+def _start_request_timer():
+    g.metrics_started = metrics.clock()
 
-# createpdf function to create a Invoice PDF
-def create_pdf(companynamepdf, companyaddresspdf, amountpdf, staxpdf, emailpdf, timestamppdf, canvas_module, datepdf, finalstaxpdf, productpdf):
-    # Save invoice into a project-local INVOICE folder so it's cross-platform
-    invoice_dir = os.path.join(APP_ROOT, 'INVOICE')
-    os.makedirs(invoice_dir, exist_ok=True)
-    filename = f"Invoice ({timestamppdf}).pdf"
-    path = os.path.join(invoice_dir, filename)
-    # Create a styled invoice with background, logo, item table and footer
-    c = canvas_module.Canvas(path, pagesize=letter)
+
+@app.after_request
+def _finish_request_metrics(response):
+    started = g.get('metrics_started')
+    if started is not None and request.endpoint != 'metrics_endpoint':
+        endpoint = request.endpoint or 'unknown'
+        elapsed = time.perf_counter() - started
+        metrics.inc('invoice_http_requests_total', endpoint=endpoint, status=response.status_code)
+        metrics.observe('invoice_http_request_seconds', elapsed, endpoint=endpoint)
+        if response.status_code >= 500:
+            metrics.inc('invoice_failures_total', endpoint=endpoint)
+        if SERVER_TIMING:
+            timings = g.get('server_timing', [])
+            response.headers['Server-Timing'] = ', '.join(
+                [f'{stage};dur={seconds * 1000.0:.2f}' for stage, seconds in timings] + [f'total;dur={elapsed * 1000.0:.2f}'])
+    return response
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    # Prometheus scrape target
+    if not metrics.enabled:
+        return Response('metrics are disabled (METRICS_ENABLED=0)\n', status=404, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route("/db/pool")
+def db_pool_stats():
+    # Connection pool statistics, useful for sizing DB_POOL_MIN / DB_POOL_MAX
+    return jsonify(get_db_pool().stats())
+
+
+@app.route("/assets/reload", methods=["POST"])
+def reload_assets():
+    # Drop cached logo/watermark images (and the page templates built from them)
+    assets.clear()
+    return jsonify(assets.stats())
+
+
+@app.route("/db/writer")
+def db_writer_stats():
+    # Write-behind queue statistics (only meaningful when DB_WRITE_BEHIND=1)
+    if not DB_WRITE_BEHIND:
+        return jsonify({'enabled': False})
+    return jsonify(dict(get_invoice_writer().stats(), enabled=True))
+
+
+@app.route("/invoices/numbers")
+def invoice_number_stats():
+    return jsonify(invoice_numbers.stats())
+
+
+@app.route("/idempotency")
+def idempotency_stats():
+    return jsonify(idempotency.stats())
+
+
+@app.route("/email/outbox")
+def email_outbox_stats():
+    # Outbox depth per status, plus this process' sender statistics (throughput, SMTP connection reuse)
+    if not SMTP_HOST:
+        return jsonify({'enabled': False})
+    sender = _email_sender.stats() if _email_sender is not None else None
+    return jsonify({'enabled': True, 'outbox': email_outbox_depth(), 'sender': sender})
+
+
+@app.route("/products/cache")
+def product_cache_stats():
+    return jsonify(catalog.stats())
+
+
+@app.route("/products/reload", methods=["POST"])
+def reload_products():
+    # Drop cached prices after editing the products table; other processes pick changes up within CATALOG_TTL
+    catalog.invalidate()
+    return jsonify(catalog.stats())
+
+
+
+# Invariant page furniture is rendered once per process and stamped into every invoice as a form XObject
+PAGE_TEMPLATES = os.getenv('PAGE_TEMPLATES', '1') == '1'
+
+# Image assets looked up in the project root
+LOGO_FILES = ('logo.png', 'logo.jpg')
+WATERMARK_FILE = '.webp'
+
+# Seconds between filesystem checks for changed image assets (0 = check on every use)
+ASSET_REVALIDATE_SECONDS = float(os.getenv('ASSET_REVALIDATE_SECONDS', '2'))
+
+# PDF output profiles. All of them draw with the standard PDF fonts only (Helvetica, ZapfDingbats),
+# which viewers supply themselves, so fonts are never embedded.
+#   compress: deflate page content streams
+#   images: draw the logo and watermark at all
+#   image_max_px: downsample images to this many pixels on their longest side (None = as they are)
+#   jpeg_quality: re-encode images without transparency as JPEG at this quality (None = lossless)
+PDF_PROFILES = {
+    'standard': {'compress': True, 'images': True, 'image_max_px': None, 'jpeg_quality': None},
+    'compact': {'compress': True, 'images': True, 'image_max_px': 400, 'jpeg_quality': 70},
+    'minimal': {'compress': True, 'images': False, 'image_max_px': None, 'jpeg_quality': None},
+    'uncompressed': {'compress': False, 'images': True, 'image_max_px': None, 'jpeg_quality': None},  # readable, for debugging
+}
+PDF_PROFILE = os.getenv('PDF_PROFILE', 'standard')
+
+
+def _pdf_profile():
+    profile = PDF_PROFILES.get(PDF_PROFILE)
+    if profile is None:
+        raise ValueError(f'unknown PDF_PROFILE {PDF_PROFILE!r}; expected one of {", ".join(PDF_PROFILES)}')
+    return profile
+
+
+def set_pdf_profile(name):
+    """Switch the output profile of this process, dropping images and templates prepared for the old one."""
+    global PDF_PROFILE
+    if name not in PDF_PROFILES:
+        raise ValueError(f'unknown PDF profile {name!r}; expected one of {", ".join(PDF_PROFILES)}')
+    PDF_PROFILE = name
+    assets.clear()
+
+
+def _reencode_image(path, max_px=None, jpeg_quality=None):
+    # Downsampled and/or JPEG re-encoded copy of an image as an ImageReader; the original path if Pillow is missing
+    try:
+        from PIL import Image
+    except ImportError:
+        logging.warning('Pillow is not installed; %s is embedded as it is', path)
+        return path
+    with Image.open(path) as im:
+        im.load()
+        if max_px and max(im.size) > max_px:
+            im.thumbnail((max_px, max_px), Image.LANCZOS)
+        out = io.BytesIO()
+        transparent = im.mode in ('RGBA', 'LA', 'PA') or (im.mode == 'P' and 'transparency' in im.info)
+        if jpeg_quality and not transparent:
+            im.convert('L' if im.mode in ('L', '1') else 'RGB').save(out, 'JPEG', quality=jpeg_quality, optimize=True)
+        else:
+            im.save(out, 'PNG', optimize=True)
+    out.seek(0)
+    return ImageReader(out)
+
+
+class ImageAsset:
+    """An image encoded once per process into a PDF image XObject.
+
+    ReportLab normally re-reads, decodes and re-encodes an image for every
+    document it is drawn into. ``draw`` registers a copy of the pre-encoded
+    XObject in the target document first, under the name ``drawImage`` looks
+    for, so the per-document cost is a dictionary lookup.
+    """
+
+    def __init__(self, path, mtime_ns, max_px=None, jpeg_quality=None):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        # drawImage names file-based images after the file name and mask
+        self.key = canvas._digester(('%s%s' % (path, 'auto')).encode('utf-8'))
+        # The output profile may ask for a smaller copy; drawImage then finds it under the same name
+        source = _reencode_image(path, max_px, jpeg_quality) if max_px or jpeg_quality else path
+        xobject = pdfdoc.PDFImageXObject(self.key, source, mask='auto')
+        xobject.name = self.key
+        self._smask = xobject.__dict__.pop('_smask', None)
+        self._xobject = xobject
+
+    def register(self, c):
+        doc = c._doc
+        reg_name = doc.getXObjectName(self.key)
+        if reg_name in doc.idToObject:
+            return
+        # Objects remember the document they were registered with, so each document gets a shallow copy
+        xobject = copy.copy(self._xobject)
+        doc.Reference(xobject, reg_name)
+        doc.addForm(self.key, xobject)
+        if self._smask is not None:
+            mask_name = doc.getXObjectName(self._smask.name)
+            if mask_name in doc.idToObject:
+                xobject.smask = pdfdoc.PDFObjectReference(mask_name)
+            else:
+                xobject.smask = doc.Reference(copy.copy(self._smask), mask_name)
+
+    def draw(self, c, x, y, width, height):
+        self.register(c)
+        c.drawImage(self.path, x, y, width=width, height=height, preserveAspectRatio=True, mask='auto')
+
+
+class AssetCache:
+    """Process-wide cache of image assets in the project root.
+
+    Lookups only touch the filesystem once every ``revalidate`` seconds per
+    file; a changed mtime reloads the image. Missing or undecodable files are
+    cached as ``None`` so they are not retried (or logged) on every invoice.
+    """
+
+    def __init__(self, root, revalidate=2.0):
+        self.root = root
+        self.revalidate = revalidate
+        self._entries = {}  # name -> (asset or None, mtime_ns, checked_at)
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def get(self, name):
+        entry = self._entries.get(name)
+        if entry is not None and time.monotonic() - entry[2] < self.revalidate:
+            self._stats['hits'] += 1
+            return entry[0]
+        with self._lock:
+            entry = self._entries.get(name)
+            now = time.monotonic()
+            if entry is not None and now - entry[2] < self.revalidate:
+                return entry[0]
+            path = os.path.join(self.root, name)
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            if entry is not None and entry[1] == mtime_ns:
+                self._entries[name] = (entry[0], mtime_ns, now)
+                self._stats['revalidated'] += 1
+                return entry[0]
+            asset = None
+            if mtime_ns is not None:
+                try:
+                    profile = _pdf_profile()
+                    asset = ImageAsset(path, mtime_ns, profile['image_max_px'], profile['jpeg_quality'])
+                    self._stats['loads'] += 1
+                    logging.info('Loaded image asset %s', path)
+                except Exception:
+                    self._stats['load_failures'] += 1
+                    logging.warning('Could not load image asset %s', path)
+            self._entries[name] = (asset, mtime_ns, now)
+            return asset
+
+    def first(self, names):
+        for name in names:
+            asset = self.get(name)
+            if asset is not None:
+                return asset
+        return None
+
+    def signature(self, names):
+        # Changes whenever one of the named files is added, removed or modified
+        return tuple((name, asset.mtime_ns if asset else None) for name, asset in ((n, self.get(n)) for n in names))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats['reloads'] += 1
+
+    def stats(self):
+        with self._lock:
+            entries = {name: entry[0] is not None for name, entry in self._entries.items()}
+        return dict(self._stats, assets=entries)
+
+
+assets = AssetCache(APP_ROOT, ASSET_REVALIDATE_SECONDS)
+
+
+def _draw_tan_background(c):
     width, height = letter
     margin = 50
-
     # Page background (light brown)
     bg_color = colors.HexColor('#D2B48C')  # tan/brown
     c.setFillColor(bg_color)
@@ -74,36 +1176,16 @@ def create_pdf(companynamepdf, companyaddresspdf, amountpdf, staxpdf, emailpdf,
     c.setFillColor(header_color)
     c.rect(margin, height - margin - header_height, width - 2 * margin, header_height, fill=1, stroke=0)
 
-    # Logo (top-left) - look for logo.png or logo.jpg in project root
-    logo_path_png = os.path.join(APP_ROOT, 'logo.png')
-    logo_path_jpg = os.path.join(APP_ROOT, 'logo.jpg')
-    logo_drawn = False
-    try:
-        if os.path.exists(logo_path_png):
-            c.drawImage(logo_path_png, margin + 10, height - margin - 65, width=100, height=60, preserveAspectRatio=True, mask='auto')
-            logo_drawn = True
-        elif os.path.exists(logo_path_jpg):
-            c.drawImage(logo_path_jpg, margin + 10, height - margin - 65, width=100, height=60, preserveAspectRatio=True, mask='auto')
-            logo_drawn = True
-    except Exception:
-        logging.warning('Could not draw logo image')
 
-    # Company name & address in header (if no logo we still show name)
-    c.setFillColor(colors.white)
-    c.setFont('Helvetica-Bold', 18)
-    name_x = margin + (120 if logo_drawn else 10)
-    c.drawString(name_x, height - margin - 30, companynamepdf or 'Company Name')
-    c.setFont('Helvetica', 8)
-    addr_lines = (companyaddresspdf or '').split('\n')
-    for i, line in enumerate(addr_lines[:3]):
-        c.drawString(name_x, height - margin - 48 - (i * 10), line)
+def _draw_tan_static_text(c, logo_drawn):
+    width, height = letter
+    margin = 50
+    header_height = 90
 
-    # Invoice metadata on right
+    # Invoice title on right
+    c.setFillColor(colors.white)
     c.setFont('Helvetica-Bold', 14)
     c.drawRightString(width - margin - 10, height - margin - 30, 'INVOICE')
-    c.setFont('Helvetica', 9)
-    c.drawRightString(width - margin - 10, height - margin - 48, f'Date: {datepdf}')
-    c.drawRightString(width - margin - 10, height - margin - 64, f'Invoice #: {timestamppdf}')
 
     # Item table header
     table_top = height - margin - header_height - 30
@@ -120,83 +1202,14 @@ def create_pdf(companynamepdf, companyaddresspdf, amountpdf, staxpdf, emailpdf,
     c.setLineWidth(0.8)
     c.line(margin, table_top - 4, width - margin, table_top - 4)
 
-    # Item rows - this app only supports a single line currently; show product as description
-    c.setFont('Helvetica', 10)
-    y = table_top - 20
-    # If product contains multiple lines, wrap naively
-    product_text = str(productpdf or '')
-    # show one line of product description
-    c.drawString(col_item_x, y, product_text[:60])
-
-    # Qty, unit price, total
-    try:
-        amt = float(amountpdf)
-    except Exception:
-        amt = 0.0
-    qty = 1
-    unit_price = amt
-    line_total = round(qty * unit_price, 2)
-    c.drawRightString(col_qty_x + 20, y, str(qty))
-    c.drawRightString(col_unit_x + 40, y, f"{unit_price:,.2f}")
-    c.drawRightString(col_total_x, y, f"{line_total:,.2f}")
-
-    # Totals area (right side)
-    try:
-        stax = float(staxpdf)
-    except Exception:
-        stax = 0.0
-    subtotal = round(line_total, 2)
-    tax_amt = round(subtotal * (stax / 100.0), 2)
-    try:
-        final_amt = float(finalstaxpdf)
-    except Exception:
-        final_amt = round(subtotal + tax_amt, 2)
-
-    totals_x = width - margin - 260
-    totals_y = y - 10
-    c.setFont('Helvetica', 10)
-    c.drawString(totals_x + 10, totals_y + 40, 'Subtotal:')
-    c.drawRightString(totals_x + 240, totals_y + 40, f"{subtotal:,.2f}")
-    c.drawString(totals_x + 10, totals_y + 20, f'Service Tax ({stax:.0f}%):')
-    c.drawRightString(totals_x + 240, totals_y + 20, f"{tax_amt:,.2f}")
-    c.setFont('Helvetica-Bold', 12)
-    c.drawString(totals_x + 10, totals_y, 'Total:')
-    c.drawRightString(totals_x + 240, totals_y, f"{final_amt:,.2f}")
-
-    # Thank you message + company address at bottom
+    # Thank you message at bottom
     footer_y = margin + 40
     c.setFont('Helvetica-Bold', 12)
     c.setFillColor(colors.black)
     c.drawCentredString(width / 2, footer_y + 20, 'Thank you')
-    c.setFont('Helvetica', 9)
-    addr = companyaddresspdf or ''
-    # Draw company address centered below thank you
-    addr_lines = addr.split('\n') if addr else []
-    for i, line in enumerate(addr_lines[:3]):
-        c.drawCentredString(width / 2, footer_y - (i * 12), line)
-
-    # Save
-    c.save()
-    logging.info('Created PDF: %s', path)
-    return path
-
-
-def create_pdf_pharma(companyname, companyaddress, amount, stax, email, timestamp, canvas_module, date, final_amount, products, quantities, amount_paid=None, change=None, customername=None, customerphone=None):
-    """Create a modern, aesthetic booklet-style invoice PDF for e-commerce business.
 
-    - Gradient header with professional colors
-    - Clean white background with elegant borders
-    - Dynamic company branding
-    - Enhanced typography and spacing
-    - Subtle watermark and visual elements
-    - E-commerce specific elements like order confirmation
-    """
-    invoice_dir = os.path.join(APP_ROOT, 'INVOICE')
-    os.makedirs(invoice_dir, exist_ok=True)
-    filename = f"Invoice ({timestamp}).pdf"
-    path = os.path.join(invoice_dir, filename)
 
-    c = canvas_module.Canvas(path, pagesize=letter)
+def _draw_pharma_background(c):
     width, height = letter
     margin = 50
 
@@ -218,37 +1231,22 @@ def create_pdf_pharma(companyname, companyaddress, amount, stax, email, timestam
     c.setFillColor(colors.HexColor('#10B981'))
     c.rect(margin, height - margin - header_h, width - 2 * margin, 8, fill=1, stroke=0)
 
-    # Logo with better positioning
-    logo_png = os.path.join(APP_ROOT, 'logo.png')
-    logo_jpg = os.path.join(APP_ROOT, 'logo.jpg')
-    logo_drawn = False
-    try:
-        if os.path.exists(logo_png):
-            c.drawImage(logo_png, margin + 15, height - margin - header_h + 15, width=120, height=60, preserveAspectRatio=True, mask='auto')
-            logo_drawn = True
-        elif os.path.exists(logo_jpg):
-            c.drawImage(logo_jpg, margin + 15, height - margin - header_h + 15, width=120, height=60, preserveAspectRatio=True, mask='auto')
-            logo_drawn = True
-    except Exception:
-        logging.warning('Logo draw failed')
 
-    # Dynamic company name and tagline
+def _draw_pharma_static_text(c, logo_drawn):
+    width, height = letter
+    margin = 50
+    header_h = 90
+
+    # Tagline under the company name
     c.setFillColor(colors.white)
-    c.setFont('Helvetica-Bold', 22)
-    name_x = margin + (140 if logo_drawn else 15)
-    company_display = companyname or 'Your E-commerce Store'
-    c.drawString(name_x, height - margin - 35, company_display)
     c.setFont('Helvetica', 11)
+    name_x = margin + (140 if logo_drawn else 15)
     c.drawString(name_x, height - margin - 55, 'Premium Online Shopping Experience')
 
     # Invoice title with modern styling
     c.setFont('Helvetica-Bold', 18)
     c.setFillColor(colors.HexColor('#1F2937'))
     c.drawRightString(width - margin - 10, height - margin - 30, 'INVOICE')
-    c.setFont('Helvetica', 10)
-    c.setFillColor(colors.HexColor('#6B7280'))
-    c.drawRightString(width - margin - 10, height - margin - 50, f'Date: {date}')
-    c.drawRightString(width - margin - 10, height - margin - 68, f'Invoice #: {timestamp}')
 
     # Order confirmation note (e-commerce specific)
     c.setFillColor(colors.HexColor('#10B981'))
@@ -266,10 +1264,6 @@ def create_pdf_pharma(companyname, companyaddress, amount, stax, email, timestam
     c.setFillColor(colors.HexColor('#1F2937'))
     c.setFont('Helvetica-Bold', 11)
     c.drawString(margin + 12, bill_box_y - 20, 'Bill To:')
-    c.setFont('Helvetica', 10)
-    c.setFillColor(colors.HexColor('#374151'))
-    c.drawString(margin + 12, bill_box_y - 38, customername or 'Customer Name')
-    c.drawString(margin + 12, bill_box_y - 52, customerphone or 'Customer Phone')
 
     # Payment info box
     c.setFillColor(colors.HexColor('#F1F5F9'))
@@ -283,13 +1277,9 @@ def create_pdf_pharma(companyname, companyaddress, amount, stax, email, timestam
     c.drawString(width - margin - 195, bill_box_y - 38, 'Due upon receipt')
     c.drawString(width - margin - 195, bill_box_y - 52, 'Payment Method: Online')
 
-    # Enhanced table with better styling
+    # Table header with specific height (1cm)
     table_top = bill_box_y - 140  # Added more space after bill box for better separation
     header_height = 28  # 1cm height for header box (28 points ≈ 1cm)
-    gap_below_header = 4  # 0.15cm gap below header (4 points ≈ 0.15cm)
-    row_h = 20
-
-    # Table header with specific height (1cm)
     c.setFillColor(colors.HexColor('#E0F2FE'))
     c.roundRect(margin, table_top, width - 2 * margin, header_height, 3, fill=1, stroke=0)
     c.setFillColor(colors.HexColor('#0F172A'))
@@ -300,264 +1290,2922 @@ def create_pdf_pharma(companyname, companyaddress, amount, stax, email, timestam
     c.drawRightString(col_x[2] + 30, table_top + 8, 'Unit Price')
     c.drawRightString(col_x[3] + 30, table_top + 8, 'Line Total')
 
-    # Item rows with alternating background - start after 0.5cm gap
-    c.setFont('Helvetica', 10)
-    row_top = table_top - header_height - gap_below_header
-    line_height = 18
-
-    current_y = row_top
-    subtotal = 0.0
 
-    if products and quantities:
-        for idx, (prod, qty) in enumerate(zip(products, quantities)):
-            description = prod.strip()
-            wrapped_lines = textwrap.wrap(description, width=45)
+def _draw_pharma_continued_background(c):
+    width, height = letter
+    margin = 50
 
-            for i, wline in enumerate(wrapped_lines):
-                # Alternating row colors
-                if (idx + i) % 2 == 0:
-                    c.setFillColor(colors.HexColor('#FAFAFA'))
-                else:
-                    c.setFillColor(colors.white)
-                c.rect(margin, current_y - 6, width - 2 * margin, line_height + 4, fill=1, stroke=0)
-
-                c.setFillColor(colors.HexColor('#1F2937'))
-                c.drawString(col_x[0], current_y + 2, wline)
-
-                if i == 0:
-                    unit_price = PRODUCT_PRICES.get(prod, 0.0)
-                    line_total = round(qty * unit_price, 2)
-                    subtotal += line_total
-                    c.drawRightString(col_x[1] + 30, current_y + 2, str(qty))
-                    c.drawRightString(col_x[2] + 30, current_y + 2, f"${unit_price:,.2f}")
-                    c.drawRightString(col_x[3] + 30, current_y + 2, f"${line_total:,.2f}")
-                current_y -= line_height
-    else:
-        # Fallback for single product if no products/quantities provided
-        description = (product or 'Premium Product').strip()
-        wrapped_lines = textwrap.wrap(description, width=45)
+    # Same page frame as the first page, with a slim header bar
+    c.setFillColor(colors.white)
+    c.rect(0, 0, width, height, stroke=0, fill=1)
+    c.setStrokeColor(colors.HexColor('#E8F4F8'))
+    c.setLineWidth(2)
+    c.roundRect(margin/2, margin/2, width - margin, height - margin, 8, stroke=1, fill=0)
+    c.setFillColor(colors.HexColor('#2563EB'))
+    c.rect(margin, height - margin - 40, width - 2 * margin, 40, fill=1, stroke=0)
+    c.setFillColor(colors.HexColor('#10B981'))
+    c.rect(margin, height - margin - 40, width - 2 * margin, 4, fill=1, stroke=0)
 
-        for i, wline in enumerate(wrapped_lines):
-            # Alternating row colors
-            if i % 2 == 0:
-                c.setFillColor(colors.HexColor('#FAFAFA'))
-            else:
-                c.setFillColor(colors.white)
-            c.rect(margin, current_y - 6, width - 2 * margin, line_height + 4, fill=1, stroke=0)
 
-            c.setFillColor(colors.HexColor('#1F2937'))
-            c.drawString(col_x[0], current_y + 2, wline)
+def _draw_pharma_continued_static_text(c, logo_drawn):
+    width, height = letter
+    margin = 50
 
-            if i == 0:
-                qty = 1
-                try:
-                    unit_price = float(amount)
-                except Exception:
-                    unit_price = 0.0
-                line_total = round(qty * unit_price, 2)
-                subtotal = line_total
-                c.drawRightString(col_x[1] + 30, current_y + 2, str(qty))
-                c.drawRightString(col_x[2] + 30, current_y + 2, f"${unit_price:,.2f}")
-                c.drawRightString(col_x[3] + 30, current_y + 2, f"${line_total:,.2f}")
-            current_y -= line_height
+    # Repeated table header
+    table_top = height - margin - 80
+    c.setFillColor(colors.HexColor('#E0F2FE'))
+    c.roundRect(margin, table_top, width - 2 * margin, 28, 3, fill=1, stroke=0)
+    c.setFillColor(colors.HexColor('#0F172A'))
+    c.setFont('Helvetica-Bold', 10)
+    col_x = [margin + 10, margin + 280, margin + 360, width - margin - 70, width - margin]
+    c.drawString(col_x[0], table_top + 8, 'Item / Description')
+    c.drawRightString(col_x[1] + 30, table_top + 8, 'Qty')
+    c.drawRightString(col_x[2] + 30, table_top + 8, 'Unit Price')
+    c.drawRightString(col_x[3] + 30, table_top + 8, 'Line Total')
 
-    # Table borders
-    items_bottom = current_y + line_height
-    c.setStrokeColor(colors.HexColor('#E2E8F0'))
-    c.setLineWidth(0.8)
-    c.roundRect(margin, table_top, width - 2 * margin, (table_top - items_bottom) + row_h + 6, 3, stroke=1, fill=0)
 
-    # Enhanced totals section with more space
+def _draw_pharma_watermark(c):
+    width, height = letter
+    # Subtle watermark with logo (opacity is applied by _draw_page_overlay)
+    watermark = assets.get(WATERMARK_FILE) if _pdf_profile()['images'] else None
+    if watermark is None:
+        return
+    c.saveState()
     try:
-        staxf = float(stax)
+        c.translate(width/2, height/2)
+        c.rotate(45)
+        watermark.draw(c, -100, -100, 200, 200)
     except Exception:
-        staxf = 0.0
-    tax_amt = round(subtotal * (staxf / 100.0), 2)
+        logging.warning('Could not draw watermark logo')
+    finally:
+        c.restoreState()
+
+
+# Static parts of each layout: background drawing, logo box (x, y, w, h), text drawn over the logo row, overlay
+_PAGE_LAYOUTS = {
+    'tan': (_draw_tan_background, (60, letter[1] - 115, 100, 60), _draw_tan_static_text, None),
+    'pharma': (_draw_pharma_background, (65, letter[1] - 125, 120, 60), _draw_pharma_static_text, _draw_pharma_watermark),
+    'pharma-continued': (_draw_pharma_continued_background, None, _draw_pharma_continued_static_text, _draw_pharma_watermark),
+}
+
+
+def _draw_logo(c, box):
+    # Logo - logo.png or logo.jpg in project root
+    if box is None or not _pdf_profile()['images']:
+        return False
+    logo = assets.first(LOGO_FILES)
+    if logo is None:
+        return False
     try:
-        total_amt = float(final_amount)
+        logo.draw(c, *box)
+        return True
     except Exception:
-        total_amt = round(subtotal + tax_amt, 2)
+        logging.warning('Could not draw logo image')
+        return False
 
-    totals_w = 240
-    totals_h = 80
-    totals_x = width - margin - totals_w
-    totals_y = items_bottom - totals_h - 35  # Added more space after table
 
-    # Totals box with gradient
-    c.setFillColor(colors.HexColor('#F8FAFC'))
-    c.roundRect(totals_x, totals_y, totals_w, totals_h, 5, fill=1, stroke=0)
-    c.setStrokeColor(colors.HexColor('#CBD5E1'))
-    c.roundRect(totals_x, totals_y, totals_w, totals_h, 5, stroke=1, fill=0)
+class _PageTemplate:
+    """Pre-rendered drawing operators for the invariant parts of one page layout.
 
-    c.setFillColor(colors.HexColor('#374151'))
-    c.setFont('Helvetica', 10)
-    c.drawString(totals_x + 12, totals_y + 56, 'Subtotal:')
-    c.drawRightString(totals_x + totals_w - 12, totals_y + 56, f"${subtotal:,.2f}")
-    c.drawString(totals_x + 12, totals_y + 36, f'Tax ({staxf:.0f}%):')
-    c.drawRightString(totals_x + totals_w - 12, totals_y + 36, f"${tax_amt:,.2f}")
-    c.setFillColor(colors.HexColor('#10B981'))
-    c.setFont('Helvetica-Bold', 12)
-    c.drawString(totals_x + 12, totals_y + 12, 'Total:')
-    c.drawRightString(totals_x + totals_w - 12, totals_y + 12, f"${total_amt:,.2f}")
-    c.setFillColor(colors.HexColor('#374151'))
-    c.setFont('Helvetica', 10)
-    c.drawString(totals_x + 12, totals_y - 8, 'Amount Paid:')
-    c.drawRightString(totals_x + totals_w - 12, totals_y - 8, f"${amount_paid:,.2f}")
-    c.drawString(totals_x + 12, totals_y - 28, 'Change:')
-    c.drawRightString(totals_x + totals_w - 12, totals_y - 28, f"${change:,.2f}")
+    Vector graphics and fixed text are captured once from a scratch canvas, so
+    each invoice only replays a list of operator strings instead of issuing
+    dozens of drawing calls. Single-page documents get the operators inline;
+    documents that repeat the layout on many pages get them once as a form
+    XObject referenced from every page. Images are still placed through
+    ``drawImage`` so each document registers them itself.
+    """
 
-    # Signature section with better styling
-    sig_x = margin + 20
-    sig_y = totals_y - 50
-    c.setStrokeColor(colors.HexColor('#6B7280'))
-    c.setLineWidth(1)
-    c.line(sig_x, sig_y, sig_x + 200, sig_y)
-    c.setFillColor(colors.HexColor('#6B7280'))
-    c.setFont('Helvetica', 9)
-    c.drawString(sig_x, sig_y - 15, 'Authorized Signature')
+    _versions = iter(range(1, sys.maxsize))
 
-    # Enhanced footer with watermark effect
-    footer_y = sig_y - 60
+    def __init__(self, layout):
+        background, self.logo_box, static_text, self.overlay = _PAGE_LAYOUTS[layout]
+        self.name = f'static-{layout}-{next(self._versions)}'
+        scratch = canvas.Canvas(io.BytesIO(), pagesize=letter)
+        background(scratch)
+        self.background = list(scratch._code)
+        self.logo_drawn = _draw_logo(scratch, self.logo_box)
+        mark = len(scratch._code)
+        static_text(scratch, self.logo_drawn)
+        self.text = scratch._code[mark:]
+        # Fonts the operators refer to (including fallbacks such as ZapfDingbats for '✓'), in registration order
+        self.fonts = sorted(scratch._doc.fontMapping.items(), key=lambda item: int(item[1].lstrip('/F')))
 
-    # Subtle watermark with logo
-    logo_path = os.path.join(APP_ROOT, '.webp')
-    try:
-        c.saveState()
-        c.setFillAlpha(0.1)  # Low opacity for watermark effect
-        c.translate(width/2, height/2)
-        c.rotate(45)
-        c.drawImage(logo_path, -100, -100, width=200, height=200, preserveAspectRatio=True, mask='auto')
-        c.restoreState()
-    except Exception:
-        logging.warning('Could not draw watermark logo')
+    def stamp(self, c, reuse=False):
+        # Pre-rendered operators name fonts /F1, /F2, ...; they are only valid if this document agrees
+        if any(c._doc.getInternalFontName(font) != internal for font, internal in self.fonts):
+            return False
+        if not reuse:
+            # Bracket with q/Q so the canvas' idea of the graphics state stays accurate
+            c._code.append('q')
+            self._replay(c)
+            c._code.append('Q')
+            return True
+        # Define the form the first time this document needs it, then reference it
+        if not c._doc.hasForm(self.name):
+            c.beginForm(self.name)
+            self._replay(c)
+            c.endForm()
+        c.doForm(self.name)
+        return True
 
-    # Thank you message
-    c.setFillColor(colors.HexColor('#10B981'))
-    c.setFont('Helvetica-Bold', 14)
-    c.drawCentredString(width / 2, footer_y + 25, 'Thank you for shopping with us!')
+    def _replay(self, c):
+        c._code.extend(self.background)
+        if self.logo_drawn:
+            _draw_logo(c, self.logo_box)
+        c._code.extend(self.text)
 
-    # Company address
-    c.setFillColor(colors.HexColor('#6B7280'))
-    c.setFont('Helvetica', 9)
-    addr_lines = (companyaddress or '').split('\n') if companyaddress else []
-    for i, line in enumerate(addr_lines[:3]):
-        c.drawCentredString(width / 2, footer_y - (i * 12), line)
+    def stamp_overlay(self, c, reuse=False):
+        if not reuse:
+            self.overlay(c)
+            return
+        name = self.name + '-overlay'
+        if not c._doc.hasForm(name):
+            c.beginForm(name)
+            self.overlay(c)
+            c.endForm()
+        c.doForm(name)
 
-    # E-commerce footer note
-    c.setFont('Helvetica', 8)
-    c.setFillColor(colors.HexColor('#9CA3AF'))
-    c.drawCentredString(width / 2, footer_y - 50, 'For any queries, please contact our customer support team.')
 
-    c.save()
-    logging.info('Created enhanced e-commerce PDF: %s', path)
-    return path
+_page_templates = {}
+_page_templates_lock = threading.Lock()
 
 
-# addtodatabase function to add data to a mysql database
-def addtodatabase(companynamedatabase, companyaddressdatabase, amountdatabase, emaildatabase, finalstaxdatabase, productdatabase, amount_paid=None, change=None):
-    # Connect to the database
-    # Skip DB insert if environment variables not set
-    if not (DB_USER and DB_NAME and DB_TABLE):
-        logging.warning('Database credentials/table not set in environment - skipping DB insert')
-        return
+def _get_page_template(layout):
+    # One template per layout, rebuilt when the logo or watermark files or the output profile change
+    key = (layout, PDF_PROFILE, assets.signature(LOGO_FILES + (WATERMARK_FILE,)))
+    template = _page_templates.get(key)
+    if template is None:
+        with _page_templates_lock:
+            template = _page_templates.get(key)
+            if template is None:
+                for stale in [k for k in _page_templates if k[0] == layout]:
+                    del _page_templates[stale]
+                template = _page_templates[key] = _PageTemplate(layout)
+    return template
 
-    connection = pymysql.connect(host=DB_HOST,
-                                 user=DB_USER,
-                                 password=DB_PASSWORD,
-                                 db=DB_NAME,
-                                 charset='utf8mb4',
-                                 cursorclass=pymysql.cursors.DictCursor)
-    try:
-        with connection.cursor() as cursor:
-            # Create a new record
-            sql = f"INSERT INTO `{DB_TABLE}` (`Company_Name`,`Company_Address`,`Email_ID`, `Amount`, Final_Amount, Product, Amount_Paid, Change) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
-            cursor.execute(sql, (str(companynamedatabase), str(companyaddressdatabase), str(emaildatabase), str(amountdatabase), str(finalstaxdatabase), str(productdatabase), str(amount_paid), str(change)))
-        connection.commit()
-        logging.info('Inserted record into DB table %s', DB_TABLE)
-    except Exception:
-        logging.exception('Failed to insert into database')
-    finally:
-        connection.close()
 
+def _draw_page_static(c, layout, reuse=False):
+    """Draw the invariant page furniture of ``layout``; returns whether the logo was drawn.
 
+    Pass ``reuse=True`` when the same layout will be drawn on several pages of
+    one document, so it is embedded once as a form XObject.
+    """
+    if PAGE_TEMPLATES:
+        template = _get_page_template(layout)
+        if template.stamp(c, reuse):
+            return template.logo_drawn
+    background, logo_box, static_text, _ = _PAGE_LAYOUTS[layout]
+    background(c)
+    logo_drawn = _draw_logo(c, logo_box)
+    static_text(c, logo_drawn)
+    return logo_drawn
 
 
+def _draw_page_overlay(c, layout, reuse=False):
+    # Watermark drawn over the page content. Alpha is set on the page because
+    # ReportLab does not give form XObjects their own ExtGState resources.
+    overlay = _PAGE_LAYOUTS[layout][3]
+    if overlay is None or not _pdf_profile()['images']:
+        return
+    c.saveState()
+    c.setFillAlpha(0.1)  # Low opacity for watermark effect
+    if PAGE_TEMPLATES:
+        _get_page_template(layout).stamp_overlay(c, reuse)
+    else:
+        overlay(c)
+    c.restoreState()
 
 
+def invoice_filename(number):
+    return f"Invoice ({number}).pdf"
 
 
-@app.route("/", methods=["POST"])
-def Create():
-    target = os.path.join(APP_ROOT)
-    # Use .get to avoid KeyError and validate inputs
-    companyname = request.form.get('CompanyName', '').strip()
-    companyaddress = request.form.get('CompanyAddress', '').strip()
-    customername = request.form.get('CustomerName', '').strip()
-    customerphone = request.form.get('CustomerPhone', '').strip()
-    amount_raw = request.form.get('Amount', '0').strip()
-    stax_raw = request.form.get('STax', '0').strip()
-    date = time.strftime("%d/%m/%Y")
+def _fsync_directory(path):
+    # Make a rename or link in ``path`` durable; not supported (nor needed) on Windows
+    with contextlib.suppress(OSError):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
-    # Collect products and quantities
-    products = []
-    quantities = []
-    for i in range(1, 6):
-        product = request.form.get(f'Product{i}', '').strip()
-        quantity_raw = request.form.get(f'Quantity{i}', '0').strip()
-        if product and quantity_raw:
-            try:
-                quantity = int(float(quantity_raw))
-                if quantity > 0:
-                    products.append(product)
-                    quantities.append(quantity)
-            except Exception:
-                pass
 
-    # Validate numeric values
+def _atomic_write(path, data):
+    # Write to a temporary file in the same directory and rename it into place,
+    # so concurrent readers never see a half-written file
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
     try:
-        stax = float(stax_raw)
-    except Exception:
-        stax = 0.0
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+        metrics.inc('invoice_bytes_written_total', len(data))
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
 
-    # Get Amount Paid
-    amount_paid_raw = request.form.get('AmountPaid', '0').strip()
-    try:
-        amount_paid = float(amount_paid_raw)
-    except Exception:
-        amount_paid = 0.0
 
-    # Use a filename-safe timestamp (no colons) and place invoice in project INVOICE folder
-    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-    os.makedirs(os.path.join(APP_ROOT, 'INVOICE'), exist_ok=True)
+class LocalStorage:
+    """Invoices stored as ``Invoice (<number>).pdf`` in a single directory."""
 
-    # Calculate total amount based on products and fixed prices
-    total_amount = 0.0
-    for prod, qty in zip(products, quantities):
-        price = PRODUCT_PRICES.get(prod, 0.0)
-        total_amount += qty * price
-    finalstax = total_amount + (total_amount * (stax / 100))
+    def __init__(self, root):
+        self.root = root
 
-    # Calculate change
-    change = amount_paid - finalstax
+    def save(self, number, data):
+        path = os.path.join(self.root, invoice_filename(number))
+        _atomic_write(path, data)
+        return path
 
-    try:
-        # Use the pharmaceutical-styled invoice generator
-        pdf_path = create_pdf_pharma(companyname, companyaddress, str(total_amount), str(stax), '', timestamp, canvas, date, str(finalstax), products, quantities, amount_paid, change, customername, customerphone)
-        # For database, store a summary of products
-        product_summary = ', '.join(products) if products else 'No products'
-        try:
-            addtodatabase(companyname, companyaddress, total_amount, '', finalstax, product_summary, amount_paid, change)
-        except Exception as db_e:
-            logging.warning('Database insertion failed: %s', str(db_e))
-        message = f'Invoice created: {os.path.basename(pdf_path)}'
-        logging.info(message)
-        return render_template('index.html', message=message)
-    except Exception as e:
-        logging.exception('Error handling Create request')
-        return render_template('index.html', error=str(e))
+    def path_for(self, number):
+        path = os.path.join(self.root, invoice_filename(number))
+        return path if os.path.exists(path) else None
 
+    def entry(self, number):
+        # No index: callers fall back to the file's own metadata
+        return None
+
+
+class ContentAddressedStorage:
+    """Each distinct PDF stored once as ``objects/<sha256[:2]>/<sha256>.pdf``.
+
+    ``refs/<number>`` records which object belongs to an invoice, so identical
+    re-renders share one file.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def save(self, number, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            _atomic_write(path, data)
+        _atomic_write(os.path.join(self.root, 'refs', str(number)), digest.encode('ascii'))
+        return path
+
+    def path_for(self, number):
+        entry = self.entry(number)
+        return entry['path'] if entry else None
+
+    def entry(self, number):
+        try:
+            with open(os.path.join(self.root, 'refs', str(number)), encoding='ascii') as fh:
+                digest = fh.read().strip()
+        except OSError:
+            return None
+        return {'number': str(number), 'path': self._object_path(digest), 'sha256': digest}
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest + '.pdf')
+
+
+class InvoiceManifest:
+    """Append-only JSON-lines index of stored invoices: number -> path, size, checksum, created.
+
+    The file is read once into a dict; afterwards only lines appended since
+    the last read (by this or another process) are parsed, when a number is
+    not found. The last line for a number wins. Each entry is written with a
+    single O_APPEND write, so concurrent writers never interleave lines.
+    Appends share a lock on ``<path>.lock`` and rewrites take it exclusively,
+    so no entry appended by another process is lost when the file is replaced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._offset = 0
+        self._inode = None
+
+    def get(self, number):
+        with self._lock:
+            entry = self._entries.get(number)
+            if entry is None:
+                self._refresh()
+                entry = self._entries.get(number)
+            return entry
+
+    def append(self, entry):
+        line = (json.dumps(entry, separators=(',', ':'), sort_keys=True) + '\n').encode('utf-8')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._file_lock(exclusive=False):
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        with self._lock:
+            self._entries[entry['number']] = entry
+
+    def entries(self):
+        with self._lock:
+            self._refresh()
+            return dict(self._entries)
+
+    def rewrite(self, entries):
+        """Atomically replace the manifest with one line per entry (compaction or rebuild)."""
+        with self._file_lock(exclusive=True):
+            with self._lock:
+                self._replace(entries)
+
+    def remove(self, numbers):
+        """Drop ``numbers`` from the manifest, keeping every other entry, including ones appended meanwhile."""
+        numbers = set(numbers)
+        with self._file_lock(exclusive=True):
+            with self._lock:
+                self._refresh()
+                self._replace(sorted((e for n, e in self._entries.items() if n not in numbers), key=lambda e: e['created']))
+
+    def _replace(self, entries):
+        data = ''.join(json.dumps(e, separators=(',', ':'), sort_keys=True) + '\n' for e in entries)
+        _atomic_write(self.path, data.encode('utf-8'))
+        self._entries = {}
+        self._offset = 0
+        self._inode = None
+        self._refresh()
+
+    @contextlib.contextmanager
+    def _file_lock(self, exclusive):
+        # flock on a sidecar file: the manifest itself is swapped out by rewrites
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            os.close(fd)
+
+    def _refresh(self):
+        # Parse complete lines appended since the last read; start over if the file was replaced
+        try:
+            with open(self.path, 'rb') as fh:
+                inode = os.fstat(fh.fileno()).st_ino
+                if inode != self._inode:
+                    self._entries, self._offset, self._inode = {}, 0, inode
+                fh.seek(self._offset)
+                data = fh.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                self._entries[entry['number']] = entry
+        self._offset += end
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._entries)
+
+
+class ShardedStorage:
+    """Invoices stored as ``<yyyy>/<mm>/<shard>/Invoice (<number>).pdf`` with a manifest index.
+
+    The shard is the first byte of a hash of the invoice number, so no
+    directory holds more than a month's invoices / 256. ``manifest.jsonl`` in
+    the root maps numbers to files, so lookups never list directories.
+    """
+
+    MANIFEST = 'manifest.jsonl'
+
+    def __init__(self, root):
+        self.root = root
+        self.manifest = InvoiceManifest(os.path.join(root, self.MANIFEST))
+
+    def save(self, number, data, created=None):
+        created = time.time() if created is None else created
+        relpath = self.relative_path(number, created)
+        path = os.path.join(self.root, relpath)
+        _atomic_write(path, data)
+        self.manifest.append(self._entry(number, relpath, data, created))
+        return path
+
+    def path_for(self, number):
+        entry = self.manifest.get(str(number))
+        return os.path.join(self.root, entry['path']) if entry else None
+
+    def entry(self, number):
+        return self.manifest.get(str(number))
+
+    def import_file(self, source, number, created):
+        """Move an existing PDF into the layout and index it; returns the new path."""
+        relpath = self.relative_path(number, created)
+        path = os.path.join(self.root, relpath)
+        with open(source, 'rb') as fh:
+            data = fh.read()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(source, path)
+        self.manifest.append(self._entry(number, relpath, data, created))
+        return path
+
+    def rebuild_manifest(self):
+        """Re-create the manifest from the files on disk; returns the number of invoices indexed."""
+        entries = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                number = _invoice_number_from_filename(name)
+                if number is None or directory == self.root:
+                    continue
+                path = os.path.join(directory, name)
+                with open(path, 'rb') as fh:
+                    data = fh.read()
+                entries.append(self._entry(number, os.path.relpath(path, self.root), data, os.path.getmtime(path)))
+        entries.sort(key=lambda e: e['created'])
+        self.manifest.rewrite(entries)
+        return len(entries)
+
+    @staticmethod
+    def relative_path(number, created):
+        shard = hashlib.sha1(str(number).encode('utf-8')).hexdigest()[:2]
+        return os.path.join(time.strftime('%Y', time.localtime(created)), time.strftime('%m', time.localtime(created)),
+                            shard, invoice_filename(number))
+
+    @staticmethod
+    def _entry(number, relpath, data, created):
+        return {'number': str(number), 'path': relpath.replace(os.sep, '/'), 'size': len(data),
+                'sha256': hashlib.sha256(data).hexdigest(),
+                'created': datetime.datetime.fromtimestamp(created).isoformat(timespec='seconds')}
+
+
+def _invoice_number_from_filename(name):
+    # 'Invoice (<number>).pdf' -> '<number>'
+    if name.startswith('Invoice (') and name.endswith(').pdf'):
+        return name[len('Invoice ('):-len(').pdf')]
+    return None
+
+
+def migrate_flat_storage(source, target):
+    """Move flat ``Invoice (<number>).pdf`` files from ``source`` into a ShardedStorage; returns the count.
+
+    Files keep their modification time as creation date. Safe to re-run: files
+    already moved are no longer in ``source``.
+    """
+    moved = 0
+    with os.scandir(source) as it:
+        for item in it:
+            number = _invoice_number_from_filename(item.name)
+            if number is None or not item.is_file():
+                continue
+            target.import_file(item.path, number, item.stat().st_mtime)
+            moved += 1
+            if moved % 1000 == 0:
+                logging.info('Moved %d invoice(s)', moved)
+    return moved
+
+
+class DirectStorage:
+    """Nothing is written to disk; callers return the PDF bytes to the client."""
+
+    def __init__(self, root=None):
+        self.root = root
+
+    def save(self, number, data):
+        return None
+
+    def path_for(self, number):
+        return None
+
+    def entry(self, number):
+        return None
+
+
+INVOICE_STORAGES = {'sharded': ShardedStorage, 'local': LocalStorage, 'content': ContentAddressedStorage, 'direct': DirectStorage}
+_invoice_storages = {}
+
+
+def get_invoice_storage(persistent=False):
+    """Return the configured storage backend.
+
+    ``persistent=True`` substitutes sharded storage for 'direct', for callers
+    (such as background jobs) that have no response to put the PDF in.
+    """
+    kind = 'sharded' if persistent and INVOICE_STORAGE == 'direct' else INVOICE_STORAGE
+    storage = _invoice_storages.get(kind)
+    if storage is None:
+        if kind not in INVOICE_STORAGES:
+            raise ValueError(f'unknown INVOICE_STORAGE {kind!r}; expected one of {", ".join(INVOICE_STORAGES)}')
+        storage = _invoice_storages.setdefault(kind, INVOICE_STORAGES[kind](INVOICE_DIR))
+    return storage
+
+
+class InvoiceArchive:
+    """Old invoices packed into ZIP bundles, ``<yyyy>-<mm>.<part>.zip`` per month of creation and archiver run.
+
+    ``index.jsonl`` (an InvoiceManifest) maps each number to its bundle and
+    member, so ``read`` opens just that bundle and decompresses one member
+    through the ZIP central directory instead of unpacking the archive.
+    Bundles are written once and never reopened for writing, so a crash
+    cannot damage invoices archived by an earlier run.
+    """
+
+    INDEX = 'index.jsonl'
+
+    def __init__(self, root):
+        self.root = root
+        self.index = InvoiceManifest(os.path.join(root, self.INDEX))
+
+    def entry(self, number):
+        return self.index.get(str(number))
+
+    def read(self, number):
+        """Return the PDF bytes of an archived invoice, or None."""
+        entry = self.entry(number)
+        if entry is None:
+            return None
+        with zipfile.ZipFile(os.path.join(self.root, entry['bundle'])) as zf:
+            return zf.read(entry['member'])
+
+    def add(self, month, files):
+        """Pack ``(number, path, entry)`` files into a new bundle for ``month`` (``yyyy-mm``), index them and return its name.
+
+        The bundle is built under a temporary name and synced to disk before it
+        is linked into place; only then are its invoices indexed.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.tmp-', suffix='.zip')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                with zipfile.ZipFile(fh, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+                    for number, path, _ in files:
+                        zf.write(path, invoice_filename(number))
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.chmod(tmp, 0o644)
+            part = 1 + max((int(name.split('.')[1]) for name in os.listdir(self.root)
+                            if name.startswith(month + '.') and name.endswith('.zip') and name.count('.') == 2), default=0)
+            while True:
+                bundle = f'{month}.{part:03d}.zip'
+                try:
+                    # Unlike os.replace, link() never overwrites an existing bundle
+                    os.link(tmp, os.path.join(self.root, bundle))
+                    break
+                except FileExistsError:
+                    part += 1
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+        _fsync_directory(self.root)
+        for number, path, entry in files:
+            self.index.append(dict(entry, number=str(number), bundle=bundle, member=invoice_filename(number)))
+        return bundle
+
+
+def _archive_candidates(storage, cutoff):
+    # (number, path, entry) of stored invoices created before the ``cutoff`` Unix time
+    if isinstance(storage, ShardedStorage):
+        limit = datetime.datetime.fromtimestamp(cutoff).isoformat(timespec='seconds')
+        for number, entry in sorted(storage.manifest.entries().items(), key=lambda item: item[1]['created']):
+            if entry['created'] < limit:
+                yield number, os.path.join(storage.root, entry['path']), entry
+    elif isinstance(storage, LocalStorage):
+        with os.scandir(storage.root) as it:
+            for item in it:
+                number = _invoice_number_from_filename(item.name)
+                if number is None or not item.is_file() or item.stat().st_mtime >= cutoff:
+                    continue
+                with open(item.path, 'rb') as fh:
+                    entry = ShardedStorage._entry(number, item.name, fh.read(), item.stat().st_mtime)
+                yield number, item.path, entry
+    else:
+        raise ValueError('archiving needs INVOICE_STORAGE=sharded or local')
+
+
+def archive_invoices(days, storage=None, archive=None, dry_run=False):
+    """Move invoices older than ``days`` from ``storage`` into new ``archive`` bundles; returns a stats dict.
+
+    Files are deleted only after their bundle is synced to disk and indexed,
+    so an interrupted run loses nothing and can simply be repeated. Run one
+    archiver at a time.
+    """
+    storage = storage or get_invoice_storage(persistent=True)
+    archive = archive or InvoiceArchive(ARCHIVE_DIR)
+    cutoff = time.time() - days * 86400
+    months = collections.defaultdict(list)
+    for number, path, entry in _archive_candidates(storage, cutoff):
+        if os.path.isfile(path):
+            months[entry['created'][:7]].append((number, path, entry))
+    stats = {'invoices': sum(len(files) for files in months.values()), 'bundles': sorted(months),
+             'bytes': sum(os.path.getsize(path) for files in months.values() for _, path, _ in files)}
+    if dry_run or not months:
+        return stats
+    stats['bundles'] = []
+    for month, files in sorted(months.items()):
+        bundle = archive.add(month, files)
+        stats['bundles'].append(bundle)
+        logging.info('Archived %d invoice(s) into %s', len(files), bundle)
+        if isinstance(storage, ShardedStorage):
+            storage.manifest.remove(number for number, _, _ in files)
+        for _, path, _ in files:
+            os.remove(path)
+    stats['archive_bytes'] = sum(os.path.getsize(os.path.join(archive.root, bundle)) for bundle in stats['bundles'])
+    return stats
+
+
+def read_invoice_pdf(number):
+    """Return the PDF bytes of a stored or archived invoice, or None."""
+    path = get_invoice_storage(persistent=True).path_for(number)
+    if path is not None and os.path.isfile(path):
+        with open(path, 'rb') as fh:
+            return fh.read()
+    return InvoiceArchive(ARCHIVE_DIR).read(number)
+
+
+# createpdf function to create a Invoice PDF
+def create_pdf(companynamepdf, companyaddresspdf, amountpdf, staxpdf, emailpdf, timestamppdf, canvas_module, datepdf, finalstaxpdf, productpdf, storage=None):
+    data = render_pdf(companynamepdf, companyaddresspdf, amountpdf, staxpdf, emailpdf, timestamppdf, canvas_module, datepdf, finalstaxpdf, productpdf)
+    path = (storage or get_invoice_storage()).save(timestamppdf, data)
+    logging.info('Created PDF: %s', path or invoice_filename(timestamppdf))
+    return path
+
+
+def render_pdf(companynamepdf, companyaddresspdf, amountpdf, staxpdf, emailpdf, timestamppdf, canvas_module, datepdf, finalstaxpdf, productpdf):
+    # Render in memory; create_pdf decides where the bytes go
+    buffer = io.BytesIO()
+    # Create a styled invoice with background, logo, item table and footer
+    c = canvas_module.Canvas(buffer, pagesize=letter, pageCompression=int(_pdf_profile()['compress']))
+    width, height = letter
+    margin = 50
+    header_height = 90
+
+    # Background, header bar, logo, table header and footer greeting
+    logo_drawn = _draw_page_static(c, 'tan')
+
+    # Company name & address in header (if no logo we still show name)
+    c.setFillColor(colors.white)
+    c.setFont('Helvetica-Bold', 18)
+    name_x = margin + (120 if logo_drawn else 10)
+    c.drawString(name_x, height - margin - 30, companynamepdf or 'Company Name')
+    c.setFont('Helvetica', 8)
+    addr_lines = (companyaddresspdf or '').split('\n')
+    for i, line in enumerate(addr_lines[:3]):
+        c.drawString(name_x, height - margin - 48 - (i * 10), line)
+
+    # Invoice metadata on right
+    c.setFont('Helvetica', 9)
+    c.drawRightString(width - margin - 10, height - margin - 48, f'Date: {datepdf}')
+    c.drawRightString(width - margin - 10, height - margin - 64, f'Invoice #: {timestamppdf}')
+
+    # Item table columns
+    table_top = height - margin - header_height - 30
+    c.setFillColor(colors.black)
+    col_item_x = margin + 10
+    col_qty_x = width - margin - 200
+    col_unit_x = width - margin - 120
+    col_total_x = width - margin
+
+    # Item rows - this app only supports a single line currently; show product as description
+    c.setFont('Helvetica', 10)
+    y = table_top - 20
+    # If product contains multiple lines, wrap naively
+    product_text = str(productpdf or '')
+    # show one line of product description
+    c.drawString(col_item_x, y, product_text[:60])
+
+    # Qty, unit price, total
+    try:
+        amt = float(amountpdf)
+    except Exception:
+        amt = 0.0
+    qty = 1
+    unit_price = amt
+    line_total = round(qty * unit_price, 2)
+    c.drawRightString(col_qty_x + 20, y, str(qty))
+    c.drawRightString(col_unit_x + 40, y, f"{unit_price:,.2f}")
+    c.drawRightString(col_total_x, y, f"{line_total:,.2f}")
+
+    # Totals area (right side)
+    try:
+        stax = float(staxpdf)
+    except Exception:
+        stax = 0.0
+    subtotal = round(line_total, 2)
+    tax_amt = round(subtotal * (stax / 100.0), 2)
+    try:
+        final_amt = float(finalstaxpdf)
+    except Exception:
+        final_amt = round(subtotal + tax_amt, 2)
+
+    totals_x = width - margin - 260
+    totals_y = y - 10
+    c.setFont('Helvetica', 10)
+    c.drawString(totals_x + 10, totals_y + 40, 'Subtotal:')
+    c.drawRightString(totals_x + 240, totals_y + 40, f"{subtotal:,.2f}")
+    c.drawString(totals_x + 10, totals_y + 20, f'Service Tax ({stax:.0f}%):')
+    c.drawRightString(totals_x + 240, totals_y + 20, f"{tax_amt:,.2f}")
+    c.setFont('Helvetica-Bold', 12)
+    c.drawString(totals_x + 10, totals_y, 'Total:')
+    c.drawRightString(totals_x + 240, totals_y, f"{final_amt:,.2f}")
+
+    # Company address at bottom, below the 'Thank you' from the static layout
+    footer_y = margin + 40
+    c.setFillColor(colors.black)
+    c.setFont('Helvetica', 9)
+    addr = companyaddresspdf or ''
+    # Draw company address centered below thank you
+    addr_lines = addr.split('\n') if addr else []
+    for i, line in enumerate(addr_lines[:3]):
+        c.drawCentredString(width / 2, footer_y - (i * 12), line)
+
+    # Save
+    c.save()
+    return buffer.getvalue()
+
+
+def create_pdf_pharma(companyname, companyaddress, amount, stax, email, timestamp, canvas_module, date, final_amount, products, quantities, amount_paid=None, change=None, customername=None, customerphone=None, storage=None):
+    """Create the e-commerce invoice PDF and save it with ``storage`` (default: INVOICE_STORAGE).
+
+    Returns the stored path, or None when the storage keeps nothing on disk.
+    """
+    data = render_pdf_pharma(companyname, companyaddress, amount, stax, email, timestamp, canvas_module, date, final_amount, products, quantities, amount_paid, change, customername, customerphone)
+    started = metrics.clock()
+    path = (storage or get_invoice_storage()).save(timestamp, data)
+    metrics.record('store', started)
+    logging.info('Created enhanced e-commerce PDF: %s', path or invoice_filename(timestamp))
+    return path
+
+
+def _pharma_line_items(products, quantities, amount):
+    # (description, quantity, unit price) for each invoice row, produced lazily
+    if products is None or quantities is None or (isinstance(products, (list, tuple)) and not products):
+        # Fallback for single product if no products/quantities provided
+        try:
+            unit_price = float(amount)
+        except Exception:
+            unit_price = 0.0
+        yield 'Premium Product', 1, unit_price
+        return
+    rows = zip(products, quantities)
+    while True:
+        # Look prices up a page-sized chunk at a time so long invoices need few catalog queries
+        chunk = list(itertools.islice(rows, 500))
+        if not chunk:
+            return
+        prices = catalog.prices([prod for prod, _ in chunk])
+        for prod, qty in chunk:
+            yield prod, qty, prices[prod] or 0.0
+
+
+def _close_pharma_table(c, table_top, items_bottom):
+    # Border around the table header and the rows drawn on this page
+    width, height = letter
+    margin = 50
+    c.setStrokeColor(colors.HexColor('#E2E8F0'))
+    c.setLineWidth(0.8)
+    c.roundRect(margin, items_bottom - 8, width - 2 * margin, table_top - items_bottom + 8, 3, stroke=1, fill=0)
+
+
+def _draw_pharma_continued_header(c, company_display, timestamp, page):
+    """Start a continuation page of a long invoice; returns the y of its table header."""
+    width, height = letter
+    margin = 50
+    _draw_page_static(c, 'pharma-continued', reuse=True)
+    c.setFillColor(colors.white)
+    c.setFont('Helvetica-Bold', 14)
+    c.drawString(margin + 15, height - margin - 26, company_display)
+    c.setFont('Helvetica', 10)
+    c.drawRightString(width - margin - 10, height - margin - 26, f'Invoice #: {timestamp} (continued) - Page {page}')
+    return height - margin - 80
+
+
+def render_pdf_pharma(companyname, companyaddress, amount, stax, email, timestamp, canvas_module, date, final_amount, products, quantities, amount_paid=None, change=None, customername=None, customerphone=None):
+    """Render a modern, aesthetic booklet-style invoice PDF for e-commerce business and return its bytes.
+
+    - Gradient header with professional colors
+    - Clean white background with elegant borders
+    - Dynamic company branding
+    - Enhanced typography and spacing
+    - Subtle watermark and visual elements
+    - E-commerce specific elements like order confirmation
+    """
+    started = metrics.clock()
+    buffer = io.BytesIO()
+    c = canvas_module.Canvas(buffer, pagesize=letter, pageCompression=int(_pdf_profile()['compress']))
+    page = _draw_pharma_invoice(c, companyname, companyaddress, amount, stax, email, timestamp, date, final_amount, products,
+                                quantities, amount_paid, change, customername, customerphone)
+    metrics.record('draw', started)
+
+    # Serialize the document (fonts, images and page streams) into the buffer
+    started = metrics.clock()
+    c.save()
+    metrics.record('pdf_save', started)
+    metrics.inc('invoice_pages_total', page)
+    return buffer.getvalue()
+
+
+def _draw_pharma_invoice(c, companyname, companyaddress, amount, stax, email, timestamp, date, final_amount, products, quantities, amount_paid=None, change=None, customername=None, customerphone=None, reuse=False):
+    """Draw one e-commerce invoice onto ``c``, starting on its current page; returns the number of pages used.
+
+    The last page is left open for the caller to finish with ``showPage()`` or
+    ``save()``. Pass ``reuse=True`` when the canvas will hold several invoices,
+    so the static layout and watermark are embedded once as form XObjects.
+    """
+    width, height = letter
+    margin = 50
+
+    # Background, border, header bars, logo, bill/payment boxes and table header
+    logo_drawn = _draw_page_static(c, 'pharma', reuse=reuse)
+
+    # Dynamic company name
+    header_h = 90
+    c.setFillColor(colors.white)
+    c.setFont('Helvetica-Bold', 22)
+    name_x = margin + (140 if logo_drawn else 15)
+    company_display = companyname or 'Your E-commerce Store'
+    c.drawString(name_x, height - margin - 35, company_display)
+
+    # Invoice metadata under the title
+    c.setFont('Helvetica', 10)
+    c.setFillColor(colors.HexColor('#6B7280'))
+    c.drawRightString(width - margin - 10, height - margin - 50, f'Date: {date}')
+    c.drawRightString(width - margin - 10, height - margin - 68, f'Invoice #: {timestamp}')
+
+    # Customer details in the Bill To box
+    bill_box_y = height - margin - header_h - 50
+    c.setFont('Helvetica', 10)
+    c.setFillColor(colors.HexColor('#374151'))
+    c.drawString(margin + 12, bill_box_y - 38, customername or 'Customer Name')
+    c.drawString(margin + 12, bill_box_y - 52, customerphone or 'Customer Phone')
+
+    # Table geometry (the header row itself is part of the static layout)
+    table_top = bill_box_y - 140  # Added more space after bill box for better separation
+    header_height = 28  # 1cm height for header box (28 points ≈ 1cm)
+    gap_below_header = 4  # 0.15cm gap below header (4 points ≈ 0.15cm)
+    row_h = 20
+    col_x = [margin + 10, margin + 280, margin + 360, width - margin - 70, width - margin]
+
+    # Item rows with alternating background - start after 0.5cm gap
+    c.setFont('Helvetica', 10)
+    row_top = table_top - header_height - gap_below_header
+    line_height = 18
+    rows_floor = margin + 45  # lowest row position before continuing on a new page
+    closing_height = 275  # totals, signature and footer below the last row
+    closing_floor = margin - 5  # keeps the footer note clear of the page number
+
+    current_y = row_top
+    subtotal = 0.0
+    page = 1
+
+    def next_page():
+        # Close the table on this page, carry the running subtotal over and start a continuation page
+        nonlocal current_y, table_top, page
+        _close_pharma_table(c, table_top + header_height, current_y + line_height)
+        c.setFillColor(colors.HexColor('#6B7280'))
+        c.setFont('Helvetica-Oblique', 9)
+        c.drawRightString(col_x[3] + 30, rows_floor - 22, f"Subtotal carried forward: ${subtotal:,.2f}")
+        c.drawCentredString(width / 2, margin / 2 + 8, f'Page {page}')
+        _draw_page_overlay(c, 'pharma', reuse=reuse or page > 1)
+        c.showPage()
+        page += 1
+        table_top = _draw_pharma_continued_header(c, company_display, timestamp, page)
+        current_y = table_top - header_height - gap_below_header
+        c.setFillColor(colors.HexColor('#6B7280'))
+        c.setFont('Helvetica-Oblique', 9)
+        c.drawString(col_x[0], current_y + 2, 'Brought forward from previous page')
+        c.drawRightString(col_x[3] + 30, current_y + 2, f"${subtotal:,.2f}")
+        current_y -= line_height
+        c.setFont('Helvetica', 10)
+
+    # Rows are consumed lazily, so products/quantities may be generators of any length
+    for idx, (description, qty, unit_price) in enumerate(_pharma_line_items(products, quantities, amount)):
+        wrapped_lines = textwrap.wrap(description.strip(), width=45) or ['']
+        # Keep the wrapped lines of one item together on a page
+        if current_y - (len(wrapped_lines) - 1) * line_height - 6 < rows_floor:
+            next_page()
+
+        for i, wline in enumerate(wrapped_lines):
+            # Alternating row colors
+            if (idx + i) % 2 == 0:
+                c.setFillColor(colors.HexColor('#FAFAFA'))
+            else:
+                c.setFillColor(colors.white)
+            c.rect(margin, current_y - 6, width - 2 * margin, line_height + 4, fill=1, stroke=0)
+
+            c.setFillColor(colors.HexColor('#1F2937'))
+            c.drawString(col_x[0], current_y + 2, wline)
+
+            if i == 0:
+                line_total = round(qty * unit_price, 2)
+                subtotal += line_total
+                c.drawRightString(col_x[1] + 30, current_y + 2, str(qty))
+                c.drawRightString(col_x[2] + 30, current_y + 2, f"${unit_price:,.2f}")
+                c.drawRightString(col_x[3] + 30, current_y + 2, f"${line_total:,.2f}")
+            current_y -= line_height
+
+    # Totals, signature and footer go on the final page; start one if they do not fit
+    if current_y + line_height - closing_height < closing_floor:
+        next_page()
+
+    # Table borders
+    items_bottom = current_y + line_height
+    _close_pharma_table(c, table_top + header_height, items_bottom)
+
+    # Enhanced totals section with more space
+    try:
+        staxf = float(stax)
+    except Exception:
+        staxf = 0.0
+    tax_amt = round(subtotal * (staxf / 100.0), 2)
+    try:
+        total_amt = float(final_amount)
+    except Exception:
+        total_amt = round(subtotal + tax_amt, 2)
+
+    totals_w = 240
+    totals_h = 80
+    totals_x = width - margin - totals_w
+    totals_y = items_bottom - totals_h - 35  # Added more space after table
+
+    # Totals box with gradient
+    c.setFillColor(colors.HexColor('#F8FAFC'))
+    c.roundRect(totals_x, totals_y, totals_w, totals_h, 5, fill=1, stroke=0)
+    c.setStrokeColor(colors.HexColor('#CBD5E1'))
+    c.roundRect(totals_x, totals_y, totals_w, totals_h, 5, stroke=1, fill=0)
+
+    c.setFillColor(colors.HexColor('#374151'))
+    c.setFont('Helvetica', 10)
+    c.drawString(totals_x + 12, totals_y + 56, 'Subtotal:')
+    c.drawRightString(totals_x + totals_w - 12, totals_y + 56, f"${subtotal:,.2f}")
+    c.drawString(totals_x + 12, totals_y + 36, f'Tax ({staxf:.0f}%):')
+    c.drawRightString(totals_x + totals_w - 12, totals_y + 36, f"${tax_amt:,.2f}")
+    c.setFillColor(colors.HexColor('#10B981'))
+    c.setFont('Helvetica-Bold', 12)
+    c.drawString(totals_x + 12, totals_y + 12, 'Total:')
+    c.drawRightString(totals_x + totals_w - 12, totals_y + 12, f"${total_amt:,.2f}")
+    c.setFillColor(colors.HexColor('#374151'))
+    c.setFont('Helvetica', 10)
+    c.drawString(totals_x + 12, totals_y - 8, 'Amount Paid:')
+    c.drawRightString(totals_x + totals_w - 12, totals_y - 8, f"${amount_paid:,.2f}")
+    c.drawString(totals_x + 12, totals_y - 28, 'Change:')
+    c.drawRightString(totals_x + totals_w - 12, totals_y - 28, f"${change:,.2f}")
+
+    # Signature section with better styling
+    sig_x = margin + 20
+    sig_y = totals_y - 50
+    c.setStrokeColor(colors.HexColor('#6B7280'))
+    c.setLineWidth(1)
+    c.line(sig_x, sig_y, sig_x + 200, sig_y)
+    c.setFillColor(colors.HexColor('#6B7280'))
+    c.setFont('Helvetica', 9)
+    c.drawString(sig_x, sig_y - 15, 'Authorized Signature')
+
+    # Enhanced footer with watermark effect
+    footer_y = sig_y - 60
+
+    # Subtle watermark with logo
+    _draw_page_overlay(c, 'pharma', reuse=reuse or page > 1)
+    if page > 1:
+        c.drawCentredString(width / 2, margin / 2 + 8, f'Page {page}')
+
+    # Thank you message
+    c.setFillColor(colors.HexColor('#10B981'))
+    c.setFont('Helvetica-Bold', 14)
+    c.drawCentredString(width / 2, footer_y + 25, 'Thank you for shopping with us!')
+
+    # Company address
+    c.setFillColor(colors.HexColor('#6B7280'))
+    c.setFont('Helvetica', 9)
+    addr_lines = (companyaddress or '').split('\n') if companyaddress else []
+    for i, line in enumerate(addr_lines[:3]):
+        c.drawCentredString(width / 2, footer_y - (i * 12), line)
+
+    # E-commerce footer note
+    c.setFont('Helvetica', 8)
+    c.setFillColor(colors.HexColor('#9CA3AF'))
+    c.drawCentredString(width / 2, footer_y - 50, 'For any queries, please contact our customer support team.')
+    return page
+
+
+# Column order used for every insert into the invoices table
+INVOICE_COLUMNS = ('Company_Name', 'Company_Address', 'Email_ID', 'Amount', 'Final_Amount', 'Product', 'Amount_Paid', 'Change', 'Invoice_Number', 'Created_At')
+
+
+def _insert_invoice_records(records):
+    """Insert invoice records (dicts keyed by INVOICE_COLUMNS) with one executemany and a single commit."""
+    if not records:
+        return
+    columns = ', '.join(f'`{col}`' for col in INVOICE_COLUMNS)
+    placeholders = ', '.join(['%s'] * len(INVOICE_COLUMNS))
+    # Change is a reserved word in MySQL, so every column name is quoted
+    sql = f"INSERT INTO `{DB_TABLE}` ({columns}) VALUES ({placeholders})"
+    # Borrow a pooled connection instead of paying a TCP + auth handshake per invoice
+    with get_db_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [tuple(record[col] for col in INVOICE_COLUMNS) for record in records])
+            _insert_invoice_items(cursor, records)
+            _update_revenue_rollups(cursor, records)
+        connection.commit()
+
+
+def _insert_invoice_items(cursor, records):
+    # Line items of just-inserted invoices, in the same transaction: one query maps invoice
+    # numbers to row ids, then one executemany (a multi-row INSERT under pymysql) adds the items
+    numbered = {record['Invoice_Number']: record['items'] for record in records
+                if record.get('items') and record.get('Invoice_Number')}
+    if not numbered:
+        return
+    ids = {}
+    numbers = list(numbered)
+    for i in range(0, len(numbers), 500):
+        chunk = numbers[i:i + 500]
+        cursor.execute(f"SELECT `id`, `Invoice_Number` FROM `{DB_TABLE}` "
+                       f"WHERE `Invoice_Number` IN ({', '.join(['%s'] * len(chunk))})", chunk)
+        ids.update((row['Invoice_Number'], row['id']) for row in cursor.fetchall())
+    rows = [(ids[number], line_no, product, quantity, unit_price, round(quantity * unit_price, 2))
+            for number, items in numbered.items()
+            for line_no, (product, quantity, unit_price) in enumerate(items, 1)]
+    cursor.executemany("INSERT INTO `invoice_items` (`invoice_id`, `line_no`, `product`, `quantity`, `unit_price`, "
+                       "`line_total`) VALUES (%s, %s, %s, %s, %s, %s)", rows)
+
+
+# Rollup periods: name -> length of the Created_At prefix that identifies a bucket
+ROLLUP_PERIODS = {'day': 10, 'month': 7}
+ROLLUP_FIELDS = ('invoices', 'revenue', 'tax', 'total', 'amount_paid', 'change')
+
+
+def _rollup_amount(value):
+    # Record values are text and may be 'None' when a field was not given
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _update_revenue_rollups(cursor, records):
+    # Add just-inserted invoices to their day and month buckets, in the same transaction
+    sums = {}
+    for record in records:
+        revenue = _rollup_amount(record['Amount'])
+        total = _rollup_amount(record['Final_Amount'])
+        values = (1, revenue, total - revenue, total, _rollup_amount(record['Amount_Paid']), _rollup_amount(record['Change']))
+        for period, length in ROLLUP_PERIODS.items():
+            key = (period, record['Created_At'][:length], record['Company_Name'])
+            sums[key] = [a + b for a, b in zip(sums.get(key, (0,) * len(values)), values)]
+    if not sums:
+        return
+    columns = ', '.join(f'`{col}`' for col in ROLLUP_FIELDS)
+    if DB_BACKEND == 'sqlite':
+        update = 'ON CONFLICT (`period`, `bucket`, `company`) DO UPDATE SET ' + ', '.join(
+            f'`{col}` = `{col}` + excluded.`{col}`' for col in ROLLUP_FIELDS)
+    else:
+        update = 'ON DUPLICATE KEY UPDATE ' + ', '.join(f'`{col}` = `{col}` + VALUES(`{col}`)' for col in ROLLUP_FIELDS)
+    cursor.executemany(f"INSERT INTO `revenue_rollups` (`period`, `bucket`, `company`, {columns}) "
+                       f"VALUES ({', '.join(['%s'] * (3 + len(ROLLUP_FIELDS)))}) {update}",
+                       [key + tuple(round(v, 2) for v in values) for key, values in sorted(sums.items())])
+
+
+def _rebuild_revenue_rollups(cursor, since=None):
+    # Recompute the rollups from the invoices table, from the month containing ``since`` ('YYYY-MM-DD') onwards
+    where = ''
+    params = []
+    if since:
+        month = since[:7]
+        cursor.execute("DELETE FROM `revenue_rollups` WHERE `bucket` >= %s", (month,))
+        where = 'WHERE `Created_At` >= %s'
+        params = [month + '-01 00:00:00']
+    else:
+        cursor.execute("DELETE FROM `revenue_rollups`")
+    for period, length in ROLLUP_PERIODS.items():
+        cursor.execute(f"INSERT INTO `revenue_rollups` (`period`, `bucket`, `company`, "
+                       f"{', '.join(f'`{col}`' for col in ROLLUP_FIELDS)}) "
+                       f"SELECT %s, SUBSTR(`Created_At`, 1, {length}), COALESCE(`Company_Name`, ''), COUNT(*), "
+                       "COALESCE(SUM(`Amount`), 0), COALESCE(SUM(`Final_Amount` - `Amount`), 0), "
+                       "COALESCE(SUM(`Final_Amount`), 0), COALESCE(SUM(`Amount_Paid`), 0), COALESCE(SUM(`Change`), 0) "
+                       f"FROM `{DB_TABLE}` {where} GROUP BY SUBSTR(`Created_At`, 1, {length}), COALESCE(`Company_Name`, '')",
+                       [period] + params)
+
+
+def rebuild_revenue_rollups(since=None):
+    """Recompute revenue_rollups from the invoices table in one transaction.
+
+    With ``since`` ('YYYY-MM-DD') only buckets from that month onwards are
+    replaced. Invoices inserted while the rebuild runs may be counted twice
+    or missed, so run it while writes are paused.
+    """
+    if since:
+        since = datetime.datetime.strptime(since, '%Y-%m-%d').strftime('%Y-%m-%d')
+    with get_db_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            _rebuild_revenue_rollups(cursor, since)
+        connection.commit()
+
+
+def revenue_report(period='day', start=None, end=None, company=None):
+    """Rows of totals per ``period`` bucket between the days ``start`` and ``end`` (inclusive), from the rollups.
+
+    Without ``company`` the buckets add up every company. Raises ValueError for
+    an unknown period or malformed dates.
+    """
+    if period not in ROLLUP_PERIODS:
+        raise ValueError('period must be day or month')
+    length = ROLLUP_PERIODS[period]
+    conditions = ['`period` = %s']
+    params = [period]
+    for value, op in ((start, '>='), (end, '<=')):
+        if value:
+            day = datetime.datetime.strptime(value.strip(), '%Y-%m-%d').strftime('%Y-%m-%d')
+            conditions.append(f'`bucket` {op} %s')
+            params.append(day[:length])
+    if company:
+        conditions.append('`company` = %s')
+        params.append(company)
+    sums = ', '.join(f'SUM(`{col}`) AS `{col}`' for col in ROLLUP_FIELDS)
+    with get_db_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT `bucket`, {sums} FROM `revenue_rollups` WHERE {' AND '.join(conditions)} "
+                           "GROUP BY `bucket` ORDER BY `bucket`", params)
+            rows = cursor.fetchall()
+    return [dict({'bucket': row['bucket'], 'invoices': int(row['invoices'])},
+                 **{col: round(float(row[col]), 2) for col in ROLLUP_FIELDS[1:]}) for row in rows]
+
+
+def _invoice_items(invoice):
+    # [product, quantity, unit price] per line, as stored in invoice_items (JSON-friendly for the spill file)
+    prices = invoice.get('unit_prices') or {}
+    return [[product, quantity, prices.get(product) or 0.0]
+            for product, quantity in zip(invoice['products'], invoice['quantities'])]
+
+
+def backfill_invoice_items(batch_size=1000):
+    """Create invoice_items rows for invoices stored before the table existed; returns the count of invoices.
+
+    Older rows only kept a comma-separated product list, so quantities and
+    line totals are left NULL unless the invoice had a single product whose
+    quantity follows exactly from its amount. Unit prices come from the
+    catalog. Runs in batches ordered by id and can be interrupted and re-run.
+    """
+    done = 0
+    last_id = 0
+    while True:
+        with get_db_pool().connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT i.`id`, i.`Product`, i.`Amount` FROM `{DB_TABLE}` i "
+                               "WHERE i.`id` > %s AND NOT EXISTS "
+                               "(SELECT 1 FROM `invoice_items` t WHERE t.`invoice_id` = i.`id`) "
+                               "ORDER BY i.`id` LIMIT %s", (last_id, batch_size))
+                invoices = cursor.fetchall()
+                if not invoices:
+                    return done
+                rows = []
+                for invoice in invoices:
+                    summary = invoice['Product'] or ''
+                    products = [] if summary == 'No products' else [p.strip() for p in summary.split(',') if p.strip()]
+                    prices = catalog.prices(products)
+                    for line_no, product in enumerate(products, 1):
+                        quantity = line_total = None
+                        price = prices.get(product)
+                        if len(products) == 1 and price:
+                            try:
+                                amount = float(invoice['Amount'])
+                            except (TypeError, ValueError):
+                                amount = None
+                            if amount is not None and abs(amount / price - round(amount / price)) < 1e-6:
+                                quantity = int(round(amount / price))
+                                line_total = round(amount, 2)
+                        rows.append((invoice['id'], line_no, product, quantity, price, line_total))
+                if rows:
+                    cursor.executemany("INSERT INTO `invoice_items` (`invoice_id`, `line_no`, `product`, `quantity`, "
+                                       "`unit_price`, `line_total`) VALUES (%s, %s, %s, %s, %s, %s)", rows)
+            connection.commit()
+        done += len(invoices)
+        last_id = invoices[-1]['id']
+        logging.info('Backfilled line items for %d invoice(s)', done)
+
+
+# Failures caused by the records themselves (duplicate numbers, bad values, malformed spill
+# lines): retrying the same rows cannot succeed, so the writer isolates and sets them aside
+_REJECTED_RECORD_ERRORS = (pymysql.err.IntegrityError, pymysql.err.DataError, sqlite3.IntegrityError,
+                           sqlite3.DataError, KeyError, TypeError, ValueError)
+
+
+class InvoiceWriter:
+    """Background writer that batches queued invoice records into group commits.
+
+    ``submit`` applies backpressure by blocking while the in-memory queue is
+    full; if a spill file is configured, records that still do not fit are
+    appended to it and replayed once the queue drains. Batches that fail with
+    a connection or server error are retried, then spilled (or logged and
+    dropped when no spill file is configured). A batch the database rejects
+    because of its data is split in halves until the offending records are
+    found; only those are written to the dead-letter file (or logged), the
+    rest are inserted. Delivery is at-least-once across crashes while a spill
+    file is being replayed; rows replayed twice are dead-lettered as duplicates.
+    """
+
+    def __init__(self, write_records, max_queue=10000, batch_size=500, max_latency=0.5,
+                 enqueue_timeout=2.0, spill_path=None, max_retries=3, dead_letter_path=None):
+        self._write_records = write_records
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.enqueue_timeout = enqueue_timeout
+        self.spill_path = spill_path or None
+        self.dead_letter_path = dead_letter_path or None
+        self.max_retries = max_retries
+        self._spill_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._stats = collections.Counter()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='invoice-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, record):
+        if self._stopping.is_set():
+            raise RuntimeError('invoice writer is shut down')
+        try:
+            self._queue.put(record, timeout=self.enqueue_timeout)
+        except queue.Full:
+            if not self.spill_path:
+                self._stats['rejected'] += 1
+                raise
+            self._spill([record])
+            return
+        self._stats['enqueued'] += 1
+
+    def stop(self, timeout=30.0):
+        """Stop accepting records and flush everything already queued."""
+        if self._thread is None or self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['spill_pending'] = bool(self.spill_path and (os.path.exists(self.spill_path) or os.path.exists(self.spill_path + '.draining')))
+        return stats
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+            elif self._stopping.is_set():
+                break
+            else:
+                self._drain_spill()
+        self._drain_spill()
+
+    def _next_batch(self):
+        # Block for the first record, then keep collecting until the batch is full or max_latency elapses
+        try:
+            batch = [self._queue.get(timeout=self.max_latency)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        """Write ``batch``; returns False if records had to be spilled or dropped."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._write_records(batch)
+                self._stats['written'] += len(batch)
+                self._stats['batches'] += 1
+                return True
+            except _REJECTED_RECORD_ERRORS as e:
+                self._stats['failures'] += 1
+                metrics.inc('invoice_db_errors_total', kind='write_behind_rejected')
+                if len(batch) == 1:
+                    self._dead_letter(batch[0], e)
+                    return True
+                # Bisect: the good halves are written, the offending records end up alone
+                logging.warning('Write-behind batch of %d invoice(s) rejected (%s); splitting it', len(batch), e)
+                middle = len(batch) // 2
+                left = self._flush(batch[:middle])
+                return self._flush(batch[middle:]) and left
+            except Exception:
+                self._stats['failures'] += 1
+                metrics.inc('invoice_db_errors_total', kind='write_behind')
+                logging.exception('Write-behind batch of %d invoice(s) failed (attempt %d)', len(batch), attempt + 1)
+                if self._stopping.is_set():
+                    break
+                time.sleep(min(0.1 * (2 ** attempt), 5.0))
+        if self.spill_path:
+            self._spill(batch)
+        else:
+            self._stats['dropped'] += len(batch)
+            logging.error('Dropped %d invoice record(s) after repeated database failures', len(batch))
+        return False
+
+    def _dead_letter(self, record, error):
+        self._stats['dead_lettered'] += 1
+        if not self.dead_letter_path:
+            logging.error('Database rejected invoice record %s: %s', json.dumps(record), error)
+            return
+        logging.error('Database rejected invoice record %s: %s (moved to %s)', record.get('Invoice_Number'), error, self.dead_letter_path)
+        with self._spill_lock:
+            with open(self.dead_letter_path, 'a', encoding='utf-8') as fh:
+                fh.write(json.dumps(dict(record, error=str(error))) + '\n')
+
+    def _spill(self, records):
+        with self._spill_lock:
+            with open(self.spill_path, 'a', encoding='utf-8') as fh:
+                for record in records:
+                    fh.write(json.dumps(record) + '\n')
+        self._stats['spilled'] += len(records)
+
+    def _drain_spill(self):
+        # Replay spilled records once the in-memory queue has room again
+        if not self.spill_path:
+            return
+        draining = self.spill_path + '.draining'
+        with self._spill_lock:
+            if not os.path.exists(draining):
+                if not os.path.exists(self.spill_path):
+                    return
+                os.replace(self.spill_path, draining)
+        failed = False
+        with open(draining, encoding='utf-8') as fh:
+            batch = []
+            for line in fh:
+                if line.strip():
+                    try:
+                        batch.append(json.loads(line))
+                    except ValueError as e:
+                        # A line torn by a crash mid-write; keep it for inspection instead of replaying it forever
+                        self._dead_letter({'line': line.rstrip('\n')}, e)
+                        continue
+                if len(batch) >= self.batch_size:
+                    failed |= not self._flush(batch)
+                    batch = []
+            if batch:
+                failed |= not self._flush(batch)
+        # Failed batches were re-spilled by _flush, so the draining file can go either way
+        os.remove(draining)
+        if failed:
+            time.sleep(self.max_latency)
+
+
+_invoice_writer = None
+_invoice_writer_lock = threading.Lock()
+
+
+def get_invoice_writer():
+    """Return the process-wide write-behind writer, starting it on first use."""
+    global _invoice_writer
+    if _invoice_writer is None:
+        with _invoice_writer_lock:
+            if _invoice_writer is None:
+                writer = InvoiceWriter(_insert_invoice_records, max_queue=DB_WRITE_QUEUE_SIZE,
+                                       batch_size=DB_WRITE_BATCH_SIZE, max_latency=DB_WRITE_MAX_LATENCY,
+                                       enqueue_timeout=DB_WRITE_ENQUEUE_TIMEOUT, spill_path=DB_WRITE_SPILL_PATH,
+                                       dead_letter_path=DB_WRITE_DEAD_LETTER_PATH)
+                _invoice_writer = writer.start()
+                # Flush whatever is still queued when the process exits cleanly
+                atexit.register(writer.stop)
+    return _invoice_writer
+
+
+def _invoice_record(companyname, companyaddress, amount, email, finalstax, product, amount_paid=None, change=None, invoice_number=None, items=None):
+    # Row for the invoices table, keyed by INVOICE_COLUMNS, plus its line items for invoice_items
+    created_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    record = dict(zip(INVOICE_COLUMNS, (str(companyname), str(companyaddress), str(email), str(amount), str(finalstax), str(product), str(amount_paid), str(change), invoice_number, created_at)))
+    if items:
+        record['items'] = items
+    return record
+
+
+# addtodatabase function to add data to a mysql database
+def addtodatabase(companynamedatabase, companyaddressdatabase, amountdatabase, emaildatabase, finalstaxdatabase, productdatabase, amount_paid=None, change=None, invoice_number=None, items=None):
+    # Connect to the database
+    # Skip DB insert if environment variables not set
+    if not (DB_USER and DB_NAME and DB_TABLE):
+        logging.warning('Database credentials/table not set in environment - skipping DB insert')
+        return
+
+    record = _invoice_record(companynamedatabase, companyaddressdatabase, amountdatabase, emaildatabase, finalstaxdatabase, productdatabase, amount_paid, change, invoice_number, items)
+    started = metrics.clock()
+    try:
+        if DB_WRITE_BEHIND:
+            try:
+                # Queue the row; the background writer inserts it with the next batch
+                get_invoice_writer().submit(record)
+                return
+            except queue.Full:
+                # No room and no spill file: insert this row directly rather than lose it
+                metrics.inc('invoice_db_errors_total', kind='queue_full')
+                logging.warning('Write-behind queue is full - inserting the invoice record directly')
+        _insert_invoice_records([record])
+        logging.info('Inserted record into DB table %s', DB_TABLE)
+    except Exception:
+        metrics.inc('invoice_db_errors_total', kind='insert')
+        logging.exception('Failed to insert into database')
+    finally:
+        metrics.record('db', started)
+
+
+def _invoice_from_mapping(data):
+    """Build a normalized invoice dict from form fields or a JSON object.
+
+    Line items come either from an ``items`` list of ``{"product", "quantity"}``
+    objects (JSON) or from the ``Product{i}``/``Quantity{i}`` form fields; there
+    is no limit on their number, long invoices continue over several pages.
+    """
+    def text(key):
+        return str(data.get(key) or '').strip()
+
+    def number(key):
+        try:
+            return float(text(key) or 0)
+        except Exception:
+            return 0.0
+
+    # Collect products and quantities
+    if isinstance(data.get('items'), list):
+        pairs = [(str(item.get('product') or '').strip(), str(item.get('quantity') or '0').strip())
+                 for item in data['items'] if isinstance(item, dict)]
+    else:
+        # Any number of numbered Product{i} fields, in numeric order (gaps are allowed)
+        numbers = sorted({int(key[7:]) for key in data.keys() if key.startswith('Product') and key[7:].isdigit()})
+        pairs = [(text(f'Product{i}'), text(f'Quantity{i}') or '0') for i in numbers]
+    products = []
+    quantities = []
+    for product, quantity_raw in pairs:
+        if product and quantity_raw:
+            try:
+                quantity = int(float(quantity_raw))
+                if quantity > 0:
+                    products.append(product)
+                    quantities.append(quantity)
+            except Exception:
+                pass
+
+    return {
+        'companyname': text('CompanyName'),
+        'companyaddress': text('CompanyAddress'),
+        'customername': text('CustomerName'),
+        'customerphone': text('CustomerPhone'),
+        'email': text('Email'),
+        'stax': number('STax'),
+        'amount_paid': number('AmountPaid'),
+        'products': products,
+        'quantities': quantities,
+        'date': time.strftime("%d/%m/%Y"),
+        # Allocated once the invoice is accepted (see allocate_invoice_number)
+        'number': None,
+    }
+
+
+def _price_invoice(invoice):
+    # Calculate total amount based on the catalog prices (one cache lookup for all line items)
+    prices = catalog.prices(invoice['products'])
+    unknown = sorted(name for name, price in prices.items() if price is None)
+    if unknown:
+        raise UnknownProduct('unknown product(s): ' + ', '.join(unknown))
+    total_amount = 0.0
+    for prod, qty in zip(invoice['products'], invoice['quantities']):
+        total_amount += qty * prices[prod]
+    invoice['unit_prices'] = prices
+    finalstax = total_amount + (total_amount * (invoice['stax'] / 100))
+    invoice['total_amount'] = total_amount
+    invoice['finalstax'] = finalstax
+    # Calculate change
+    invoice['change'] = invoice['amount_paid'] - finalstax
+    return invoice
+
+
+def _render_invoice(invoice, persistent=False, return_bytes=False):
+    """Render an invoice and save it to the configured storage; returns the path (and bytes if asked).
+
+    Module-level so process pool workers can run it.
+    """
+    # Render workers reuse the prices looked up when the invoice was priced
+    catalog.prime(invoice.get('unit_prices', {}))
+    # Use the pharmaceutical-styled invoice generator
+    data = render_pdf_pharma(invoice['companyname'], invoice['companyaddress'], str(invoice['total_amount']), str(invoice['stax']),
+                             invoice['email'], invoice['number'], canvas, invoice['date'], str(invoice['finalstax']),
+                             invoice['products'], invoice['quantities'], invoice['amount_paid'], invoice['change'],
+                             invoice['customername'], invoice['customerphone'])
+    started = metrics.clock()
+    path = get_invoice_storage(persistent).save(invoice['number'], data)
+    metrics.record('store', started)
+    logging.info('Created enhanced e-commerce PDF: %s', path or invoice_filename(invoice['number']))
+    return (path, data) if return_bytes else path
+
+
+def _product_summary(invoice):
+    # For database, store a summary of products
+    return ', '.join(invoice['products']) if invoice['products'] else 'No products'
+
+
+def _store_invoice(invoice):
+    try:
+        addtodatabase(invoice['companyname'], invoice['companyaddress'], invoice['total_amount'], invoice['email'],
+                      invoice['finalstax'], _product_summary(invoice), invoice['amount_paid'], invoice['change'], invoice['number'],
+                      _invoice_items(invoice))
+    except Exception as db_e:
+        logging.warning('Database insertion failed: %s', str(db_e))
+
+
+class RenderQueue:
+    """Render invoices on a process pool and track them as jobs.
+
+    ``submit`` returns a job id immediately; the PDF is drawn in a worker
+    process (sidestepping the GIL) and the database row is written from the
+    parent once rendering succeeds. That write, and queueing the email, run
+    on ``finish_threads`` threads rather than on the pool's result thread,
+    so one slow insert does not hold up every other finished job. Only the
+    most recent ``max_jobs`` jobs are remembered.
+
+    Workers are started by a fork server (or spawned where there is none)
+    rather than forked from this process: by the time the pool exists the
+    web process runs threads, and a forked child could inherit one of their
+    locks (metrics, manifest, catalog) while it is held.
+    """
+
+    def __init__(self, workers=None, max_jobs=10000, finish_threads=4):
+        self.workers = workers or os.cpu_count() or 1
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        self._finisher = concurrent.futures.ThreadPoolExecutor(max_workers=finish_threads, thread_name_prefix='render-finish')
+        self.max_jobs = max_jobs
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, invoice):
+        job_id = uuid.uuid4().hex
+        # Jobs are polled later, so their PDFs must be kept even in 'direct' storage mode
+        future = self._executor.submit(_render_invoice, invoice, True)
+        # Complete before it is published: status() may read it as soon as it is in _jobs
+        job = {'id': job_id, 'status': 'queued', 'invoice': invoice['number'], 'path': None, 'error': None,
+               'submitted_at': time.time(), 'finished_at': None, 'future': future}
+        with self._lock:
+            self._jobs[job_id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        future.add_done_callback(lambda f: self._hand_off(job, invoice, f))
+        return job_id
+
+    def _hand_off(self, job, invoice, future):
+        # Runs on the pool's result thread: pass the slow part on, unless the finisher is already closed
+        try:
+            self._finisher.submit(self._finish, job, invoice, future)
+        except RuntimeError:
+            # Shutting down (or the interpreter exiting): finish here so the row and email are not lost
+            self._finish(job, invoice, future)
+
+    def _finish(self, job, invoice, future):
+        try:
+            job['path'] = future.result()
+            _store_invoice(invoice)
+            queue_invoice_email(invoice)
+        except Exception as e:
+            logging.error('Render job %s failed: %s', job['id'], e)
+            job['error'] = str(e)
+            job['status'] = 'failed'
+        else:
+            job['status'] = 'done'
+            logging.info('Render job %s finished: %s', job['id'], job['path'])
+        job['finished_at'] = time.time()
+
+    def render_many(self, items, window=None):
+        """Render ``(key, invoice)`` pairs in parallel, yielding ``(key, invoice, (path, pdf_bytes), error)`` as each completes.
+
+        At most ``window`` renders are in flight, so arbitrarily long inputs are
+        consumed lazily. Rendered invoices are not written to the database.
+        """
+        window = window or 4 * self.workers
+        items = iter(items)
+        pending = {}
+        while True:
+            for key, invoice in items:
+                pending[self._executor.submit(_render_invoice, invoice, return_bytes=True)] = (key, invoice)
+                if len(pending) >= window:
+                    break
+            if not pending:
+                return
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                key, invoice = pending.pop(future)
+                try:
+                    yield key, invoice, future.result(), None
+                except Exception as e:
+                    yield key, invoice, None, e
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        status = job['status']
+        # A rendered job stays 'running' until its row is stored
+        if status == 'queued' and (job['future'].running() or job['future'].done()):
+            status = 'running'
+        return dict({key: job[key] for key in ('id', 'invoice', 'path', 'error', 'submitted_at', 'finished_at')}, status=status)
+
+    def shutdown(self, wait=True):
+        # Drain the renders first: their callbacks still hand work to the finisher
+        self._executor.shutdown(wait=wait)
+        self._finisher.shutdown(wait=wait)
+
+
+_render_queue = None
+_render_queue_lock = threading.Lock()
+
+
+def get_render_queue():
+    """Return the process-wide render queue, creating its worker pool on first use."""
+    global _render_queue
+    if _render_queue is None:
+        with _render_queue_lock:
+            if _render_queue is None:
+                _render_queue = RenderQueue(workers=RENDER_WORKERS, max_jobs=RENDER_MAX_JOBS)
+                atexit.register(_render_queue.shutdown)
+    return _render_queue
+
+
+def _smtp_connect():
+    if SMTP_SECURITY == 'ssl':
+        smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+    else:
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        if SMTP_SECURITY == 'starttls':
+            smtp.starttls()
+    if SMTP_USER:
+        smtp.login(SMTP_USER, SMTP_PASSWORD)
+    return smtp
+
+
+def _invoice_email(row):
+    """Build the message for an outbox row, attaching the stored PDF of its invoice."""
+    number = row['invoice_number']
+    pdf = read_invoice_pdf(number)
+    if pdf is None:
+        raise FileNotFoundError(f'no stored PDF for invoice {number}')
+    message = EmailMessage()
+    message['From'] = EMAIL_FROM
+    message['To'] = row['recipient']
+    message['Subject'] = f'Invoice {number}'
+    message['Date'] = formatdate(localtime=True)
+    # Stable per outbox row, so a message re-sent after a crash can be recognized as a duplicate
+    message['Message-ID'] = f"<invoice-{number}-{row['id']}@{EMAIL_FROM.rpartition('@')[2] or 'localhost'}>"
+    message.set_content(f'Dear customer,\n\nplease find attached invoice {number}.\n\nThank you for shopping with us!\n')
+    message.add_attachment(pdf, maintype='application', subtype='pdf', filename=invoice_filename(number))
+    return message
+
+
+def _permanent_smtp_error(error):
+    # Rejections of the message itself (5xx) will not succeed on a retry; connection and server trouble might
+    if isinstance(error, FileNotFoundError):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPDataError) and error.smtp_code >= 500
+
+
+class EmailSender:
+    """Background sender for the ``email_outbox`` table.
+
+    Due messages are claimed in batches with a per-claim token, so several
+    processes can share one outbox, and sent over a single SMTP connection
+    kept open between messages: it is replaced after ``max_per_connection``
+    messages, after ``idle_close`` seconds without use, or when the server
+    drops it. Sending is paced to ``rate`` messages per second. Temporary
+    failures are retried with exponential backoff up to ``max_attempts``;
+    permanent rejections fail the message at once. A claimed message whose
+    process dies is claimed again when its lease runs out, so delivery is
+    at-least-once.
+    """
+
+    LEASE = 300.0  # seconds a claimed message is reserved for its sender
+
+    def __init__(self, connect, build_message, rate=5.0, max_attempts=8, retry_delay=30.0, idle_close=60.0,
+                 max_per_connection=100, batch_size=50, poll=5.0):
+        self._connect = connect
+        self._build_message = build_message
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.idle_close = idle_close
+        self.max_per_connection = max_per_connection
+        self.batch_size = batch_size
+        self.poll = poll
+        self._smtp = None
+        self._smtp_messages = 0
+        self._smtp_used_at = 0.0
+        self._next_send_at = 0.0
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._stats = collections.Counter()
+        self._sent_times = collections.deque(maxlen=10000)
+        self._last_error = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='email-sender', daemon=True)
+            self._thread.start()
+        return self
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self, timeout=30.0):
+        """Finish the message being sent, then close the SMTP connection."""
+        if self._thread is None:
+            self._close()
+            return
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                sent = self.run_once()
+            except Exception:
+                self._stats['errors'] += 1
+                logging.exception('Email sender failed; retrying in %.0fs', self.poll)
+                sent = 0
+            if not sent:
+                if self._smtp is not None and time.monotonic() - self._smtp_used_at >= self.idle_close:
+                    self._close()
+                self._wake.wait(self.poll)
+                self._wake.clear()
+        self._close()
+
+    def run_once(self):
+        """Claim and send one batch of due messages; returns how many were claimed."""
+        rows = self._claim()
+        for row in rows:
+            if self._stopping.is_set():
+                # Hand unsent messages back instead of waiting for their lease to expire
+                self._finish(row, release=True)
+                continue
+            try:
+                self._send(self._build_message(row))
+            except Exception as e:
+                self._failed(row, e)
+            else:
+                self._finish(row)
+        return len(rows)
+
+    def _claim(self):
+        now = time.time()
+        token = uuid.uuid4().hex
+        with get_db_pool().connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT `id` FROM `email_outbox` WHERE `status` IN ('pending', 'sending') "
+                               "AND `next_attempt_at` <= %s ORDER BY `next_attempt_at` LIMIT %s", (now, self.batch_size))
+                ids = [row['id'] for row in cursor.fetchall()]
+                if not ids:
+                    return []
+                # The status/time condition is checked again, so only one process wins each row
+                cursor.execute(f"UPDATE `email_outbox` SET `status` = 'sending', `claim` = %s, `attempts` = `attempts` + 1, "
+                               f"`next_attempt_at` = %s WHERE `id` IN ({', '.join(['%s'] * len(ids))}) "
+                               "AND `status` IN ('pending', 'sending') AND `next_attempt_at` <= %s",
+                               [token, now + self.LEASE] + ids + [now])
+                cursor.execute("SELECT `id`, `invoice_number`, `recipient`, `attempts` FROM `email_outbox` "
+                               "WHERE `claim` = %s ORDER BY `id`", (token,))
+                rows = cursor.fetchall()
+            connection.commit()
+        return rows
+
+    def _update(self, row, sql, params):
+        with get_db_pool().connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f"UPDATE `email_outbox` SET {sql} WHERE `id` = %s", list(params) + [row['id']])
+            connection.commit()
+
+    def _finish(self, row, release=False):
+        if release:
+            self._update(row, "`status` = 'pending', `claim` = NULL, `attempts` = `attempts` - 1, `next_attempt_at` = %s",
+                         (time.time(),))
+            return
+        self._update(row, "`status` = 'sent', `claim` = NULL, `last_error` = NULL, `sent_at` = %s",
+                     (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+        self._stats['sent'] += 1
+        self._sent_times.append(time.monotonic())
+        metrics.inc('invoice_emails_sent_total')
+
+    def _failed(self, row, error):
+        self._last_error = f'{type(error).__name__}: {error}'
+        permanent = _permanent_smtp_error(error)
+        if permanent or row['attempts'] >= self.max_attempts:
+            kind = 'permanent' if permanent else 'exhausted'
+            self._update(row, "`status` = 'failed', `claim` = NULL, `last_error` = %s", (self._last_error[:1000],))
+            self._stats['failed'] += 1
+            metrics.inc('invoice_email_failures_total', kind=kind)
+            logging.error('Giving up on email %s for invoice %s to %s: %s', row['id'], row['invoice_number'],
+                          row['recipient'], self._last_error)
+            return
+        delay = min(self.retry_delay * 2 ** (row['attempts'] - 1), 3600.0)
+        self._update(row, "`status` = 'pending', `claim` = NULL, `last_error` = %s, `next_attempt_at` = %s",
+                     (self._last_error[:1000], time.time() + delay))
+        self._stats['retried'] += 1
+        metrics.inc('invoice_email_failures_total', kind='retry')
+        logging.warning('Email %s for invoice %s failed (attempt %d), retrying in %.0fs: %s', row['id'],
+                        row['invoice_number'], row['attempts'], delay, self._last_error)
+
+    def _send(self, message):
+        # Pace messages to the configured rate
+        wait = self._next_send_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self._next_send_at = max(self._next_send_at, time.monotonic()) + self.interval
+        started = time.perf_counter()
+        try:
+            self._connection().send_message(message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # The server closed an idle connection: reconnect once and resend
+            self._close()
+            self._connection().send_message(message)
+        self._smtp_messages += 1
+        self._smtp_used_at = time.monotonic()
+        metrics.observe('invoice_email_send_seconds', time.perf_counter() - started)
+
+    def _connection(self):
+        if self._smtp is not None and self._smtp_messages >= self.max_per_connection:
+            self._close()
+        if self._smtp is None:
+            self._smtp = self._connect()
+            self._smtp_messages = 0
+            self._stats['connections'] += 1
+            metrics.inc('invoice_smtp_connections_total')
+        return self._smtp
+
+    def _close(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except Exception:
+                smtp.close()
+
+    def stats(self):
+        stats = dict(self._stats)
+        now = time.monotonic()
+        recent = sum(1 for sent_at in self._sent_times if now - sent_at <= 60.0)
+        stats['sent_per_sec_1m'] = round(recent / 60.0, 3)
+        stats['messages_per_connection'] = round(stats.get('sent', 0) / stats['connections'], 1) if stats.get('connections') else None
+        stats['connected'] = self._smtp is not None
+        stats['last_error'] = self._last_error
+        return stats
+
+
+_email_sender = None
+_email_sender_lock = threading.Lock()
+
+
+def get_email_sender():
+    """Return the process-wide email sender, starting its thread on first use."""
+    global _email_sender
+    if _email_sender is None:
+        with _email_sender_lock:
+            if _email_sender is None:
+                sender = EmailSender(_smtp_connect, _invoice_email, rate=EMAIL_RATE, max_attempts=EMAIL_MAX_ATTEMPTS,
+                                     retry_delay=EMAIL_RETRY_DELAY, idle_close=EMAIL_IDLE_CLOSE,
+                                     max_per_connection=EMAIL_MESSAGES_PER_CONNECTION)
+                _email_sender = sender.start()
+                atexit.register(sender.stop)
+    return _email_sender
+
+
+def email_outbox_depth():
+    # Number of outbox messages per status
+    with get_db_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT `status`, COUNT(*) AS `n` FROM `email_outbox` GROUP BY `status`")
+            return {row['status']: int(row['n']) for row in cursor.fetchall()}
+
+
+def queue_invoice_email(invoice, pdf=None):
+    """Add an email with the invoice's PDF for its customer to the outbox (when SMTP_HOST is set).
+
+    Pass the rendered ``pdf`` bytes when the configured storage kept no copy
+    ('direct'); the sender reads the attachment from storage, so one is saved.
+    Failures are logged: a lost email never fails the invoice itself.
+    """
+    recipient = parseaddr(invoice.get('email') or '')[1]
+    if not SMTP_HOST or '@' not in recipient:
+        return
+    try:
+        if pdf is not None:
+            get_invoice_storage(persistent=True).save(invoice['number'], pdf)
+        with get_db_pool().connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("INSERT INTO `email_outbox` (`invoice_number`, `recipient`, `status`, `attempts`, "
+                               "`next_attempt_at`, `created_at`) VALUES (%s, %s, 'pending', 0, %s, %s)",
+                               (invoice['number'], recipient, time.time(), datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            connection.commit()
+    except Exception:
+        metrics.inc('invoice_email_failures_total', kind='queue')
+        logging.exception('Could not queue the email for invoice %s', invoice['number'])
+        return
+    if EMAIL_WORKER:
+        get_email_sender().wake()
+
+
+class IdempotencyConflict(Exception):
+    """Raised when an Idempotency-Key is reused with different invoice data."""
+
+
+class IdempotencyCache:
+    """Bounded LRU of recent invoice results, with coalescing of concurrent duplicates.
+
+    ``run(key, fingerprint, create, ttl)`` returns ``(result, replayed)``. The
+    first caller for a key runs ``create``; callers arriving while it runs wait
+    for the same result, and later callers get the cached result until it
+    expires. Failures are not cached, so a retry after an error runs again.
+    Entries are evicted oldest-first beyond ``max_entries`` or once the PDFs
+    they hold exceed ``max_bytes``.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> (expires_at, fingerprint, result, size)
+        self._inflight = {}  # key -> (fingerprint, Future)
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0, 'conflicts': 0}
+
+    def run(self, key, fingerprint, create, ttl):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._check(entry[1], fingerprint)
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[2], True
+            inflight = self._inflight.get(key)
+            if inflight is not None:
+                self._check(inflight[0], fingerprint)
+                self._stats['coalesced'] += 1
+            else:
+                self._stats['misses'] += 1
+                self._inflight[key] = (fingerprint, concurrent.futures.Future())
+        if inflight is not None:
+            return inflight[1].result(), True
+
+        future = self._inflight[key][1]
+        try:
+            result = create()
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+        size = len(result.get('pdf') or b'')
+        with self._lock:
+            self._inflight.pop(key, None)
+            if size <= self.max_bytes:
+                self._remove(key)
+                self._entries[key] = (time.monotonic() + ttl, fingerprint, result, size)
+                self._bytes += size
+                while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+                    self._stats['evictions'] += 1
+        future.set_result(result)
+        return result, False
+
+    def _check(self, stored, fingerprint):
+        if stored != fingerprint:
+            self._stats['conflicts'] += 1
+            raise IdempotencyConflict('Idempotency-Key was already used for a different invoice')
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[3]
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._bytes, in_flight=len(self._inflight))
+
+
+idempotency = IdempotencyCache(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_MAX_BYTES)
+
+
+def _invoice_fingerprint(invoice):
+    # Hash of the submitted invoice fields (not the generated number or date)
+    fields = ('companyname', 'companyaddress', 'customername', 'customerphone', 'email', 'stax', 'amount_paid',
+              'products', 'quantities')
+    payload = json.dumps([invoice[f] for f in fields], separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _create_invoice(invoice):
+    """Price and render (or queue) one invoice; returns a result dict shared by the form and the JSON API."""
+    started = metrics.clock()
+    invoice = _price_invoice(invoice)
+    metrics.record('price', started)
+    invoice['number'] = invoice['number'] or allocate_invoice_number()
+    if RENDER_MODE == 'async':
+        return {'job_id': get_render_queue().submit(invoice)}
+    pdf_path, pdf_bytes = _render_invoice(invoice, return_bytes=True)
+    _store_invoice(invoice)
+    queue_invoice_email(invoice, pdf_bytes if pdf_path is None else None)
+    return {'invoice': invoice['number'], 'path': pdf_path,
+            # The PDF itself is only kept when there is no stored copy to point at ('direct' storage)
+            'pdf': pdf_bytes if pdf_path is None else None,
+            'total': round(invoice['finalstax'], 2), 'change': round(invoice['change'], 2)}
+
+
+def _create_invoice_once(invoice):
+    """Run _create_invoice unless the same submission was seen recently; returns (result, replayed)."""
+    fingerprint = _invoice_fingerprint(invoice)
+    key = request.headers.get('Idempotency-Key', '').strip()
+    if key:
+        key, ttl = 'key:' + key, IDEMPOTENCY_TTL
+    elif IDEMPOTENCY_WINDOW > 0:
+        key, ttl = 'content:' + fingerprint, IDEMPOTENCY_WINDOW
+    else:
+        return _create_invoice(invoice), False
+    result, replayed = idempotency.run(key, fingerprint, lambda: _create_invoice(invoice), ttl)
+    if replayed:
+        metrics.inc('invoice_idempotent_replays_total')
+        logging.info('Duplicate submission answered with invoice %s', result.get('invoice') or result.get('job_id'))
+    return result, replayed
+
+
+def _render_index(**context):
+    # Render the form page, falling back to plain HTML when the template is missing
+    try:
+        return render_template('index.html', **context)
+    except Exception:
+        logging.warning('Template index.html not found, returning fallback HTML')
+        body = context.get('error') or context.get('message') or ''
+        return f"<html><body><h1>Invoice Generator</h1><p>{body}</p></body></html>"
+
+
+def _pdf_response(data, number):
+    return send_file(io.BytesIO(data), mimetype='application/pdf', as_attachment=True, download_name=invoice_filename(number))
+
+
+@app.route("/", methods=["POST"])
+def Create():
+    # Use .get to avoid KeyError and validate inputs
+    started = metrics.clock()
+    invoice = _invoice_from_mapping(request.form)
+    metrics.record('parse', started)
+
+    try:
+        # Form posts carry no Idempotency-Key: they are only deduplicated when IDEMPOTENCY_WINDOW is set
+        result, replayed = _create_invoice_once(invoice)
+        if 'job_id' in result:
+            message = f"Invoice queued: job {result['job_id']}"
+            logging.info(message)
+            return _render_index(message=message)
+        if result['path'] is None:
+            # 'direct' storage: hand the PDF straight to the client
+            return _pdf_response(result['pdf'], result['invoice'])
+        message = f"Invoice created: {invoice_filename(result['invoice'])}"
+        logging.info(message)
+        return _render_index(message=message)
+    except Exception as e:
+        metrics.inc('invoice_failures_total', endpoint='Create')
+        logging.exception('Error handling Create request')
+        return _render_index(error=str(e))
+
+
+@app.route("/api/invoices", methods=["POST"])
+def create_invoice_api():
+    # JSON counterpart of the form: returns a job id in async mode, the finished invoice otherwise
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'expected a JSON object'}), 400
+    try:
+        result, replayed = _create_invoice_once(_invoice_from_mapping(data))
+        if 'job_id' in result:
+            job_id = result['job_id']
+            response = jsonify({'job_id': job_id, 'status': 'queued', 'status_url': f'/jobs/{job_id}'}), 202
+        elif result['path'] is None:
+            response = _pdf_response(result['pdf'], result['invoice']), 201
+        else:
+            response = jsonify({'invoice': result['invoice'], 'status': 'done', 'path': result['path'],
+                                'url': f"/invoices/{result['invoice']}.pdf",
+                                'total': result['total'], 'change': result['change']}), 201
+        if replayed:
+            response[0].headers['Idempotent-Replayed'] = 'true'
+        return response
+    except UnknownProduct as e:
+        return jsonify({'error': str(e)}), 400
+    except IdempotencyConflict as e:
+        return jsonify({'error': str(e)}), 422
+    except Exception as e:
+        logging.exception('Error handling invoice API request')
+        return jsonify({'error': str(e)}), 500
+
+
+# Invoices never change once written, so clients and CDNs may cache them for a year
+INVOICE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+@app.route("/invoices/<number>.pdf")
+def download_invoice(number):
+    """Serve a stored invoice PDF with a checksum ETag; conditional and range requests are answered by send_file."""
+    if not number.replace('-', '').replace('_', '').isalnum():
+        return jsonify({'error': 'invoice not found'}), 404
+    storage = get_invoice_storage(persistent=True)
+    path = storage.path_for(number)
+    if path is None or not os.path.isfile(path):
+        # Older invoices may have been moved to the archive
+        archive = InvoiceArchive(ARCHIVE_DIR)
+        entry = archive.entry(number)
+        if entry is None:
+            return jsonify({'error': 'invoice not found'}), 404
+        response = send_file(io.BytesIO(archive.read(number)), mimetype='application/pdf',
+                             download_name=invoice_filename(number), conditional=True, etag=entry['sha256'])
+        response.headers['Cache-Control'] = INVOICE_CACHE_CONTROL
+        return response
+    entry = storage.entry(number)
+    # A strong validator from the stored checksum; without an index Werkzeug derives one from mtime and size
+    etag = entry['sha256'] if entry and entry.get('sha256') else True
+    response = send_file(path, mimetype='application/pdf', download_name=invoice_filename(number),
+                         conditional=True, etag=etag)
+    response.headers['Cache-Control'] = INVOICE_CACHE_CONTROL
+    return response
+
+
+# Page size limits for GET /invoices
+INVOICE_PAGE_SIZE = 50
+INVOICE_MAX_PAGE_SIZE = 500
+
+
+def _db_time(value):
+    # DATETIME values come back as datetime from MySQL and as text from SQLite
+    return value.strftime('%Y-%m-%d %H:%M:%S') if isinstance(value, datetime.datetime) else value
+
+
+def _parse_day(text, end=False):
+    # 'YYYY-MM-DD' (or a full 'YYYY-MM-DD HH:MM:SS') -> comparable Created_At text; ``end`` makes a day inclusive
+    text = text.strip()
+    if len(text) == 10:
+        day = datetime.datetime.strptime(text, '%Y-%m-%d')
+        return (day + datetime.timedelta(days=1) if end else day).strftime('%Y-%m-%d %H:%M:%S')
+    return datetime.datetime.strptime(text, '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _invoice_filters(args):
+    """SQL conditions and parameters for the company/email/date/amount filters in ``args``.
+
+    Raises ValueError for malformed values.
+    """
+    conditions = []
+    params = []
+    for arg, column in (('company', 'Company_Name'), ('email', 'Email_ID')):
+        if args.get(arg):
+            conditions.append(f'`{column}` = %s')
+            params.append(args[arg])
+    if args.get('from'):
+        conditions.append('`Created_At` >= %s')
+        params.append(_parse_day(args['from']))
+    if args.get('to'):
+        # A bare date includes the whole day
+        to = args['to'].strip()
+        conditions.append('`Created_At` < %s' if len(to) == 10 else '`Created_At` <= %s')
+        params.append(_parse_day(to, end=True))
+    if args.get('min_total'):
+        conditions.append('`Final_Amount` >= %s')
+        params.append(float(args['min_total']))
+    if args.get('max_total'):
+        conditions.append('`Final_Amount` <= %s')
+        params.append(float(args['max_total']))
+    return conditions, params
+
+
+def _encode_cursor(row):
+    return base64.urlsafe_b64encode(json.dumps([_db_time(row['Created_At']), row['id']]).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(created_at), int(row_id)
+    except Exception:
+        raise ValueError('invalid cursor')
+
+
+def _invoice_json(row):
+    return {
+        'id': row['id'],
+        'number': row['Invoice_Number'],
+        'company': row['Company_Name'],
+        'email': row['Email_ID'],
+        'product': row['Product'],
+        'amount': round(float(row['Amount'] or 0), 2),
+        'total': round(float(row['Final_Amount'] or 0), 2),
+        'amount_paid': round(float(row['Amount_Paid'] or 0), 2),
+        'change': round(float(row['Change'] or 0), 2),
+        'created_at': _db_time(row['Created_At']),
+        'url': f"/invoices/{row['Invoice_Number']}.pdf" if row['Invoice_Number'] else None,
+    }
+
+
+def search_invoices(args, limit=INVOICE_PAGE_SIZE, cursor=None):
+    """Return (invoices, next_cursor) for the filters in ``args``, newest first.
+
+    Pages are keyed on (Created_At, id) instead of OFFSET, so every page is an
+    index range scan no matter how deep it is.
+    """
+    conditions, params = _invoice_filters(args)
+    if cursor:
+        created_at, row_id = _decode_cursor(cursor)
+        conditions.append('(`Created_At` < %s OR (`Created_At` = %s AND `id` < %s))')
+        params.extend([created_at, created_at, row_id])
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    sql = (f"SELECT `id`, `Invoice_Number`, `Company_Name`, `Email_ID`, `Product`, `Amount`, `Final_Amount`, "
+           f"`Amount_Paid`, `Change`, `Created_At` FROM `{DB_TABLE}` {where} "
+           f"ORDER BY `Created_At` DESC, `id` DESC LIMIT %s")
+    with get_db_pool().connection() as connection:
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(sql, params + [limit + 1])
+            rows = db_cursor.fetchall()
+    next_cursor = _encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return [_invoice_json(row) for row in rows[:limit]], next_cursor
+
+
+@app.route("/invoices")
+def list_invoices():
+    # Filters: company, email, from/to (YYYY-MM-DD), min_total/max_total; pass next_cursor back as ?cursor=
+    try:
+        limit = min(max(int(request.args.get('limit', INVOICE_PAGE_SIZE)), 1), INVOICE_MAX_PAGE_SIZE)
+        invoices, next_cursor = search_invoices(request.args, limit, request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'invoices': invoices, 'next_cursor': next_cursor})
+
+
+# Columns written by the invoice export, in order
+EXPORT_COLUMNS = ('id', 'Invoice_Number', 'Created_At', 'Company_Name', 'Company_Address', 'Email_ID', 'Product',
+                  'Amount', 'Final_Amount', 'Amount_Paid', 'Change')
+
+
+def _export_value(value):
+    # Keep DECIMAL amounts exact and DATETIME values in the same text form SQLite returns
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return _db_time(value)
+
+
+def export_invoices(fmt, args=None, after_id=0, header=True, chunk_rows=1000):
+    """Yield the invoices table as CSV or JSON-lines text in id order, ``chunk_rows`` rows per chunk.
+
+    Rows are read through an unbuffered server-side cursor (SSDictCursor on
+    MySQL), so memory stays constant however large the table is. ``args``
+    takes the GET /invoices filters; ``after_id`` resumes an export after the
+    last id already received.
+    """
+    conditions, params = _invoice_filters(args or {})
+    conditions.insert(0, '`id` > %s')
+    params.insert(0, int(after_id or 0))
+    sql = (f"SELECT {', '.join(f'`{col}`' for col in EXPORT_COLUMNS)} FROM `{DB_TABLE}` "
+           f"WHERE {' AND '.join(conditions)} ORDER BY `id`")
+    pool = get_db_pool()
+    connection = pool.acquire()
+    try:
+        if DB_BACKEND == 'sqlite':
+            # sqlite3 cursors already step through results lazily
+            cursor = connection.cursor()
+        else:
+            with connection.cursor() as session:
+                # The server waits on slow clients while streaming; don't let it give up after 60s
+                session.execute('SET SESSION net_write_timeout = 3600')
+            cursor = connection.cursor(pymysql.cursors.SSDictCursor)
+        cursor.execute(sql, params)
+        out = io.StringIO()
+        writer = csv.writer(out) if fmt == 'csv' else None
+        if writer is not None and header:
+            writer.writerow(EXPORT_COLUMNS)
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            for row in rows:
+                values = [_export_value(row[col]) for col in EXPORT_COLUMNS]
+                if writer is not None:
+                    writer.writerow(values)
+                else:
+                    out.write(json.dumps(dict(zip(EXPORT_COLUMNS, values))) + '\n')
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+        if out.tell():
+            yield out.getvalue()
+    finally:
+        # An unbuffered result that was not read to the end would have to be drained before the
+        # connection could be reused, and the session timeout was changed: close it instead
+        pool.release(connection, discard=True)
+
+
+@app.route("/invoices/export")
+def export_invoices_endpoint():
+    # ?format=csv|jsonl, the GET /invoices filters, and after_id=<last id received> to resume
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({'error': 'format must be csv or jsonl'}), 400
+    try:
+        _invoice_filters(request.args)
+        after_id = int(request.args.get('after_id') or 0)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(export_invoices(fmt, request.args, after_id, header=not after_id)),
+                        mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="invoices.{fmt}"'
+    return response
+
+
+def _last_exported_id(path, fmt):
+    # id of the last complete row in an earlier export file, or 0
+    last = None
+    with open(path, encoding='utf-8', newline='') as fh:
+        if fmt == 'csv':
+            for row in csv.reader(fh):
+                if row and row[0] != 'id':
+                    last = row[0]
+        else:
+            for line in fh:
+                if line.strip():
+                    last = json.loads(line)['id']
+    return int(last) if last is not None else 0
+
+
+@app.route("/reports/revenue")
+def revenue_report_endpoint():
+    # ?period=day|month&from=YYYY-MM-DD&to=YYYY-MM-DD&company=...; answered from revenue_rollups
+    try:
+        rows = revenue_report(request.args.get('period', 'day'), request.args.get('from'),
+                              request.args.get('to'), request.args.get('company'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    totals = {col: round(sum(row[col] for row in rows), 2) for col in ROLLUP_FIELDS}
+    totals['invoices'] = int(totals['invoices'])
+    return jsonify({'period': request.args.get('period', 'day'), 'rows': rows, 'totals': totals})
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    status = get_render_queue().status(job_id) if _render_queue is not None else None
+    if status is None:
+        return jsonify({'error': 'unknown job'}), 404
+    if status['status'] == 'done':
+        status['url'] = f"/invoices/{status['invoice']}.pdf"
+    return jsonify(status)
+
+
+def _read_batch(stream, fmt):
+    """Yield ``(line_number, invoice, error)`` for each record of a CSV or JSON-lines upload.
+
+    CSV files use the form field names as column headers (``CompanyName``,
+    ``Product1``, ``Quantity1``, ...); JSON-lines records use the
+    ``POST /api/invoices`` body format.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='') if isinstance(stream.read(0), bytes) else stream
+    if fmt == 'csv':
+        rows = ((reader.line_num, row) for reader in [csv.DictReader(text)] for row in reader)
+    else:
+        rows = ((number, line) for number, line in enumerate(text, 1) if line.strip())
+    for number, row in rows:
+        try:
+            data = row if fmt == 'csv' else json.loads(row)
+            if not isinstance(data, dict):
+                raise ValueError('expected a JSON object')
+            invoice = _price_invoice(_invoice_from_mapping(data))
+            if not invoice['products']:
+                raise ValueError('no line items')
+        except Exception as e:
+            yield number, None, e
+        else:
+            yield number, invoice, None
+
+
+class _ZipStream:
+    # Write-only file object collecting zipfile output so it can be yielded in chunks
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _errors_csv(errors):
+    # errors.csv report of the ``(line, message)`` records a batch skipped
+    report = io.StringIO()
+    writer = csv.writer(report)
+    writer.writerow(['line', 'error'])
+    writer.writerows(sorted(errors))
+    return report.getvalue()
+
+
+def generate_batch(stream, fmt, workers=None, stats=None):
+    """Render every invoice in an upload and yield a ZIP archive of the PDFs chunk by chunk.
+
+    Invoices are rendered in parallel on the render queue's process pool and
+    added to the archive in completion order; their database rows are inserted
+    in bulk and customers with an email address are sent theirs. Records that fail to parse or render are listed in ``errors.csv``
+    inside the archive instead of aborting the batch. ``stats`` (a dict), if
+    given, is filled with counts and throughput.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(rendered=0, failed=0, started=time.monotonic())
+    errors = []
+    records = []
+    batch_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    def items():
+        for number, invoice, error in _read_batch(stream, fmt):
+            if error is not None:
+                errors.append((number, str(error)))
+                continue
+            invoice['number'] = allocate_invoice_number()
+            yield number, invoice
+
+    def flush_records():
+        try:
+            _insert_invoice_records(records)
+        except Exception:
+            logging.exception('Bulk insert of %d invoice(s) failed', len(records))
+        records.clear()
+
+    out = _ZipStream()
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for number, invoice, result, error in get_render_queue().render_many(items(), window=workers and 4 * workers):
+            if error is not None:
+                errors.append((number, str(error)))
+                continue
+            zf.writestr(invoice_filename(invoice['number']), result[1])
+            queue_invoice_email(invoice, result[1] if result[0] is None else None)
+            records.append(_invoice_record(invoice['companyname'], invoice['companyaddress'], invoice['total_amount'], invoice['email'],
+                                           invoice['finalstax'], _product_summary(invoice), invoice['amount_paid'], invoice['change'],
+                                           invoice['number'], _invoice_items(invoice)))
+            if len(records) >= DB_WRITE_BATCH_SIZE:
+                flush_records()
+            stats['rendered'] += 1
+            yield out.drain()
+        flush_records()
+        stats['failed'] = len(errors)
+        if errors:
+            zf.writestr('errors.csv', _errors_csv(errors))
+    elapsed = time.monotonic() - stats['started']
+    stats['elapsed'] = elapsed
+    stats['invoices_per_sec'] = stats['rendered'] / elapsed if elapsed > 0 else 0.0
+    logging.info('Batch %s: %d rendered, %d failed in %.2fs (%.1f invoices/sec)', batch_id, stats['rendered'], stats['failed'], elapsed, stats['invoices_per_sec'])
+    yield out.drain()
+
+
+def render_print_run(invoices, output):
+    """Draw priced and numbered ``invoices`` as consecutive pages of a single PDF written to ``output``.
+
+    Logo, watermark, fonts and the static page layout are embedded once and
+    referenced from every page, and each invoice gets an outline entry.
+    ReportLab writes the file on ``save()``, so finished pages are kept
+    compressed in memory until the run is complete. Returns the page count.
+    """
+    c = canvas.Canvas(output, pagesize=letter, pageCompression=int(_pdf_profile()['compress']))
+    c.setTitle(f"Print run {datetime.datetime.now():%Y-%m-%d %H:%M}")
+    pages = 0
+    for invoice in invoices:
+        started = metrics.clock()
+        c.bookmarkPage(invoice['number'])
+        c.addOutlineEntry(f"{invoice['number']} {invoice['companyname']}", invoice['number'])
+        pages += _draw_pharma_invoice(c, invoice['companyname'], invoice['companyaddress'], str(invoice['total_amount']),
+                                      str(invoice['stax']), invoice['email'], invoice['number'], invoice['date'],
+                                      str(invoice['finalstax']), invoice['products'], invoice['quantities'],
+                                      invoice['amount_paid'], invoice['change'], invoice['customername'],
+                                      invoice['customerphone'], reuse=True)
+        c.showPage()
+        metrics.record('draw', started)
+    started = metrics.clock()
+    c.save()
+    metrics.record('pdf_save', started)
+    metrics.inc('invoice_pages_total', pages)
+    return pages
+
+
+def generate_print_run(stream, fmt, output, workers=None, stats=None, store=True):
+    """Render every invoice in a batch upload into the single print-run PDF ``output``.
+
+    Each invoice is also rendered on its own on the render pool, saved to
+    storage, inserted into the database and emailed, exactly as in
+    ``generate_batch``, so it can be downloaded later. Only invoices whose own
+    render succeeded are drawn into the print run, in input order. Records
+    that fail to parse or render are skipped and listed in ``stats['errors']``
+    as ``(line, message)``.
+
+    ``store=False`` makes a print-only draft: invoices are drawn once, into
+    the print run only, numbered ``DRAFT-<n>`` rather than from the invoice
+    number sequence, and nothing is stored, inserted or emailed.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(rendered=0, failed=0, errors=[], started=time.monotonic())
+    records = []
+
+    def flush_records():
+        try:
+            _insert_invoice_records(records)
+        except Exception:
+            logging.exception('Bulk insert of %d invoice(s) failed', len(records))
+        records.clear()
+
+    def items():
+        # Keyed by (sequence, line): the pool completes out of order and pages must follow the input
+        sequence = itertools.count()
+        for number, invoice, error in _read_batch(stream, fmt):
+            if error is not None:
+                stats['errors'].append((number, str(error)))
+                continue
+            invoice['number'] = allocate_invoice_number()
+            yield (next(sequence), number), invoice
+
+    def drafts():
+        sequence = itertools.count(1)
+        for number, invoice, error in _read_batch(stream, fmt):
+            if error is not None:
+                stats['errors'].append((number, str(error)))
+                continue
+            invoice['number'] = f'DRAFT-{next(sequence):05d}'
+            yield invoice
+            stats['rendered'] += 1
+
+    def invoices():
+        finished = {}
+        position = 0
+        for (sequence, number), invoice, result, error in get_render_queue().render_many(items(), window=workers and 4 * workers):
+            finished[sequence] = (number, invoice, result, error)
+            while position in finished:
+                number, invoice, result, error = finished.pop(position)
+                position += 1
+                if error is not None:
+                    stats['errors'].append((number, str(error)))
+                    continue
+                yield invoice
+                path, data = result
+                queue_invoice_email(invoice, data if path is None else None)
+                records.append(_invoice_record(invoice['companyname'], invoice['companyaddress'], invoice['total_amount'], invoice['email'],
+                                               invoice['finalstax'], _product_summary(invoice), invoice['amount_paid'], invoice['change'],
+                                               invoice['number'], _invoice_items(invoice)))
+                if len(records) >= DB_WRITE_BATCH_SIZE:
+                    flush_records()
+                stats['rendered'] += 1
+
+    stats['pages'] = render_print_run(invoices() if store else drafts(), output)
+    flush_records()
+    stats['failed'] = len(stats['errors'])
+    elapsed = time.monotonic() - stats['started']
+    stats['elapsed'] = elapsed
+    stats['invoices_per_sec'] = stats['rendered'] / elapsed if elapsed > 0 else 0.0
+    logging.info('Print run: %d invoices on %d pages, %d failed in %.2fs (%.1f invoices/sec)',
+                 stats['rendered'], stats['pages'], stats['failed'], elapsed, stats['invoices_per_sec'])
+    return stats
+
+
+def _batch_format(filename, requested=None):
+    fmt = (requested or os.path.splitext(filename or '')[1].lstrip('.')).lower()
+    return 'jsonl' if fmt in ('jsonl', 'ndjson', 'json') else 'csv' if fmt == 'csv' else None
+
+
+@app.route("/batch", methods=["POST"])
+def create_batch():
+    # Bulk invoice generation: upload a CSV or JSON-lines file, receive a streamed ZIP of PDFs
+    # (or, with ?output=pdf, one print-run PDF holding every invoice)
+    upload = request.files.get('file')
+    fmt = _batch_format(upload.filename if upload else None, request.args.get('format'))
+    if fmt is None:
+        return jsonify({'error': 'upload a .csv or .jsonl file (or pass ?format=csv|jsonl)'}), 400
+    # Spool the upload to disk: the request's own stream is closed before a streamed response finishes
+    stream = tempfile.TemporaryFile()
+    shutil.copyfileobj(upload.stream if upload else request.stream, stream)
+    stream.seek(0)
+    if request.args.get('output') == 'pdf':
+        output = tempfile.TemporaryFile()
+        try:
+            stats = generate_print_run(stream, fmt, output, store=request.args.get('draft') not in ('1', 'true'))
+        finally:
+            stream.close()
+        output.seek(0)
+        response = send_file(output, mimetype='application/pdf', as_attachment=True,
+                             download_name=f"Print run ({datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}).pdf")
+        response.headers['X-Invoices-Rendered'] = str(stats['rendered'])
+        response.headers['X-Invoices-Failed'] = str(stats['failed'])
+        if stats['errors']:
+            # The PDF has no room for errors.csv; name the skipped input lines instead
+            response.headers['X-Invoices-Failed-Lines'] = ','.join(str(line) for line, _ in sorted(stats['errors']))
+        return response
+    filename = f"Invoices ({datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}).zip"
+
+    def body():
+        try:
+            yield from generate_batch(stream, fmt)
+        finally:
+            stream.close()
+
+    return Response(stream_with_context(body()), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+# Cold-start timings of this process, filled in by preload()
+startup = {}
+
+
+def _warm_renderers():
+    # Draw one throwaway invoice of each style in memory: loads the standard font metrics,
+    # the lazily imported parts of ReportLab and the cached page templates
+    render_pdf('Preload', '', '0', '0', '', 'PRELOAD', canvas, '01/01/2000', '0', 'Pens')
+    render_pdf_pharma('Preload', '', '0', '0', '', 'PRELOAD', canvas, '01/01/2000', '0', [], [], 0.0, 0.0, '', '')
+
+
+def preload():
+    """Load the per-process state a worker would otherwise build on its first requests.
+
+    Meant to run once in the parent of a pre-fork server, so every worker
+    starts warm and shares these objects copy-on-write. Each step is timed;
+    a failing step is logged and skipped. Returns the ``startup`` timings.
+    """
+    if startup.get('preloaded'):
+        return startup
+    steps = [('assets', lambda: [assets.get(name) for name in LOGO_FILES + (WATERMARK_FILE,)])]
+    if PAGE_TEMPLATES:
+        steps.append(('templates', lambda: [_get_page_template(layout) for layout in _PAGE_LAYOUTS]))
+    steps.append(('renderers', _warm_renderers))
+    if CATALOG_WARM:
+        steps.append(('catalog', catalog.warm))
+    for name, step in steps:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logging.warning('Preload step %s failed: %s', name, e)
+        startup[f'{name}_seconds'] = round(time.perf_counter() - started, 4)
+    # The warm-up renders are not traffic
+    metrics.reset()
+    startup['preloaded'] = True
+    return startup
+
+
+def _reset_after_fork():
+    # Sockets, threads and process pools do not survive fork(): a worker must open its own.
+    # Dropping the references (rather than closing) leaves the parent's connections alone.
+    global _db_pool, _db_pool_lock, _invoice_writer, _invoice_writer_lock, _render_queue, _render_queue_lock
+    global _email_sender, _email_sender_lock
+    _db_pool = None
+    _db_pool_lock = threading.Lock()
+    _invoice_writer = None
+    _invoice_writer_lock = threading.Lock()
+    _render_queue = None
+    _render_queue_lock = threading.Lock()
+    _email_sender = None
+    _email_sender_lock = threading.Lock()
+    startup['worker_pid'] = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def create_app():
+    """WSGI entry point for production servers, e.g. ``gunicorn -c gunicorn.conf.py``.
+
+    Returns the Flask app after ``preload()`` (unless PRELOAD=0) with debug
+    mode off, and logs the cold-start time: import plus preload.
+    """
+    app.debug = False
+    if PRELOAD:
+        preload()
+    startup['ready_seconds'] = round(time.perf_counter() - _IMPORT_STARTED, 4)
+    logging.info('Application ready in %.3fs (%s)', startup['ready_seconds'],
+                 ', '.join(f'{k}={v}' for k, v in sorted(startup.items()) if k.endswith('_seconds')))
+    return app
+
+
+@app.route("/startup")
+def startup_stats():
+    # Cold-start timings of the process serving this request
+    return jsonify(dict(startup, pid=os.getpid()))
+
+
+def run_cli(argv):
+    parser = argparse.ArgumentParser(prog='server.py', description='Invoice generator command line tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    batch_cmd = commands.add_parser('batch', help='render a CSV or JSON-lines file of invoices into a ZIP')
+    batch_cmd.add_argument('input', help='CSV or JSON-lines file of invoices')
+    batch_cmd.add_argument('-o', '--output', help='ZIP file to write (default: input name with .zip)')
+    batch_cmd.add_argument('--format', choices=['csv', 'jsonl'], help='input format (default: from file extension)')
+    batch_cmd.add_argument('--workers', type=int, help='render processes (default: RENDER_WORKERS)')
+    batch_cmd.add_argument('--print-run', action='store_true',
+                           help='write every invoice into one PDF (default output: input name with .pdf)')
+    batch_cmd.add_argument('--draft', action='store_true',
+                           help='with --print-run: print only; no invoice numbers, database rows, stored PDFs or emails')
+    commands.add_parser('migrate', help='create or upgrade the database tables')
+    serve_cmd = commands.add_parser('serve', help='serve without debug mode, reloader or browser (single process; '
+                                                  'use gunicorn -c gunicorn.conf.py for several cores)')
+    serve_cmd.add_argument('--host', default='0.0.0.0')
+    serve_cmd.add_argument('--port', type=int, default=8080)
+    archive_cmd = commands.add_parser('archive', help='pack invoices older than N days into ZIP bundles')
+    archive_cmd.add_argument('--days', type=int, required=True, help='archive invoices older than this')
+    archive_cmd.add_argument('--dry-run', action='store_true', help='only report what would be archived')
+    extract_cmd = commands.add_parser('extract', help='write one stored or archived invoice PDF to a file')
+    extract_cmd.add_argument('number')
+    extract_cmd.add_argument('-o', '--output', help='file to write (default: Invoice (<number>).pdf)')
+    mail_cmd = commands.add_parser('send-mail', help='send queued invoice emails (for EMAIL_WORKER=0 deployments)')
+    mail_cmd.add_argument('--once', action='store_true', help='exit once nothing is due instead of waiting for more')
+    rollups_cmd = commands.add_parser('rebuild-rollups', help='recompute the revenue rollups from the invoices table')
+    rollups_cmd.add_argument('--from', dest='from_', metavar='YYYY-MM-DD',
+                             help='only rebuild buckets from this month onwards')
+    export_cmd = commands.add_parser('export', help='stream the invoices table to CSV or JSON-lines')
+    export_cmd.add_argument('-o', '--output', help='file to write (default: standard output)')
+    export_cmd.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    export_cmd.add_argument('--from', dest='from_', metavar='YYYY-MM-DD', help='first day to include')
+    export_cmd.add_argument('--to', metavar='YYYY-MM-DD', help='last day to include')
+    export_cmd.add_argument('--company', help='only this company')
+    export_cmd.add_argument('--after-id', type=int, default=0, help='start after this invoice id')
+    export_cmd.add_argument('--resume', action='store_true', help='append to --output after its last exported id')
+    backfill_cmd = commands.add_parser('backfill-items', help='fill invoice_items for invoices stored before it existed')
+    backfill_cmd.add_argument('--batch-size', type=int, default=1000)
+    storage_cmd = commands.add_parser('migrate-storage', help='move a flat INVOICE/ folder into the sharded layout')
+    storage_cmd.add_argument('--source', help='folder with Invoice (<number>).pdf files (default: INVOICE_DIR)')
+    storage_cmd.add_argument('--reindex', action='store_true', help='rebuild manifest.jsonl from the files on disk')
+    products_cmd = commands.add_parser('products', help='list or update catalog prices')
+    products_cmd.add_argument('action', choices=['list', 'set', 'import'])
+    products_cmd.add_argument('args', nargs='*', help='set: NAME PRICE; import: CSV file with name,price columns')
+    args = parser.parse_args(argv)
+
+    if args.command == 'migrate':
+        applied = migrate()
+        print(f"Applied {len(applied)} migration(s){': ' + ', '.join(applied) if applied else ''}")
+        return 0
+
+    if args.command == 'archive':
+        stats = archive_invoices(args.days, dry_run=args.dry_run)
+        if not stats['invoices']:
+            print(f'No invoices older than {args.days} day(s)')
+        elif args.dry_run:
+            print(f"{stats['invoices']} invoice(s), {stats['bytes']:,} bytes, would go into {len(stats['bundles'])} bundle(s)")
+        else:
+            print(f"Archived {stats['invoices']} invoice(s), {stats['bytes']:,} bytes, into {len(stats['bundles'])} new bundle(s) "
+                  f"in {ARCHIVE_DIR} ({stats['archive_bytes']:,} bytes)")
+        return 0
+
+    if args.command == 'extract':
+        data = read_invoice_pdf(args.number)
+        if data is None:
+            print(f'Invoice {args.number} not found', file=sys.stderr)
+            return 1
+        output = args.output or invoice_filename(args.number)
+        with open(output, 'wb') as fh:
+            fh.write(data)
+        print(f'Wrote {output}')
+        return 0
+
+    if args.command == 'send-mail':
+        if not SMTP_HOST:
+            parser.error('set SMTP_HOST to send email')
+        sender = EmailSender(_smtp_connect, _invoice_email, rate=EMAIL_RATE, max_attempts=EMAIL_MAX_ATTEMPTS,
+                             retry_delay=EMAIL_RETRY_DELAY, idle_close=EMAIL_IDLE_CLOSE,
+                             max_per_connection=EMAIL_MESSAGES_PER_CONNECTION)
+        started = time.monotonic()
+        try:
+            if args.once:
+                while sender.run_once():
+                    pass
+                sender.stop()
+            else:
+                sender.start()
+                while True:
+                    time.sleep(3600)
+        except KeyboardInterrupt:
+            sender.stop()
+        stats = sender.stats()
+        elapsed = time.monotonic() - started
+        print(f"{stats.get('sent', 0)} sent, {stats.get('retried', 0)} to retry, {stats.get('failed', 0)} failed "
+              f"over {stats.get('connections', 0)} SMTP connection(s) in {elapsed:.2f}s; outbox: {email_outbox_depth()}")
+        return 0
+
+    if args.command == 'serve':
+        create_app()
+        if SMTP_HOST and EMAIL_WORKER:
+            get_email_sender()
+        app.run(host=args.host, port=args.port, debug=False, use_reloader=False, threaded=True)
+        return 0
+
+    if args.command == 'rebuild-rollups':
+        rebuild_revenue_rollups(args.from_)
+        print('Revenue rollups rebuilt')
+        return 0
+
+    if args.command == 'export':
+        filters = {'from': args.from_, 'to': args.to, 'company': args.company}
+        after_id = args.after_id
+        if args.resume and args.output and os.path.exists(args.output):
+            after_id = max(after_id, _last_exported_id(args.output, args.format))
+        dst = open(args.output, 'a' if args.resume else 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+        try:
+            for chunk in export_invoices(args.format, filters, after_id, header=not after_id):
+                dst.write(chunk)
+        finally:
+            if dst is not sys.stdout:
+                dst.close()
+        return 0
+
+    if args.command == 'backfill-items':
+        print(f'Backfilled line items for {backfill_invoice_items(args.batch_size)} invoice(s)')
+        return 0
+
+    if args.command == 'migrate-storage':
+        storage = ShardedStorage(INVOICE_DIR)
+        if args.reindex:
+            print(f'Indexed {storage.rebuild_manifest()} invoice(s) in {storage.manifest.path}')
+            return 0
+        moved = migrate_flat_storage(args.source or INVOICE_DIR, storage)
+        print(f'Moved {moved} invoice(s) into {INVOICE_DIR}')
+        return 0
+
+    if args.command == 'products':
+        if args.action == 'list':
+            for name, price in sorted(_load_product_prices().items()):
+                print(f'{name}\t{price:.2f}')
+            return 0
+        if args.action == 'set':
+            if len(args.args) != 2:
+                parser.error('products set NAME PRICE')
+            prices = {args.args[0]: float(args.args[1])}
+        else:
+            if len(args.args) != 1:
+                parser.error('products import FILE.csv')
+            with open(args.args[0], newline='', encoding='utf-8-sig') as fh:
+                prices = {row['name'].strip(): float(row['price']) for row in csv.DictReader(fh)}
+        _save_product_prices(prices)
+        print(f'Saved {len(prices)} product price(s); running servers pick them up within {CATALOG_TTL:g}s '
+              f'(or immediately after POST /products/reload)')
+        return 0
+
+    if args.command == 'batch':
+        global RENDER_WORKERS
+        RENDER_WORKERS = args.workers or RENDER_WORKERS
+        fmt = _batch_format(args.input, args.format)
+        if fmt is None:
+            parser.error('cannot tell the input format; pass --format')
+        if args.print_run:
+            output = args.output or os.path.splitext(args.input)[0] + '.pdf'
+            with open(args.input, 'rb') as src:
+                stats = generate_print_run(src, fmt, output, workers=args.workers, store=not args.draft)
+            if stats['errors']:
+                errors_path = os.path.splitext(output)[0] + '.errors.csv'
+                with open(errors_path, 'w', newline='', encoding='utf-8') as fh:
+                    fh.write(_errors_csv(stats['errors']))
+                print(f"{stats['failed']} record(s) skipped, listed in {errors_path}", file=sys.stderr)
+            print(f"{stats['rendered']} invoices on {stats['pages']} pages, {stats['failed']} failed in {stats['elapsed']:.2f}s "
+                  f"({stats['invoices_per_sec']:.1f} invoices/sec) -> {output}")
+            return 1 if stats['failed'] else 0
+        output = args.output or os.path.splitext(args.input)[0] + '.zip'
+        stats = {}
+        with open(args.input, 'rb') as src, open(output, 'wb') as dst:
+            for chunk in generate_batch(src, fmt, workers=args.workers, stats=stats):
+                dst.write(chunk)
+        print(f"{stats['rendered']} invoices rendered, {stats['failed']} failed in {stats['elapsed']:.2f}s "
+              f"({stats['invoices_per_sec']:.1f} invoices/sec) -> {output}")
+        return 1 if stats['failed'] else 0
+
+
+startup['import_seconds'] = round(time.perf_counter() - _IMPORT_STARTED, 4)
+
+
+if __name__ == "__main__":
+    # Subcommands (e.g. `python server.py batch invoices.csv`) run a tool instead of the web server
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+
+    if CATALOG_WARM:
+        try:
+            catalog.warm()
+        except Exception as e:
+            logging.warning('Could not warm the product catalog: %s', e)
 
-if __name__ == "__main__":
     # Configure where to open the browser. Use localhost so the browser can access the local server.
     HOST = '0.0.0.0'
     PORT = 8080
@@ -582,4 +4230,7 @@ if __name__ == "__main__":
     else:
         # Child process or non-debug run: start a thread to open the browser and run the server.
         threading.Thread(target=_open_browser_delayed, daemon=True).start()
+        if SMTP_HOST and EMAIL_WORKER:
+            # Send mail queued before a restart, too
+            get_email_sender()
         app.run(host=HOST, port=PORT, debug=DEBUG)
@@ -0,0 +1,22 @@
+import os
+import shutil
+import sys
+import tempfile
+
+# server.py reads its configuration at import time: point it at the local SQLite stand-in
+# and a throwaway invoice folder before any test imports it
+_WORKDIR = tempfile.mkdtemp(prefix='invoice-tests-')
+os.environ.update({
+    'DB_BACKEND': 'sqlite',
+    'DB_SQLITE_PATH': os.path.join(_WORKDIR, 'test.sqlite3'),
+    'DB_WRITE_BEHIND': '0',
+    'INVOICE_DIR': os.path.join(_WORKDIR, 'INVOICE'),
+    'INVOICE_STORAGE': 'sharded',
+    'RENDER_MODE': 'sync',
+    'PRELOAD': '0',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_WORKDIR, ignore_errors=True)
@@ -0,0 +1,69 @@
+import os
+import time
+import zipfile
+
+import pytest
+
+import server
+
+OLD = time.time() - 400 * 86400
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return server.ShardedStorage(str(tmp_path / 'INVOICE'))
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return server.InvoiceArchive(str(tmp_path / 'archive'))
+
+
+def save_old(storage, numbers):
+    for number in numbers:
+        storage.save(number, b'%PDF-1.4 ' + number.encode() * 50, created=OLD)
+
+
+def test_archived_invoices_are_read_back_from_their_bundle(storage, archive):
+    save_old(storage, ['ARC-1', 'ARC-2'])
+    storage.save('NEW-1', b'%PDF-1.4 new')
+    stats = server.archive_invoices(365, storage=storage, archive=archive)
+    assert stats['invoices'] == 2
+    assert archive.read('ARC-1') == b'%PDF-1.4 ' + b'ARC-1' * 50
+    assert storage.path_for('ARC-1') is None
+    assert storage.path_for('NEW-1') is not None
+    assert server.archive_invoices(365, storage=storage, archive=archive)['invoices'] == 0
+
+
+def test_a_run_aborted_mid_bundle_leaves_earlier_bundles_and_its_sources_intact(storage, archive, monkeypatch):
+    save_old(storage, ['ARC-1', 'ARC-2'])
+    first, = server.archive_invoices(365, storage=storage, archive=archive)['bundles']
+
+    save_old(storage, ['ARC-3', 'ARC-4'])
+    write = zipfile.ZipFile.write
+    calls = []
+
+    def crash_on_second_member(self, *args, **kwargs):
+        calls.append(args)
+        if len(calls) == 2:
+            raise KeyboardInterrupt('killed mid-add')
+        return write(self, *args, **kwargs)
+
+    monkeypatch.setattr(zipfile.ZipFile, 'write', crash_on_second_member)
+    with pytest.raises(KeyboardInterrupt):
+        server.archive_invoices(365, storage=storage, archive=archive)
+    monkeypatch.undo()
+
+    # The earlier bundle is untouched and no partial bundle or temporary file is left behind
+    assert sorted(os.listdir(archive.root)) == sorted([first, server.InvoiceArchive.INDEX, server.InvoiceArchive.INDEX + '.lock'])
+    with zipfile.ZipFile(os.path.join(archive.root, first)) as zf:
+        assert zf.testzip() is None
+    assert archive.read('ARC-1') and archive.read('ARC-2')
+    # The interrupted invoices were neither indexed nor deleted
+    assert archive.entry('ARC-3') is None
+    assert os.path.isfile(storage.path_for('ARC-3'))
+
+    stats = server.archive_invoices(365, storage=storage, archive=archive)
+    assert stats['invoices'] == 2 and stats['bundles'] != [first]
+    assert archive.read('ARC-3') == b'%PDF-1.4 ' + b'ARC-3' * 50
+    assert archive.read('ARC-1') == b'%PDF-1.4 ' + b'ARC-1' * 50
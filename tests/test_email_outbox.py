@@ -0,0 +1,220 @@
+import io
+import smtplib
+import time
+import zipfile
+
+import pytest
+
+import server
+
+
+class FakeSMTP:
+    """Stands in for smtplib.SMTP: records messages and raises the scripted errors in turn."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        self.messages = []
+        self.closed = False
+
+    def send_message(self, message):
+        if self.closed:
+            raise smtplib.SMTPServerDisconnected('connection closed')
+        if self.errors:
+            error = self.errors.pop(0)
+            if isinstance(error, smtplib.SMTPServerDisconnected):
+                self.closed = True
+            raise error
+        self.messages.append(message)
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class FakeServer:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.connections = []
+
+    def connect(self):
+        smtp = FakeSMTP(self.errors)
+        self.connections.append(smtp)
+        return smtp
+
+    @property
+    def messages(self):
+        return [message for smtp in self.connections for message in smtp.messages]
+
+
+@pytest.fixture(autouse=True)
+def outbox(monkeypatch):
+    server.migrate()
+    monkeypatch.setattr(server, 'SMTP_HOST', 'smtp.invalid')
+    monkeypatch.setattr(server, 'EMAIL_WORKER', False)
+    with server.get_db_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM `email_outbox`")
+        connection.commit()
+
+
+def make_sender(smtp_server, **kwargs):
+    kwargs.setdefault('rate', 0)
+    kwargs.setdefault('retry_delay', 30.0)
+    return server.EmailSender(smtp_server.connect, server._invoice_email, **kwargs)
+
+
+def queue(number, recipient='customer@example.com'):
+    server.queue_invoice_email({'number': number, 'email': recipient}, pdf=b'%PDF-1.4 ' + number.encode())
+
+
+def outbox_row(number):
+    with server.get_db_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT * FROM `email_outbox` WHERE `invoice_number` = %s", (number,))
+            return cursor.fetchone()
+
+
+def make_due(number):
+    with server.get_db_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE `email_outbox` SET `next_attempt_at` = %s WHERE `invoice_number` = %s",
+                           (time.time() - 1, number))
+        connection.commit()
+
+
+def test_queued_message_is_sent_with_its_pdf():
+    smtp_server = FakeServer()
+    queue('MAIL-1')
+    assert outbox_row('MAIL-1')['status'] == 'pending'
+
+    assert make_sender(smtp_server).run_once() == 1
+
+    row = outbox_row('MAIL-1')
+    assert (row['status'], row['attempts'], row['claim']) == ('sent', 1, None)
+    assert row['sent_at']
+    message, = smtp_server.messages
+    assert message['To'] == 'customer@example.com'
+    attachment, = message.iter_attachments()
+    assert attachment.get_content() == b'%PDF-1.4 MAIL-1'
+
+
+def test_invoices_without_an_address_are_not_queued():
+    queue('MAIL-NONE', recipient='')
+    assert outbox_row('MAIL-NONE') is None
+
+
+def test_temporary_failures_are_retried_with_backoff():
+    busy = smtplib.SMTPRecipientsRefused({'customer@example.com': (451, b'try again later')})
+    smtp_server = FakeServer(busy, busy)
+    sender = make_sender(smtp_server)
+    queue('MAIL-2')
+
+    started = time.time()
+    sender.run_once()
+    row = outbox_row('MAIL-2')
+    assert (row['status'], row['attempts']) == ('pending', 1)
+    assert '451' in row['last_error']
+    assert row['next_attempt_at'] == pytest.approx(started + 30.0, abs=5.0)
+    # Not due yet: nothing is claimed
+    assert sender.run_once() == 0
+
+    make_due('MAIL-2')
+    started = time.time()
+    sender.run_once()
+    row = outbox_row('MAIL-2')
+    assert (row['status'], row['attempts']) == ('pending', 2)
+    assert row['next_attempt_at'] == pytest.approx(started + 60.0, abs=5.0)
+
+    make_due('MAIL-2')
+    sender.run_once()
+    row = outbox_row('MAIL-2')
+    assert (row['status'], row['attempts'], row['last_error']) == ('sent', 3, None)
+    assert sender.stats()['retried'] == 2
+
+
+def test_permanent_rejection_fails_at_once():
+    smtp_server = FakeServer(smtplib.SMTPRecipientsRefused({'customer@example.com': (550, b'no such user')}))
+    sender = make_sender(smtp_server)
+    queue('MAIL-3')
+    sender.run_once()
+    row = outbox_row('MAIL-3')
+    assert (row['status'], row['attempts']) == ('failed', 1)
+    assert '550' in row['last_error']
+    assert sender.stats()['failed'] == 1
+
+
+def test_message_fails_after_max_attempts():
+    busy = smtplib.SMTPRecipientsRefused({'customer@example.com': (451, b'try again later')})
+    sender = make_sender(FakeServer(busy, busy), max_attempts=2)
+    queue('MAIL-4')
+    sender.run_once()
+    make_due('MAIL-4')
+    sender.run_once()
+    assert (outbox_row('MAIL-4')['status'], outbox_row('MAIL-4')['attempts']) == ('failed', 2)
+
+
+def test_one_connection_is_reused_across_messages():
+    smtp_server = FakeServer()
+    for i in range(5):
+        queue(f'MAIL-R{i}')
+    sender = make_sender(smtp_server)
+    assert sender.run_once() == 5
+    assert len(smtp_server.connections) == 1
+    assert len(smtp_server.messages) == 5
+    stats = sender.stats()
+    assert (stats['connections'], stats['messages_per_connection'], stats['connected']) == (1, 5.0, True)
+    sender.stop()
+    assert smtp_server.connections[0].closed
+    assert not sender.stats()['connected']
+
+
+def test_connection_is_replaced_after_max_messages():
+    smtp_server = FakeServer()
+    for i in range(5):
+        queue(f'MAIL-M{i}')
+    make_sender(smtp_server, max_per_connection=2).run_once()
+    assert [len(smtp.messages) for smtp in smtp_server.connections] == [2, 2, 1]
+    assert all(smtp.closed for smtp in smtp_server.connections[:2])
+
+
+def test_dropped_connection_is_reopened_and_the_message_resent():
+    smtp_server = FakeServer(smtplib.SMTPServerDisconnected('idle timeout'))
+    queue('MAIL-D')
+    sender = make_sender(smtp_server)
+    sender.run_once()
+    assert outbox_row('MAIL-D')['status'] == 'sent'
+    assert len(smtp_server.connections) == 2
+    assert len(smtp_server.messages) == 1
+
+
+def test_claimed_messages_are_not_sent_by_a_second_sender():
+    queue('MAIL-C')
+    first = make_sender(FakeServer())
+    rows = first._claim()
+    assert [row['invoice_number'] for row in rows] == ['MAIL-C']
+    assert outbox_row('MAIL-C')['status'] == 'sending'
+    assert make_sender(FakeServer()).run_once() == 0
+
+
+def test_batch_invoices_are_emailed_to_their_customers():
+    upload = io.BytesIO(b'CompanyName,Email,STax,AmountPaid,Product1,Quantity1\n'
+                        b'Acme,buyer@example.com,10,100,Pens,2\n'
+                        b'Quiet Ltd,,10,100,Pens,1\n')
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(server.generate_batch(upload, 'csv'))))
+    numbers = sorted(name for name in archive.namelist() if name.endswith('.pdf'))
+    assert len(numbers) == 2
+
+    with server.get_db_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT `invoice_number`, `recipient` FROM `email_outbox`")
+            rows = cursor.fetchall()
+    row, = rows
+    assert row['recipient'] == 'buyer@example.com'
+
+    smtp_server = FakeServer()
+    make_sender(smtp_server).run_once()
+    message, = smtp_server.messages
+    attachment, = message.iter_attachments()
+    assert attachment.get_content() == archive.read(server.invoice_filename(row['invoice_number']))
@@ -0,0 +1,142 @@
+import threading
+import time
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def make_pool(tmp_path):
+    pools = []
+
+    def make(**kwargs):
+        path = str(tmp_path / 'pool.sqlite3')
+        pool = server.ConnectionPool(lambda: server._SQLiteConnection(path), **kwargs)
+        pools.append(pool)
+        return pool
+
+    yield make
+    for pool in pools:
+        pool.close()
+
+
+def test_checkout_and_return_reuses_the_connection(make_pool):
+    pool = make_pool(min_size=1, max_size=2)
+    pool.fill()
+    conn = pool.acquire()
+    assert pool.stats()['in_use'] == 1
+    pool.release(conn)
+    assert pool.acquire() is conn
+    stats = pool.stats()
+    assert (stats['created'], stats['acquired'], stats['released'], stats['size']) == (1, 2, 1, 1)
+
+
+def test_connection_block_rolls_back_and_returns_the_connection(make_pool):
+    pool = make_pool(min_size=0, max_size=1)
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('CREATE TABLE t (x INTEGER)')
+        conn.commit()
+    with pytest.raises(RuntimeError):
+        with pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('INSERT INTO t VALUES (%s)', (1,))
+            raise RuntimeError('boom')
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) AS n FROM t')
+            assert cursor.fetchone()['n'] == 0
+    assert pool.stats()['idle'] == 1
+
+
+def test_connections_past_max_lifetime_are_recycled(make_pool):
+    pool = make_pool(min_size=0, max_size=1, max_lifetime=0.05)
+    first = pool.acquire()
+    pool.release(first)
+    time.sleep(0.1)
+    second = pool.acquire()
+    assert second is not first
+    stats = pool.stats()
+    assert (stats['recycled'], stats['closed'], stats['created'], stats['size']) == (1, 1, 2, 1)
+
+
+def test_idle_connections_failing_a_ping_are_replaced(make_pool):
+    pool = make_pool(min_size=0, max_size=1, ping_idle=0)
+    stale = pool.acquire()
+    pool.release(stale)
+    stale.close()  # the server dropped it while it sat in the pool
+    fresh = pool.acquire()
+    assert fresh is not stale
+    fresh.ping()
+    assert pool.stats()['ping_failures'] == 1
+
+
+def test_exhausted_pool_times_out_then_hands_over_a_released_connection(make_pool):
+    pool = make_pool(min_size=0, max_size=1, timeout=0.05)
+    conn = pool.acquire()
+    with pytest.raises(server.PoolTimeout):
+        pool.acquire()
+    assert pool.stats()['timeouts'] == 1
+
+    threading.Timer(0.05, pool.release, args=(conn,)).start()
+    assert pool.acquire(timeout=2.0) is conn
+    assert pool.stats()['waits'] >= 1
+
+
+def test_release_rejects_foreign_connections(make_pool, tmp_path):
+    pool = make_pool(min_size=0, max_size=1)
+    with pytest.raises(ValueError):
+        pool.release(server._SQLiteConnection(str(tmp_path / 'other.sqlite3')))
+
+
+def test_counters_stay_consistent_under_concurrency(make_pool):
+    pool = make_pool(min_size=0, max_size=4, timeout=10.0)
+
+    def worker():
+        for _ in range(200):
+            pool.release(pool.acquire())
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = pool.stats()
+    assert stats['acquired'] == stats['released'] == 1600
+    assert stats['in_use'] == 0
+    assert stats['size'] <= 4
+
+
+def test_release_ends_the_open_transaction(make_pool):
+    # A read-only borrower still leaves a transaction (a snapshot, under MySQL) open; release must end it
+    pool = make_pool(min_size=0, max_size=1)
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('CREATE TABLE t (x INTEGER)')
+        conn.commit()
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('INSERT INTO t VALUES (%s)', (1,))
+        assert conn._conn.in_transaction
+    assert not conn._conn.in_transaction
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) AS n FROM t')
+            assert cursor.fetchone()['n'] == 0
+
+
+def test_connection_that_cannot_be_reset_is_discarded(make_pool):
+    class BrokenRollback:
+        def rollback(self):
+            raise OSError('connection lost')
+
+        def close(self):
+            pass
+
+    pool = make_pool(min_size=0, max_size=1)
+    pool._connect = BrokenRollback
+    conn = pool.acquire()
+    pool.release(conn)
+    stats = pool.stats()
+    assert (stats['reset_failures'], stats['idle'], stats['size']) == (1, 0, 0)